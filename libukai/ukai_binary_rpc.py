@@ -0,0 +1,593 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_binary_rpc.py module provides a length-prefixed binary
+protocol to transfer block data between nodes.  Only the data path
+operations (read, write, allocate_dataspace, and the vectored
+readv and writev) are served, and the other operations use XML-RPC.
+Block data is sent as raw bytes without any XML encoding.
+
+A request consists of a header, the image name, the fixed size
+arguments of the operation and the payload.
+
+    !IBBH: body length, operation, flags, image name length
+    image name
+    arguments (see UKAI_BINARY_RPC_ARGS)
+    payload (the data to be written)
+
+A response consists of a header and the payload.
+
+    !IBB: body length, status, flags
+    payload (the data read, the return value packed by !q, or an
+        error message)
+
+The vectored operations carry multiple pieces of one disk image.
+The arguments are followed by a !QQQ (block index, offset, length)
+tupple of each piece.  The length is the size to be read for readv,
+and the length of the payload of the piece for writev, whose
+payloads follow the tupples in order.  The response payload of
+readv is a !I length and the data of each piece, and the one of
+writev is a !q return value of each piece.
+
+All-zero data is sent as a zero extent without the payload.  A write
+request with UKAI_BINARY_RPC_FLAG_ZERO carries the !Q length of the
+zeros as the payload, and a read response with the flag has no
+payload.  The most significant bit of a piece length of readv and
+writev marks a zero extent of the length in the other bits, which
+has no payload.  Servers send zero extents only if the flag is set
+in the read request.
+
+The connection is kept open and reused for subsequent requests.
+'''
+
+import errno
+import socket
+import SocketServer
+import struct
+import time
+
+from ukai_compression import UKAINodeCompression, UKAI_COMPRESSION_NONE
+from ukai_compression import UKAI_COMPRESSION_DEFAULT_LEVEL
+from ukai_compression import ukai_compression_encoding, ukai_compression_level
+from ukai_compression import ukai_encode, ukai_decode
+from ukai_local_io import ukai_local_read, ukai_local_write
+from ukai_local_io import ukai_local_write_zero, ukai_is_zero
+from ukai_local_io import ukai_local_allocate_dataspace
+from ukai_rpc import UKAIRPCConnectionPool, UKAI_RPC_SERVER_TIMEOUT
+from ukai_statistics import UKAIStatistics
+
+UKAI_BINARY_RPC_READ = 1
+UKAI_BINARY_RPC_WRITE = 2
+UKAI_BINARY_RPC_ALLOCATE_DATASPACE = 3
+UKAI_BINARY_RPC_READV = 4
+UKAI_BINARY_RPC_WRITEV = 5
+
+# The payload is compressed by zlib at the level stored in the upper
+# 4 bits of the flags (0 means UKAI_COMPRESSION_DEFAULT_LEVEL).  In a
+# read request, the flags request the server to compress the data
+# read in the same way.
+UKAI_BINARY_RPC_FLAG_ZLIB = 0x01
+UKAI_BINARY_RPC_FLAG_ZERO = 0x02
+UKAI_BINARY_RPC_LEVEL_SHIFT = 4
+
+UKAI_BINARY_RPC_STATUS_OK = 0
+UKAI_BINARY_RPC_STATUS_ERROR = 1
+
+_UKAI_BINARY_RPC_REQUEST = struct.Struct('!IBBH')
+_UKAI_BINARY_RPC_RESPONSE = struct.Struct('!IBB')
+_UKAI_BINARY_RPC_RESULT = struct.Struct('!q')
+_UKAI_BINARY_RPC_PIECE = struct.Struct('!QQQ')
+_UKAI_BINARY_RPC_PIECE_LENGTH = struct.Struct('!I')
+_UKAI_BINARY_RPC_ZERO_LENGTH = struct.Struct('!Q')
+# The bit of the piece lengths of readv (!I) and writev (!QQQ)
+# marking a zero extent.
+_UKAI_BINARY_RPC_PIECE_LENGTH_ZERO = 1 << 31
+_UKAI_BINARY_RPC_PIECE_ZERO = 1 << 63
+# operation => the struct of the arguments.
+#   read: block size, block index, offset, size
+#   write: block size, block index, offset
+#   allocate_dataspace: block size, block index
+#   readv, writev: block size, the number of pieces
+UKAI_BINARY_RPC_ARGS = {
+    UKAI_BINARY_RPC_READ: struct.Struct('!QQQQ'),
+    UKAI_BINARY_RPC_WRITE: struct.Struct('!QQQ'),
+    UKAI_BINARY_RPC_ALLOCATE_DATASPACE: struct.Struct('!QQ'),
+    UKAI_BINARY_RPC_READV: struct.Struct('!QI'),
+    UKAI_BINARY_RPC_WRITEV: struct.Struct('!QI'),
+}
+
+class UKAIBinaryRPCError(IOError):
+    '''
+    The UKAIBinaryRPCError exception is raised when a server reports
+    an error of an operation.
+    '''
+    pass
+
+def _ukai_encoding_flags(encoding):
+    '''
+    Returns the flags of the compression encoding.
+    '''
+    level = ukai_compression_level(encoding)
+    if level is None:
+        return (0)
+    if level == UKAI_COMPRESSION_DEFAULT_LEVEL:
+        return (UKAI_BINARY_RPC_FLAG_ZLIB)
+    return (UKAI_BINARY_RPC_FLAG_ZLIB
+            | (level << UKAI_BINARY_RPC_LEVEL_SHIFT))
+
+def _ukai_flags_encoding(flags):
+    '''
+    Returns the compression encoding of the flags.
+    '''
+    if not flags & UKAI_BINARY_RPC_FLAG_ZLIB:
+        return (UKAI_COMPRESSION_NONE)
+    level = flags >> UKAI_BINARY_RPC_LEVEL_SHIFT
+    if level == 0:
+        level = UKAI_COMPRESSION_DEFAULT_LEVEL
+    return (ukai_compression_encoding(level))
+
+def _ukai_recv(fp, size):
+    '''
+    Reads exactly the specified bytes from a file object of a socket.
+
+    Return values: The data read, or None if the connection is closed
+        before any byte is read.
+    '''
+    data = fp.read(size)
+    if len(data) == size:
+        return (data)
+    if len(data) == 0:
+        return (None)
+    raise socket.error(errno.ECONNRESET, 'Connection closed in a message')
+
+class UKAIBinaryRPCConnection(object):
+    '''
+    The UKAIBinaryRPCConnection class is a connection to a server,
+    which is kept by the UKAIRPCConnectionPool class.
+    '''
+    def __init__(self, statistics):
+        self._statistics = statistics
+        self._sock = None
+        self._fp = None
+
+    def _connect(self, server, port):
+        start_time = time.time()
+        self._sock = socket.create_connection((server, port))
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._fp = self._sock.makefile('rb')
+        self._statistics.add_connect(time.time() - start_time)
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._fp.close()
+        self._sock.close()
+        self._fp = None
+        self._sock = None
+
+    def request(self, server, port, operation, flags, image_name, args,
+                payload=''):
+        '''
+        Sends a request and receives the response.  If a reused
+        connection turns out to be closed by the server, the request
+        is sent again over a new connection.
+
+        Return values: A (flags, payload) tupple of the response.
+        '''
+        body = image_name + UKAI_BINARY_RPC_ARGS[operation].pack(*args)
+        message = (_UKAI_BINARY_RPC_REQUEST.pack(len(body) + len(payload),
+                                                 operation, flags,
+                                                 len(image_name))
+                   + body + payload)
+        for attempt in (0, 1):
+            reused = self._sock is not None
+            if reused:
+                self._statistics.add_reuse()
+            else:
+                self._connect(server, port)
+            try:
+                self._sock.sendall(message)
+                header = _ukai_recv(self._fp, _UKAI_BINARY_RPC_RESPONSE.size)
+                if header is None:
+                    raise socket.error(errno.ECONNRESET,
+                                       'Connection closed by the server')
+                (length, status, flags) = _UKAI_BINARY_RPC_RESPONSE.unpack(
+                    header)
+                response = ''
+                if length > 0:
+                    response = _ukai_recv(self._fp, length)
+                    if response is None:
+                        raise socket.error(errno.ECONNRESET,
+                                           'Connection closed in a message')
+            except socket.error:
+                self.close()
+                if attempt or not reused:
+                    raise
+                continue
+            if status != UKAI_BINARY_RPC_STATUS_OK:
+                raise UKAIBinaryRPCError(response)
+            return (flags, response)
+
+class UKAIBinaryRPCCall(object):
+    '''
+    The UKAIBinaryRPCCall class sends requests to a server using the
+    connections kept in ukai_binary_rpc_connection_pool.
+    '''
+    def __init__(self, server, port, compression=None):
+        '''
+        param server: the address of the server.
+        param port: the port number of the server.
+        param compression: an UKAINodeCompression instance of the
+            link to the server, which chooses the encoding of block
+            data and counts the bytes transferred.  If None, data is
+            compressed by zlib at the default level.
+        '''
+        self._server = server
+        self._port = port
+        if compression is None:
+            compression = UKAINodeCompression(server)
+        self._compression = compression
+
+    def _request(self, operation, flags, image_name, args, payload=''):
+        conn = ukai_binary_rpc_connection_pool.acquire(self._server,
+                                                       self._port)
+        reusable = False
+        try:
+            ret = conn.request(self._server, self._port, operation, flags,
+                               image_name, args, payload)
+            reusable = True
+            return ret
+        except UKAIBinaryRPCError:
+            reusable = True
+            raise
+        finally:
+            ukai_binary_rpc_connection_pool.release(self._server,
+                                                    self._port,
+                                                    conn, reusable)
+
+    def read(self, image_name, block_size, block_index, offset, size):
+        (flags, payload) = self._request(
+            UKAI_BINARY_RPC_READ,
+            (_ukai_encoding_flags(self._compression.encoding())
+             | UKAI_BINARY_RPC_FLAG_ZERO),
+            image_name, (block_size, block_index, offset, size))
+        if flags & UKAI_BINARY_RPC_FLAG_ZERO:
+            self._compression.zero_extent(size)
+            if image_name in UKAIStatistics:
+                UKAIStatistics[image_name].zero_wire_read(size)
+            return ('\0' * size)
+        return (self._compression.decode(_ukai_flags_encoding(flags),
+                                         payload))
+
+    def write(self, image_name, block_size, block_index, offset, data):
+        if ukai_is_zero(data):
+            (flags, payload) = self._request(
+                UKAI_BINARY_RPC_WRITE, UKAI_BINARY_RPC_FLAG_ZERO,
+                image_name, (block_size, block_index, offset),
+                _UKAI_BINARY_RPC_ZERO_LENGTH.pack(len(data)))
+            self._compression.zero_extent(len(data))
+            if image_name in UKAIStatistics:
+                UKAIStatistics[image_name].zero_wire_write(len(data))
+            return (_UKAI_BINARY_RPC_RESULT.unpack(payload)[0])
+        (encoding, encoded_data) = self._compression.encode(data)
+        (flags, payload) = self._request(UKAI_BINARY_RPC_WRITE,
+                                         _ukai_encoding_flags(encoding),
+                                         image_name,
+                                         (block_size, block_index, offset),
+                                         encoded_data)
+        return (_UKAI_BINARY_RPC_RESULT.unpack(payload)[0])
+
+    def allocate_dataspace(self, image_name, block_size, block_index):
+        (flags, payload) = self._request(UKAI_BINARY_RPC_ALLOCATE_DATASPACE,
+                                         0, image_name,
+                                         (block_size, block_index))
+        return (_UKAI_BINARY_RPC_RESULT.unpack(payload)[0])
+
+    def readv(self, image_name, block_size, pieces):
+        '''
+        Reads multiple pieces of the disk image in one request.
+
+        param pieces: a list of (block index, offset, size) tupples.
+
+        Return values: A list of the data of each piece.
+        '''
+        request = ''.join([_UKAI_BINARY_RPC_PIECE.pack(*piece)
+                           for piece in pieces])
+        (flags, payload) = self._request(
+            UKAI_BINARY_RPC_READV,
+            (_ukai_encoding_flags(self._compression.encoding())
+             | UKAI_BINARY_RPC_FLAG_ZERO),
+            image_name, (block_size, len(pieces)), request)
+        encoding = _ukai_flags_encoding(flags)
+        data_list = []
+        pos = 0
+        for piece in pieces:
+            (length,) = _UKAI_BINARY_RPC_PIECE_LENGTH.unpack_from(payload,
+                                                                  pos)
+            pos += _UKAI_BINARY_RPC_PIECE_LENGTH.size
+            if length & _UKAI_BINARY_RPC_PIECE_LENGTH_ZERO:
+                length &= ~_UKAI_BINARY_RPC_PIECE_LENGTH_ZERO
+                self._compression.zero_extent(length)
+                if image_name in UKAIStatistics:
+                    UKAIStatistics[image_name].zero_wire_read(length)
+                data_list.append('\0' * length)
+                continue
+            data_list.append(self._compression.decode(
+                    encoding, payload[pos:pos + length]))
+            pos += length
+        return (data_list)
+
+    def writev(self, image_name, block_size, pieces):
+        '''
+        Writes multiple pieces of the disk image in one request.
+
+        param pieces: a list of (block index, offset, data) tupples.
+
+        Return values: A list of the return values of each piece.
+        '''
+        encoding = self._compression.encoding()
+        headers = []
+        payloads = []
+        zero_sizes = []
+        for (blk_idx, offset, data) in pieces:
+            if ukai_is_zero(data):
+                zero_sizes.append(len(data))
+                headers.append(_UKAI_BINARY_RPC_PIECE.pack(
+                        blk_idx, offset,
+                        len(data) | _UKAI_BINARY_RPC_PIECE_ZERO))
+                continue
+            payload = self._compression.encode(data, encoding)[1]
+            headers.append(_UKAI_BINARY_RPC_PIECE.pack(blk_idx, offset,
+                                                       len(payload)))
+            payloads.append(payload)
+        request = ''.join(headers)
+        (flags, payload) = self._request(UKAI_BINARY_RPC_WRITEV,
+                                         _ukai_encoding_flags(encoding),
+                                         image_name,
+                                         (block_size, len(pieces)),
+                                         request + ''.join(payloads))
+        for size in zero_sizes:
+            self._compression.zero_extent(size)
+            if image_name in UKAIStatistics:
+                UKAIStatistics[image_name].zero_wire_write(size)
+        return ([_UKAI_BINARY_RPC_RESULT.unpack_from(
+                    payload, idx * _UKAI_BINARY_RPC_RESULT.size)[0]
+                 for idx in range(0, len(pieces))])
+
+ukai_binary_rpc_connection_pool = UKAIRPCConnectionPool(
+    UKAIBinaryRPCConnection)
+
+class UKAIBinaryRPCRequestHandler(SocketServer.StreamRequestHandler):
+    '''
+    The UKAIBinaryRPCRequestHandler class serves requests received on
+    one connection until the client closes it, or it is idle for
+    UKAI_RPC_SERVER_TIMEOUT seconds.
+    '''
+    timeout = UKAI_RPC_SERVER_TIMEOUT
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        while True:
+            try:
+                header = _ukai_recv(self.rfile,
+                                    _UKAI_BINARY_RPC_REQUEST.size)
+                if header is None:
+                    return
+                (length, operation, flags,
+                 name_length) = _UKAI_BINARY_RPC_REQUEST.unpack(header)
+                body = _ukai_recv(self.rfile, length)
+                if body is None:
+                    return
+            except socket.error:
+                return
+            status = UKAI_BINARY_RPC_STATUS_OK
+            try:
+                (flags, payload) = self._dispatch(operation, flags,
+                                                  body[:name_length],
+                                                  body[name_length:])
+            except Exception, e:
+                status = UKAI_BINARY_RPC_STATUS_ERROR
+                flags = 0
+                payload = '%s: %s' % (e.__class__.__name__, e)
+            try:
+                self.wfile.write(_UKAI_BINARY_RPC_RESPONSE.pack(
+                        len(payload), status, flags) + payload)
+            except socket.error:
+                return
+
+    def _dispatch(self, operation, flags, image_name, body):
+        config = self.server.config
+        args_struct = UKAI_BINARY_RPC_ARGS[operation]
+        args = args_struct.unpack(body[:args_struct.size])
+        payload = body[args_struct.size:]
+        encoding = _ukai_flags_encoding(flags)
+        if operation == UKAI_BINARY_RPC_READ:
+            (block_size, block_index, offset, size) = args
+            data = ukai_local_read(image_name, block_size, block_index,
+                                   offset, size, config)
+            if flags & UKAI_BINARY_RPC_FLAG_ZERO and ukai_is_zero(data):
+                return (UKAI_BINARY_RPC_FLAG_ZERO, '')
+            return (flags & ~UKAI_BINARY_RPC_FLAG_ZERO,
+                    ukai_encode(data, encoding))
+        if operation == UKAI_BINARY_RPC_WRITE:
+            (block_size, block_index, offset) = args
+            if flags & UKAI_BINARY_RPC_FLAG_ZERO:
+                (size,) = _UKAI_BINARY_RPC_ZERO_LENGTH.unpack(payload)
+                ret = ukai_local_write_zero(image_name, block_size,
+                                            block_index, offset, size,
+                                            config)
+                return (0, _UKAI_BINARY_RPC_RESULT.pack(ret))
+            ret = ukai_local_write(image_name, block_size, block_index,
+                                   offset, ukai_decode(payload, encoding),
+                                   config)
+            return (0, _UKAI_BINARY_RPC_RESULT.pack(ret))
+        if operation == UKAI_BINARY_RPC_ALLOCATE_DATASPACE:
+            (block_size, block_index) = args
+            ret = ukai_local_allocate_dataspace(image_name, block_size,
+                                                block_index, config)
+            return (0, _UKAI_BINARY_RPC_RESULT.pack(ret))
+        (block_size, num_pieces) = args
+        pieces = [_UKAI_BINARY_RPC_PIECE.unpack_from(
+                payload, idx * _UKAI_BINARY_RPC_PIECE.size)
+                  for idx in range(0, num_pieces)]
+        pos = num_pieces * _UKAI_BINARY_RPC_PIECE.size
+        response = []
+        if operation == UKAI_BINARY_RPC_READV:
+            for (block_index, offset, size) in pieces:
+                data = ukai_local_read(image_name, block_size, block_index,
+                                       offset, size, config)
+                if flags & UKAI_BINARY_RPC_FLAG_ZERO and ukai_is_zero(data):
+                    response.append(_UKAI_BINARY_RPC_PIECE_LENGTH.pack(
+                            size | _UKAI_BINARY_RPC_PIECE_LENGTH_ZERO))
+                    continue
+                data = ukai_encode(data, encoding)
+                response.append(_UKAI_BINARY_RPC_PIECE_LENGTH.pack(len(data)))
+                response.append(data)
+            return (flags & ~UKAI_BINARY_RPC_FLAG_ZERO, ''.join(response))
+        for (block_index, offset, length) in pieces:
+            if length & _UKAI_BINARY_RPC_PIECE_ZERO:
+                ret = ukai_local_write_zero(
+                    image_name, block_size, block_index, offset,
+                    length & ~_UKAI_BINARY_RPC_PIECE_ZERO, config)
+                response.append(_UKAI_BINARY_RPC_RESULT.pack(ret))
+                continue
+            data = ukai_decode(payload[pos:pos + length], encoding)
+            pos += length
+            ret = ukai_local_write(image_name, block_size, block_index,
+                                   offset, data, config)
+            response.append(_UKAI_BINARY_RPC_RESULT.pack(ret))
+        return (0, ''.join(response))
+
+class UKAIBinaryRPCServer(SocketServer.ThreadingMixIn,
+                          SocketServer.TCPServer):
+    '''
+    The UKAIBinaryRPCServer class serves the binary protocol with a
+    thread per connection.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, config):
+        '''
+        param server_address: an (address, port) tupple to listen on.
+        param config: an UKAIConfig instance.
+        '''
+        self.config = config
+        SocketServer.TCPServer.__init__(self, server_address,
+                                        UKAIBinaryRPCRequestHandler)
+
+if __name__ == '__main__':
+    import os
+    import shutil
+    import sys
+    import tempfile
+    import threading
+    import xmlrpclib
+    import zlib
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    from ukai_rpc import UKAIXMLRPCCall, UKAIXMLRPCRequestHandler
+    from ukai_rpc import ukai_rpc_connection_pool
+
+    class Config(dict):
+        def get(self, key):
+            return (dict.get(self, key))
+
+    class XMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+        daemon_threads = True
+
+    # Compares the throughput of the data path operations of the
+    # binary protocol with the XML-RPC path used by the UKAICore
+    # class, on localhost.
+    count = 200
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    block_size = 1024 * 1024
+    piece_size = 64 * 1024
+    config = Config(data_root=tempfile.mkdtemp(),
+                    blockname_format='%016d')
+
+    def proxy_read(image_name, str_block_size, str_block_index,
+                   str_offset, str_size):
+        data = ukai_local_read(image_name, int(str_block_size),
+                               int(str_block_index), int(str_offset),
+                               int(str_size), config)
+        return xmlrpclib.Binary(zlib.compress(data))
+
+    def proxy_write(image_name, str_block_size, str_block_index,
+                    str_offset, encoded_data):
+        return ukai_local_write(image_name, int(str_block_size),
+                                int(str_block_index), int(str_offset),
+                                zlib.decompress(encoded_data.data), config)
+
+    xmlrpc_server = XMLRPCServer(('127.0.0.1', 0),
+                                 requestHandler=UKAIXMLRPCRequestHandler,
+                                 logRequests=False, allow_none=True)
+    xmlrpc_server.register_function(proxy_read)
+    xmlrpc_server.register_function(proxy_write)
+    binary_server = UKAIBinaryRPCServer(('127.0.0.1', 0), config)
+    for server in (xmlrpc_server, binary_server):
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    xmlrpc_call = UKAIXMLRPCCall('127.0.0.1',
+                                 xmlrpc_server.server_address[1])
+    binary_call = UKAIBinaryRPCCall('127.0.0.1',
+                                    binary_server.server_address[1])
+    binary_call.allocate_dataspace('benchmark', block_size, 0)
+    num_pieces = block_size / piece_size
+    for (data_name, data) in (('random', os.urandom(piece_size)),
+                              ('zero', '\0' * piece_size)):
+        for (name, write, read) in (
+            ('xmlrpc',
+             lambda offset: xmlrpc_call.call(
+                    'proxy_write', 'benchmark', str(block_size), '0',
+                    str(offset),
+                    xmlrpclib.Binary(zlib.compress(data))),
+             lambda offset: zlib.decompress(xmlrpc_call.call(
+                        'proxy_read', 'benchmark', str(block_size), '0',
+                        str(offset), str(piece_size)).data)),
+            ('binary',
+             lambda offset: binary_call.write(
+                    'benchmark', block_size, 0, offset, data),
+             lambda offset: binary_call.read(
+                    'benchmark', block_size, 0, offset, piece_size))):
+            for (op_name, op) in (('write', write), ('read', read)):
+                start_time = time.time()
+                for i in range(0, count):
+                    op((i % num_pieces) * piece_size)
+                elapsed = time.time() - start_time
+                print '%s %s (%s data): %.1f MB/sec' % (
+                    name, op_name, data_name,
+                    count * piece_size / elapsed / 1000000)
+    ukai_rpc_connection_pool.clear()
+    ukai_binary_rpc_connection_pool.clear()
+    xmlrpc_server.shutdown()
+    binary_server.shutdown()
+    shutil.rmtree(config['data_root'])
@@ -0,0 +1,398 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_block_status.py module provides a compact in-memory
+representation of the location and synchronization status of all the
+blocks of a disk image.
+'''
+
+import binascii
+
+# The status value of a node which is not a location of a block.
+UKAI_NO_LOCATION = 0xff
+
+# The sync status value of an in-sync node.  Must be the same as
+# UKAI_IN_SYNC defined in the ukai_metadata.py module.
+UKAI_BLOCK_STATUS_IN_SYNC = 0
+
+def _ukai_translation_table(mapping):
+    table = bytearray(range(0, 256))
+    for (src, dst) in mapping.items():
+        table[src] = dst
+    return (str(table))
+
+# A translation table which converts in-sync entries to 1, and the
+# other entries to 0.
+_UKAI_IN_SYNC_FLAGS = str(bytearray([1 if value == UKAI_BLOCK_STATUS_IN_SYNC
+                                     else 0 for value in range(0, 256)]))
+
+def _ukai_or_flags(flags1, flags2):
+    '''
+    Returns the bitwise OR of two byte arrays of the same length.
+    '''
+    if len(flags1) == 0:
+        return (flags1)
+    value = (long(binascii.hexlify(flags1), 16)
+             | long(binascii.hexlify(flags2), 16))
+    return (bytearray(binascii.unhexlify('%0*x' % (len(flags1) * 2, value))))
+
+class UKAIBlockStatusTable(object):
+    '''
+    The UKAIBlockStatusTable class keeps the sync status of each node
+    of each block.  Node addresses are interned to small integers,
+    and the status of a node is kept in a byte array which has one
+    entry per block.  An entry is UKAI_NO_LOCATION if the node is not
+    a location of the block.
+
+    The JSON style representation used for storing and exchanging
+    metadata is a list of dictionaries shown below.
+
+        [{NODE: {'sync_status': SYNC_STATUS}, ...}, ...]
+    '''
+    def __init__(self, num_blocks):
+        '''
+        Initializes a table of the specified number of blocks without
+        any location.
+
+        num_blocks: The number of blocks of a disk image.
+
+        Return values: This function does not return any values.
+        '''
+        self._num_blocks = num_blocks
+        # interned index => node address.
+        self._nodes = []
+        # node address => interned index.
+        self._node_index = {}
+        # interned index => a byte array of the sync status.
+        self._status = []
+
+    @classmethod
+    def from_json(cls, blocks):
+        '''
+        Creates a table from the JSON style representation.
+
+        blocks: a list of location dictionaries of each block.
+        '''
+        table = cls(len(blocks))
+        for blk_idx in range(0, len(blocks)):
+            for node in blocks[blk_idx]:
+                status = table._get_status_array(node, True)
+                status[blk_idx] = blocks[blk_idx][node]['sync_status']
+        return (table)
+
+    def to_json(self):
+        '''
+        Returns the JSON style representation of the table.
+        '''
+        blocks = []
+        for blk_idx in range(0, self._num_blocks):
+            block = {}
+            for node_idx in range(0, len(self._nodes)):
+                sync_status = self._status[node_idx][blk_idx]
+                if sync_status == UKAI_NO_LOCATION:
+                    continue
+                block[self._nodes[node_idx]] = {'sync_status': sync_status}
+            blocks.append(block)
+        return (blocks)
+
+    @classmethod
+    def unpack(cls, num_blocks, nodes, packed_status):
+        '''
+        Creates a table from the packed representation returned by
+        the pack method.
+
+        num_blocks: The number of blocks.
+        nodes: A list of node addresses.
+        packed_status: A string which contains the sync status arrays
+            of the nodes in the order of the nodes argument.
+        '''
+        assert len(packed_status) == num_blocks * len(nodes)
+        table = cls(num_blocks)
+        for node_idx in range(0, len(nodes)):
+            status = table._get_status_array(nodes[node_idx], True)
+            status[:] = packed_status[node_idx * num_blocks:
+                                      (node_idx + 1) * num_blocks]
+        return (table)
+
+    def pack(self):
+        '''
+        Returns a (nodes, packed_status) tupple, where nodes is a list
+        of node addresses which are a location of at least one block,
+        and packed_status is a string which contains the sync status
+        arrays of the nodes in the same order.  Each array has one
+        byte per block.
+        '''
+        nodes = self.nodes
+        packed_status = ''.join([str(self._status[self._node_index[node]])
+                                 for node in nodes])
+        return ((nodes, packed_status))
+
+    def slice(self, start_idx, end_idx):
+        '''
+        Returns a new table which contains the specified range of
+        blocks.
+
+        start_idx: The first block index.
+        end_idx: The last block index.
+        '''
+        table = UKAIBlockStatusTable(end_idx - start_idx + 1)
+        for node_idx in range(0, len(self._nodes)):
+            status = self._status[node_idx][start_idx:end_idx + 1]
+            if status.count(chr(UKAI_NO_LOCATION)) == len(status):
+                continue
+            table._get_status_array(self._nodes[node_idx], True)[:] = status
+        return (table)
+
+    def merge(self, start_idx, table):
+        '''
+        Replaces the range of blocks starting at start_idx with the
+        contents of the specified table.
+
+        start_idx: The block index at which the table is merged.
+        table: An UKAIBlockStatusTable instance returned by the slice
+            method.
+
+        Return values: This function does not return any values.
+        '''
+        end_idx = start_idx + table._num_blocks - 1
+        absent = bytearray(chr(UKAI_NO_LOCATION) * table._num_blocks)
+        for node_idx in range(0, len(self._nodes)):
+            if self._nodes[node_idx] in table._node_index:
+                continue
+            self._status[node_idx][start_idx:end_idx + 1] = absent
+        for node_idx in range(0, len(table._nodes)):
+            status = self._get_status_array(table._nodes[node_idx], True)
+            status[start_idx:end_idx + 1] = table._status[node_idx]
+
+    @property
+    def num_blocks(self):
+        '''
+        The number of blocks.
+        '''
+        return (self._num_blocks)
+
+    @property
+    def nodes(self):
+        '''
+        A list of all the nodes which are a location of at least one
+        block.
+        '''
+        return ([self._nodes[node_idx]
+                 for node_idx in range(0, len(self._nodes))
+                 if (self._status[node_idx].count(chr(UKAI_NO_LOCATION))
+                     != self._num_blocks)])
+
+    def get_locations(self, blk_idx):
+        '''
+        Returns a list of nodes which are locations of the specified
+        block.
+
+        blk_idx: The index of a block.
+        '''
+        return ([self._nodes[node_idx]
+                 for node_idx in range(0, len(self._nodes))
+                 if self._status[node_idx][blk_idx] != UKAI_NO_LOCATION])
+
+    def has_location(self, blk_idx, node):
+        '''
+        Returns True if the node is a location of the specified block.
+
+        blk_idx: The index of a block.
+        node: The address of a node.
+        '''
+        status = self._get_status_array(node)
+        if status is None:
+            return (False)
+        return (status[blk_idx] != UKAI_NO_LOCATION)
+
+    def get_sync_status(self, blk_idx, node):
+        '''
+        Returns the sync status of the node of the specified block.
+        The node must be a location of the block.
+
+        blk_idx: The index of a block.
+        node: The address of a node.
+        '''
+        status = self._get_status_array(node)
+        if status is None or status[blk_idx] == UKAI_NO_LOCATION:
+            raise KeyError(node)
+        return (status[blk_idx])
+
+    def set_sync_status(self, blk_idx, node, sync_status):
+        '''
+        Sets the sync status of the node of the specified block.  The
+        node must be a location of the block.
+
+        blk_idx: The index of a block.
+        node: The address of a node.
+        sync_status: A new sync status.
+
+        Return values: True if the status has been changed, False
+            otherwise.
+        '''
+        status = self._get_status_array(node)
+        if status is None or status[blk_idx] == UKAI_NO_LOCATION:
+            raise KeyError(node)
+        if status[blk_idx] == sync_status:
+            return (False)
+        status[blk_idx] = sync_status
+        return (True)
+
+    def add_location(self, node, start_idx, end_idx, sync_status):
+        '''
+        Adds the node as a location of the specified range of blocks.
+        The blocks which already have the node are not changed.
+
+        node: The address of a node.
+        start_idx: The first block index.
+        end_idx: The last block index.
+        sync_status: The initial sync status.
+
+        Return values: True if any block has been changed, False
+            otherwise.
+        '''
+        status = self._get_status_array(node, True)
+        current = status[start_idx:end_idx + 1]
+        if current.count(chr(UKAI_NO_LOCATION)) == 0:
+            return (False)
+        status[start_idx:end_idx + 1] = current.translate(
+            _ukai_translation_table({UKAI_NO_LOCATION: sync_status}))
+        return (True)
+
+    def remove_location(self, node, start_idx, end_idx):
+        '''
+        Removes the node from the locations of the specified range of
+        blocks.  The node is not removed from the blocks which don't
+        have any other in-sync location.
+
+        node: The address of a node.
+        start_idx: The first block index.
+        end_idx: The last block index.
+
+        Return values: A (changed, kept_blocks) tupple, where changed
+            is True if any block has been changed, and kept_blocks is
+            a list of block indices from which the node was not
+            removed.
+        '''
+        status = self._get_status_array(node)
+        if status is None:
+            return ((False, []))
+        other_in_sync = self.in_sync_flags(start_idx, end_idx, exclude=node)
+        current = status[start_idx:end_idx + 1]
+        if other_in_sync.count('\x00') == 0:
+            # every block has another in-sync location.
+            status[start_idx:end_idx + 1] = (chr(UKAI_NO_LOCATION)
+                                             * len(current))
+            return ((current.count(chr(UKAI_NO_LOCATION)) != len(current),
+                     []))
+        changed = False
+        kept_blocks = []
+        for offset in range(0, len(current)):
+            if current[offset] == UKAI_NO_LOCATION:
+                continue
+            if other_in_sync[offset] == 0:
+                kept_blocks.append(start_idx + offset)
+                continue
+            status[start_idx + offset] = UKAI_NO_LOCATION
+            changed = True
+        return ((changed, kept_blocks))
+
+    def in_sync_flags(self, start_idx, end_idx, exclude=None):
+        '''
+        Returns a byte array which has one entry per block of the
+        specified range.  An entry is 1 if the block has at least one
+        in-sync location, and 0 otherwise.
+
+        start_idx: The first block index.
+        end_idx: The last block index.
+        exclude: The address of a node which is not counted.
+        '''
+        flags = bytearray(end_idx - start_idx + 1)
+        for node_idx in range(0, len(self._nodes)):
+            if self._nodes[node_idx] == exclude:
+                continue
+            node_flags = self._status[node_idx][start_idx:end_idx + 1]
+            flags = _ukai_or_flags(flags,
+                                   node_flags.translate(_UKAI_IN_SYNC_FLAGS))
+        return (flags)
+
+    def changed_blocks(self, other):
+        '''
+        Returns a list of block indices whose locations or sync status
+        differ from the other table.
+
+        other: An UKAIBlockStatusTable instance.
+        '''
+        if self._num_blocks != other._num_blocks:
+            return (range(0, max(self._num_blocks, other._num_blocks)))
+        changed = set()
+        absent = bytearray(chr(UKAI_NO_LOCATION) * self._num_blocks)
+        for node in set(self._nodes) | set(other._nodes):
+            status = self._get_status_array(node)
+            if status is None:
+                status = absent
+            other_status = other._get_status_array(node)
+            if other_status is None:
+                other_status = absent
+            if status == other_status:
+                continue
+            for blk_idx in range(0, self._num_blocks):
+                if status[blk_idx] != other_status[blk_idx]:
+                    changed.add(blk_idx)
+        return (sorted(changed))
+
+    def _get_status_array(self, node, create=False):
+        if node in self._node_index:
+            return (self._status[self._node_index[node]])
+        if create is False:
+            return (None)
+        self._node_index[node] = len(self._nodes)
+        self._nodes.append(node)
+        self._status.append(bytearray(chr(UKAI_NO_LOCATION)
+                                      * self._num_blocks))
+        return (self._status[-1])
+
+if __name__ == '__main__':
+    import time
+
+    num_blocks = 100000
+    blocks = [{'192.168.100.1': {'sync_status': UKAI_BLOCK_STATUS_IN_SYNC}}
+              for blk_idx in range(0, num_blocks)]
+    table = UKAIBlockStatusTable.from_json(blocks)
+
+    start_time = time.time()
+    table.add_location('192.168.100.2', 0, num_blocks - 1, 2)
+    print 'add_location: %f sec' % (time.time() - start_time)
+    start_time = time.time()
+    flags = table.in_sync_flags(0, num_blocks - 1, exclude='192.168.100.2')
+    print 'in_sync_flags: %f sec' % (time.time() - start_time)
+    start_time = time.time()
+    print table.remove_location('192.168.100.2', 0, num_blocks - 1)
+    print 'remove_location: %f sec' % (time.time() - start_time)
+    assert table.to_json() == blocks
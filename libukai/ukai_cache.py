@@ -0,0 +1,502 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_cache.py module provides an in-memory cache and an on-disk
+cache of block data read from remote storage nodes.
+'''
+
+import collections
+import os
+import shutil
+import threading
+
+class UKAIBlockCache(object):
+    '''
+    The UKAIBlockCache class keeps extents of block data in memory.
+    An extent is a contiguous piece of data in a block, identified by
+    a block index and an offset in the block.  When the total size of
+    the cached extents exceeds the capacity, the least recently used
+    extents are evicted.
+    '''
+    def __init__(self, capacity):
+        '''
+        Initializes an empty cache.
+
+        capacity: The maximum number of bytes kept in the cache.
+
+        Return values: This function does not return any values.
+        '''
+        self._capacity = capacity
+        self._size = 0
+        # (block index, offset) => data, ordered from the least
+        # recently used extent.
+        self._extents = collections.OrderedDict()
+        # block index => a set of offsets of the cached extents.
+        self._block_extents = {}
+        # block index => the number of modifications of the block.
+        self._generations = {}
+        # the number of invalidations of the entire cache.
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        '''
+        The maximum number of bytes kept in the cache.
+        '''
+        return (self._capacity)
+
+    @property
+    def size(self):
+        '''
+        The total number of bytes currently cached.
+        '''
+        return (self._size)
+
+    def get(self, blk_idx, off_in_blk, size_in_blk):
+        '''
+        Returns the cached data of the specified range, or None if
+        the range is not fully covered by one of the cached extents.
+
+        blk_idx: the block index of the disk image.
+        off_in_blk: the offset relative to the beginning of the
+            specified block.
+        size_in_blk: the length of the data.
+        '''
+        try:
+            self._lock.acquire()
+            if blk_idx not in self._block_extents:
+                return (None)
+            for off in self._block_extents[blk_idx]:
+                key = (blk_idx, off)
+                data = self._extents[key]
+                if off > off_in_blk:
+                    continue
+                if off + len(data) < off_in_blk + size_in_blk:
+                    continue
+                # mark the extent as the most recently used one.
+                del self._extents[key]
+                self._extents[key] = data
+                return (data[off_in_blk - off:
+                             off_in_blk - off + size_in_blk])
+            return (None)
+        finally:
+            self._lock.release()
+
+    def generation(self, blk_idx):
+        '''
+        Returns the generation of the specified block.  The generation
+        changes every time the cached data of the block is modified or
+        invalidated.
+
+        blk_idx: the block index of the disk image.
+        '''
+        try:
+            self._lock.acquire()
+            return ((self._epoch, self._generations.get(blk_idx, 0)))
+        finally:
+            self._lock.release()
+
+    def put(self, blk_idx, off_in_blk, data, generation=None):
+        '''
+        Inserts an extent to the cache.  If the cache is full, the
+        least recently used extents are evicted.
+
+        blk_idx: the block index of the disk image.
+        off_in_blk: the offset relative to the beginning of the
+            specified block.
+        data: the data of the extent.
+        generation: the generation of the block returned by
+            the generation() method before reading the data.  If
+            specified and the block has been modified since then, the
+            data is discarded.
+
+        Return values: This function does not return any values.
+        '''
+        if len(data) > self._capacity:
+            return
+        try:
+            self._lock.acquire()
+            if (generation is not None
+                and generation != (self._epoch,
+                                   self._generations.get(blk_idx, 0))):
+                # the data may be stale.
+                return
+            key = (blk_idx, off_in_blk)
+            if key in self._extents:
+                self._remove(key)
+            self._extents[key] = data
+            if blk_idx not in self._block_extents:
+                self._block_extents[blk_idx] = set()
+            self._block_extents[blk_idx].add(off_in_blk)
+            self._size += len(data)
+            while self._size > self._capacity:
+                self._remove(next(iter(self._extents)))
+        finally:
+            self._lock.release()
+
+    def update(self, blk_idx, off_in_blk, data):
+        '''
+        Overwrites the cached extents overlapping with the written
+        data, so that the cache doesn't keep stale data.
+
+        blk_idx: the block index of the disk image.
+        off_in_blk: the offset relative to the beginning of the
+            specified block.
+        data: the written data.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            self._generations[blk_idx] = self._generations.get(blk_idx, 0) + 1
+            if blk_idx not in self._block_extents:
+                return
+            for off in self._block_extents[blk_idx]:
+                key = (blk_idx, off)
+                extent = self._extents[key]
+                start = max(off, off_in_blk)
+                end = min(off + len(extent), off_in_blk + len(data))
+                if start >= end:
+                    continue
+                self._extents[key] = (extent[:start - off]
+                                      + data[start - off_in_blk:
+                                             end - off_in_blk]
+                                      + extent[end - off:])
+        finally:
+            self._lock.release()
+
+    def invalidate(self, blk_idx):
+        '''
+        Removes all the cached extents of the specified block.
+
+        blk_idx: the block index of the disk image.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            self._generations[blk_idx] = self._generations.get(blk_idx, 0) + 1
+            if blk_idx not in self._block_extents:
+                return
+            for off in list(self._block_extents[blk_idx]):
+                self._remove((blk_idx, off))
+        finally:
+            self._lock.release()
+
+    def invalidate_all(self):
+        '''
+        Removes all the cached extents.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            self._epoch += 1
+            self._extents.clear()
+            self._block_extents.clear()
+            self._size = 0
+        finally:
+            self._lock.release()
+
+    def _remove(self, key):
+        (blk_idx, off) = key
+        data = self._extents.pop(key)
+        self._size -= len(data)
+        self._block_extents[blk_idx].discard(off)
+        if len(self._block_extents[blk_idx]) == 0:
+            del self._block_extents[blk_idx]
+
+class UKAIDiskCache(object):
+    '''
+    The UKAIDiskCache class keeps extents of block data read from
+    remote storage nodes in files under the cache_root directory.
+    The files are kept across restarts of the UKAI server.  Each file
+    records the write generation of the disk image and the node from
+    which the data was read, and the data is served only in the same
+    generation while the node is in-sync for the block.
+
+    The file layout is as follows.
+
+    CACHE_ROOT/IMAGE_NAME/BLOCK_INDEX_OFFSET_SIZE_GENERATION_NODE
+    '''
+    def __init__(self):
+        '''
+        Initializes a disabled cache.  Call the load() method to
+        enable the cache.
+
+        Return values: This function does not return any values.
+        '''
+        self._cache_root = None
+        self._capacity = 0
+        self._size = 0
+        # path => size, ordered from the least recently used file.
+        self._files = collections.OrderedDict()
+        # image name => block index => a list of
+        # (offset, size, generation, node, path) tupples.
+        self._index = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        '''
+        True if the cache is enabled.
+        '''
+        return (self._cache_root is not None and self._capacity > 0)
+
+    def load(self, config):
+        '''
+        Enables the cache if the cache_root and cache_size parameters
+        are configured, and loads the files cached before.
+
+        config: an UKAIConfig instance.
+
+        Return values: This function does not return any values.
+        '''
+        if config.get('cache_root') is None:
+            return
+        if config.get('cache_size') is None:
+            return
+        self._cache_root = config.get('cache_root')
+        self._capacity = config.get('cache_size')
+        if not os.path.exists(self._cache_root):
+            os.makedirs(self._cache_root)
+
+        entries = []
+        for image_name in os.listdir(self._cache_root):
+            image_path = '%s/%s' % (self._cache_root, image_name)
+            if not os.path.isdir(image_path):
+                continue
+            for file_name in os.listdir(image_path):
+                path = '%s/%s' % (image_path, file_name)
+                entry = self._parse_file_name(file_name)
+                if entry is None:
+                    # garbage, or a temporary file.
+                    os.unlink(path)
+                    continue
+                (blk_idx, off, size, generation, node) = entry
+                if os.path.getsize(path) != size:
+                    os.unlink(path)
+                    continue
+                entries.append((os.path.getmtime(path), image_name,
+                                blk_idx, off, size, generation, node, path))
+        try:
+            self._lock.acquire()
+            for (mtime, image_name, blk_idx, off, size, generation, node,
+                 path) in sorted(entries):
+                self._add_entry(image_name, blk_idx, off, size, generation,
+                                node, path)
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def get(self, image_name, blk_idx, off_in_blk, size_in_blk, generation,
+            is_valid):
+        '''
+        Returns the cached data of the specified range, or None if
+        the range is not cached.  The entries of other write
+        generations, and the ones whose node is reported invalid by
+        the is_valid function are removed.
+
+        image_name: the name of a virtual disk image.
+        blk_idx: the block index of the disk image.
+        off_in_blk: the offset relative to the beginning of the
+            specified block.
+        size_in_blk: the length of the data.
+        generation: the current write generation of the disk image.
+        is_valid: a function which receives a node address and
+            returns True if the data read from the node is valid.
+        '''
+        path = None
+        try:
+            self._lock.acquire()
+            if image_name not in self._index:
+                return (None)
+            if blk_idx not in self._index[image_name]:
+                return (None)
+            for (off, size, entry_generation, node, entry_path) in list(
+                self._index[image_name][blk_idx]):
+                if (entry_generation != generation
+                    or is_valid(node) is False):
+                    self._remove_entry(entry_path)
+                    continue
+                if off > off_in_blk:
+                    continue
+                if off + size < off_in_blk + size_in_blk:
+                    continue
+                path = entry_path
+                offset = off_in_blk - off
+                # mark the file as the most recently used one.
+                self._files[path] = self._files.pop(path)
+                break
+        finally:
+            self._lock.release()
+
+        if path is None:
+            return (None)
+        try:
+            fh = open(path, 'r')
+            fh.seek(offset)
+            data = fh.read(size_in_blk)
+            fh.close()
+            os.utime(path, None)
+        except (IOError, OSError):
+            # the file may be evicted by another thread.
+            return (None)
+        if len(data) != size_in_blk:
+            return (None)
+        return (data)
+
+    def put(self, image_name, blk_idx, off_in_blk, data, generation, node):
+        '''
+        Stores an extent read from the specified node to the cache.
+
+        image_name: the name of a virtual disk image.
+        blk_idx: the block index of the disk image.
+        off_in_blk: the offset relative to the beginning of the
+            specified block.
+        data: the data of the extent.
+        generation: the write generation of the disk image in which
+            the data was read.
+        node: the node from which the data was read.
+
+        Return values: This function does not return any values.
+        '''
+        if len(data) > self._capacity:
+            return
+        image_path = '%s/%s' % (self._cache_root, image_name)
+        path = '%s/%d_%d_%d_%d_%s' % (image_path, blk_idx, off_in_blk,
+                                      len(data), generation, node)
+        try:
+            if not os.path.exists(image_path):
+                os.makedirs(image_path)
+            # write to a temporary file and rename it, so that a
+            # partially written file is never served.
+            fh = open(path + '.tmp', 'w')
+            fh.write(data)
+            fh.close()
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            print e.__class__
+            return
+        try:
+            self._lock.acquire()
+            if path in self._files:
+                self._remove_entry(path, False)
+            self._add_entry(image_name, blk_idx, off_in_blk, len(data),
+                            generation, node, path)
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def invalidate(self, image_name, blk_idx):
+        '''
+        Removes all the cached extents of the specified block.
+
+        image_name: the name of a virtual disk image.
+        blk_idx: the block index of the disk image.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            if image_name not in self._index:
+                return
+            if blk_idx not in self._index[image_name]:
+                return
+            for entry in list(self._index[image_name][blk_idx]):
+                self._remove_entry(entry[4])
+        finally:
+            self._lock.release()
+
+    def invalidate_image(self, image_name):
+        '''
+        Removes all the cached extents of the specified disk image.
+
+        image_name: the name of a virtual disk image.
+
+        Return values: This function does not return any values.
+        '''
+        if not self.enabled:
+            return
+        try:
+            self._lock.acquire()
+            if image_name in self._index:
+                for blk_idx in self._index[image_name].keys():
+                    for entry in self._index[image_name][blk_idx]:
+                        self._size -= self._files.pop(entry[4])
+                del self._index[image_name]
+            image_path = '%s/%s' % (self._cache_root, image_name)
+            if os.path.exists(image_path):
+                shutil.rmtree(image_path)
+        finally:
+            self._lock.release()
+
+    def _parse_file_name(self, file_name):
+        params = file_name.split('_', 4)
+        if len(params) != 5:
+            return (None)
+        try:
+            return (int(params[0]), int(params[1]), int(params[2]),
+                    int(params[3]), params[4])
+        except ValueError:
+            return (None)
+
+    def _add_entry(self, image_name, blk_idx, off, size, generation, node,
+                   path):
+        if image_name not in self._index:
+            self._index[image_name] = {}
+        if blk_idx not in self._index[image_name]:
+            self._index[image_name][blk_idx] = []
+        self._index[image_name][blk_idx].append((off, size, generation, node,
+                                                 path))
+        self._files[path] = size
+        self._size += size
+
+    def _remove_entry(self, path, unlink=True):
+        file_name = os.path.basename(path)
+        image_name = os.path.basename(os.path.dirname(path))
+        (blk_idx, off, size, generation,
+         node) = self._parse_file_name(file_name)
+        self._index[image_name][blk_idx].remove((off, size, generation, node,
+                                                 path))
+        if len(self._index[image_name][blk_idx]) == 0:
+            del self._index[image_name][blk_idx]
+        self._size -= self._files.pop(path)
+        if unlink is True:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._size > self._capacity:
+            self._remove_entry(next(iter(self._files)))
+
+ukai_disk_cache = UKAIDiskCache()
@@ -0,0 +1,328 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_compression.py module provides the compression of block
+data transferred between nodes, and the compression policy of each
+link to a remote node.
+
+The compression of each transfer is described by an encoding name,
+which is sent with the data so that the receiver decodes it.
+
+    none: not compressed
+    zlib: compressed by zlib at the default level
+    zlib:LEVEL: compressed by zlib at the level (1-9)
+
+The policy of a link is one of the following.
+
+    off: no compression
+    zlib[:LEVEL]: always compressed by zlib
+    adaptive[:LEVEL]: compressed by zlib while the data is
+        compressible.  When the average compression ratio exceeds
+        UKAI_COMPRESSION_ADAPTIVE_THRESHOLD, the data is sent
+        uncompressed, and one in UKAI_COMPRESSION_ADAPTIVE_PROBE_INTERVAL
+        transfers is compressed to sample the ratio again.
+'''
+
+import threading
+import zlib
+
+UKAI_COMPRESSION_NONE = 'none'
+UKAI_COMPRESSION_ZLIB = 'zlib'
+
+UKAI_COMPRESSION_POLICY_OFF = 'off'
+UKAI_COMPRESSION_POLICY_ZLIB = 'zlib'
+UKAI_COMPRESSION_POLICY_ADAPTIVE = 'adaptive'
+
+# The policy used when not configured, which is compatible with the
+# nodes which always compress data by zlib at the default level.
+UKAI_COMPRESSION_POLICY_DEFAULT = UKAI_COMPRESSION_POLICY_ZLIB
+
+# The level of zlib.compress() when no level is specified.
+UKAI_COMPRESSION_DEFAULT_LEVEL = 6
+
+# The compression ratio (compressed size / original size) above
+# which the adaptive policy stops compressing.
+UKAI_COMPRESSION_ADAPTIVE_THRESHOLD = 0.9
+
+# The number of uncompressed transfers after which the adaptive
+# policy compresses a transfer to sample the ratio again.
+UKAI_COMPRESSION_ADAPTIVE_PROBE_INTERVAL = 64
+
+# The weight of a new sample in the exponentially weighted moving
+# average of the compression ratio.
+UKAI_COMPRESSION_EWMA_WEIGHT = 0.2
+
+def ukai_compression_encoding(level):
+    '''
+    Returns the encoding name of zlib at the level.
+    '''
+    if level == UKAI_COMPRESSION_DEFAULT_LEVEL:
+        return (UKAI_COMPRESSION_ZLIB)
+    return ('%s:%d' % (UKAI_COMPRESSION_ZLIB, level))
+
+def ukai_compression_level(encoding):
+    '''
+    Returns the zlib level of the encoding, or None if the encoding
+    is not compressed.
+
+    Exceptions: ValueError is raised if the encoding is unknown.
+    '''
+    (name, sep, level) = encoding.partition(':')
+    if name == UKAI_COMPRESSION_NONE:
+        return (None)
+    if name != UKAI_COMPRESSION_ZLIB:
+        raise ValueError('Unknown encoding: %s' % encoding)
+    if len(level) == 0:
+        return (UKAI_COMPRESSION_DEFAULT_LEVEL)
+    return (int(level))
+
+def ukai_encode(data, encoding):
+    '''
+    Returns the data compressed as specified by the encoding.
+    '''
+    level = ukai_compression_level(encoding)
+    if level is None:
+        return (data)
+    return (zlib.compress(data, level))
+
+def ukai_decode(data, encoding):
+    '''
+    Returns the original data of the data encoded by the encoding.
+    '''
+    if ukai_compression_level(encoding) is None:
+        return (data)
+    return (zlib.decompress(data))
+
+class UKAINodeCompression(object):
+    '''
+    The UKAINodeCompression class chooses the encoding of the data
+    transferred to and from a remote node according to the policy of
+    the link, and keeps the number of bytes before and after
+    compression.
+    '''
+    def __init__(self, address, policy=None):
+        '''
+        Initializes an instance with the policy of the link.
+
+        address: The IP address of the node.
+        policy: A policy name optionally followed by a colon and a
+            zlib level.  If None, UKAI_COMPRESSION_POLICY_DEFAULT is
+            used.
+
+        Exceptions: ValueError is raised if the policy is unknown.
+        '''
+        if policy is None:
+            policy = UKAI_COMPRESSION_POLICY_DEFAULT
+        (mode, sep, level) = policy.partition(':')
+        if mode not in (UKAI_COMPRESSION_POLICY_OFF,
+                        UKAI_COMPRESSION_POLICY_ZLIB,
+                        UKAI_COMPRESSION_POLICY_ADAPTIVE):
+            raise ValueError('Unknown compression policy: %s' % policy)
+        self._address = address
+        self._policy = policy
+        self._mode = mode
+        self._level = UKAI_COMPRESSION_DEFAULT_LEVEL
+        if len(level) > 0:
+            self._level = int(level)
+        self._lock = threading.Lock()
+        self._ratio = None
+        self._skipped = 0
+        self._raw_bytes = 0
+        self._wire_bytes = 0
+        self._compressed = 0
+        self._uncompressed = 0
+        self._zero_extents = 0
+
+    def encoding(self):
+        '''
+        Returns the encoding of the next transfer.
+        '''
+        if self._mode == UKAI_COMPRESSION_POLICY_OFF:
+            return (UKAI_COMPRESSION_NONE)
+        if self._mode == UKAI_COMPRESSION_POLICY_ADAPTIVE:
+            try:
+                self._lock.acquire()
+                incompressible = (
+                    self._ratio is not None
+                    and self._ratio > UKAI_COMPRESSION_ADAPTIVE_THRESHOLD)
+                if (incompressible
+                    and self._skipped
+                    < UKAI_COMPRESSION_ADAPTIVE_PROBE_INTERVAL):
+                    self._skipped += 1
+                    return (UKAI_COMPRESSION_NONE)
+                self._skipped = 0
+            finally:
+                self._lock.release()
+        return (ukai_compression_encoding(self._level))
+
+    def encode(self, data, encoding=None):
+        '''
+        Encodes the data to be sent to the node.
+
+        data: The data to be sent.
+        encoding: The encoding to be used.  If None, the encoding
+            returned by the encoding() method is used.
+
+        Return values: An (encoding, encoded data) tupple.
+        '''
+        if encoding is None:
+            encoding = self.encoding()
+        encoded_data = ukai_encode(data, encoding)
+        self._record(encoding, len(data), len(encoded_data))
+        return ((encoding, encoded_data))
+
+    def decode(self, encoding, encoded_data):
+        '''
+        Decodes the data received from the node.
+
+        Return values: The original data.
+        '''
+        data = ukai_decode(encoded_data, encoding)
+        self._record(encoding, len(data), len(encoded_data))
+        return (data)
+
+    def zero_extent(self, size):
+        '''
+        Records a piece of all-zero data transferred as a zero extent
+        without the payload.
+
+        size: The size of the piece.
+        '''
+        try:
+            self._lock.acquire()
+            self._raw_bytes += size
+            self._zero_extents += 1
+        finally:
+            self._lock.release()
+
+    def _record(self, encoding, raw_size, wire_size):
+        try:
+            self._lock.acquire()
+            self._raw_bytes += raw_size
+            self._wire_bytes += wire_size
+            if encoding == UKAI_COMPRESSION_NONE:
+                self._uncompressed += 1
+                return
+            self._compressed += 1
+            if raw_size == 0:
+                return
+            ratio = float(wire_size) / raw_size
+            if self._ratio is None:
+                self._ratio = ratio
+            else:
+                self._ratio = (self._ratio
+                               * (1 - UKAI_COMPRESSION_EWMA_WEIGHT)
+                               + ratio * UKAI_COMPRESSION_EWMA_WEIGHT)
+        finally:
+            self._lock.release()
+
+    def get(self):
+        '''
+        Returns the statistics of the link in the format described
+        in the UKAINodeCompressionSet.get_list() method.
+        '''
+        try:
+            self._lock.acquire()
+            return ({'address': self._address,
+                     'policy': self._policy,
+                     'raw_bytes': self._raw_bytes,
+                     'wire_bytes': self._wire_bytes,
+                     'compressed': self._compressed,
+                     'uncompressed': self._uncompressed,
+                     'zero_extents': self._zero_extents,
+                     'ratio': self._ratio})
+        finally:
+            self._lock.release()
+
+class UKAINodeCompressionSet(object):
+    '''
+    The UKAINodeCompressionSet class keeps an UKAINodeCompression
+    instance of each remote node.  The policy of a link is taken from
+    the wire_compression_links parameter of the config, or the
+    wire_compression parameter if the node is not listed.
+    '''
+    def __init__(self, config):
+        '''
+        config: an UKAIConfig instance.
+
+        Exceptions: ValueError is raised if a policy is unknown.
+        '''
+        self._default_policy = config.get('wire_compression')
+        if self._default_policy is None:
+            self._default_policy = UKAI_COMPRESSION_POLICY_DEFAULT
+        self._link_policies = config.get('wire_compression_links')
+        if self._link_policies is None:
+            self._link_policies = {}
+        for policy in [self._default_policy] + self._link_policies.values():
+            # validates the configured policies.
+            UKAINodeCompression(None, policy)
+        self._set = {}
+        self._lock = threading.Lock()
+
+    def get(self, address):
+        '''
+        Returns the UKAINodeCompression instance of the node.
+        '''
+        try:
+            self._lock.acquire()
+            if address not in self._set:
+                policy = self._link_policies.get(address,
+                                                 self._default_policy)
+                self._set[address] = UKAINodeCompression(address, policy)
+            return (self._set[address])
+        finally:
+            self._lock.release()
+
+    def get_list(self):
+        '''
+        Returns a list of the statistics of each link.
+
+        Return values: A list object of a dictionary object of
+        following format.
+
+            {
+                'address': NODE_ADDRESS,
+                'policy': POLICY,
+                'raw_bytes': BYTES_BEFORE_COMPRESSION,
+                'wire_bytes': BYTES_AFTER_COMPRESSION,
+                'compressed': NUMBER_OF_COMPRESSED_TRANSFERS,
+                'uncompressed': NUMBER_OF_UNCOMPRESSED_TRANSFERS,
+                'zero_extents': NUMBER_OF_ZERO_EXTENTS,
+                'ratio': AVERAGE_COMPRESSION_RATIO
+            }
+
+        AVERAGE_COMPRESSION_RATIO is the exponentially weighted
+        moving average of the ratio of compressed transfers, or None
+        if no transfer is compressed.
+        '''
+        try:
+            self._lock.acquire()
+            return ([compression.get() for compression in self._set.values()])
+        finally:
+            self._lock.release()
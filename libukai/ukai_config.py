@@ -30,11 +30,41 @@
 The ukai_config.py module defines the global parameters of the
 UKAI system.
 
-metadata_servers: the location of the backend metadata servers
+metadata_servers: the list of the backend metadata servers.  The
+    metadata of disk images is distributed to the servers by
+    consistent hashing
 data_root: the location of the backend image storage space
 blockname_format: the filename format of each block data file
 core_server: the IP address of the UKAICore service
 core_port: the port number of the UKAICore service
+data_port: the port number of the binary protocol service to
+    transfer block data
+io_workers: the number of worker threads to access storage nodes in
+    parallel
+block_cache_size: the maximum bytes of remote block data cached in
+    memory per disk image
+cache_root: the location of the on-disk cache of remote block data
+cache_size: the maximum bytes of the on-disk cache
+readahead_min: the initial readahead window of sequential reads
+readahead_max: the maximum readahead window of sequential reads
+latency_probe_ratio: the ratio of reads sent to a random node to
+    measure its latency
+hedged_read_percentile: the percentile of the round trip time after
+    which a read is sent to another node
+metadata_flush_interval: the interval in seconds to write out
+    metadata modified by I/O operations
+metadata_format: the format of metadata stored in the metadata
+    servers ('binary' or 'json')
+metadata_segment_size: the number of blocks of each segment of
+    metadata stored in the metadata servers
+rpc_pool_size: the maximum number of idle connections kept per
+    remote node
+rpc_idle_timeout: the time in seconds after which an idle connection
+    to a remote node is closed
+wire_compression: the compression policy of block data sent to
+    remote nodes ('off', 'zlib[:LEVEL]' or 'adaptive[:LEVEL]')
+wire_compression_links: a dictionary of the compression policy of
+    each remote node overriding wire_compression
 '''
 
 import json
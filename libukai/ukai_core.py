@@ -38,6 +38,10 @@ import sys
 import threading
 import zlib
 
+from ukai_binary_rpc import ukai_binary_rpc_connection_pool
+from ukai_cache import ukai_disk_cache
+from ukai_compression import UKAINodeCompressionSet
+from ukai_compression import UKAI_COMPRESSION_ZLIB, ukai_encode, ukai_decode
 from ukai_config import UKAIConfig
 from ukai_data import UKAIData
 from ukai_data import ukai_data_destroy, ukai_data_location_destroy
@@ -47,13 +51,69 @@ from ukai_local_io import ukai_local_allocate_dataspace
 from ukai_local_io import ukai_local_destroy_image
 from ukai_metadata import UKAIMetadata, UKAI_OUT_OF_SYNC
 from ukai_metadata import ukai_metadata_create, ukai_metadata_destroy
+from ukai_metadata_codec import ukai_metadata_to_json
 from ukai_node_error_state import UKAINodeErrorStateSet
-from ukai_rpc import UKAIXMLRPCTranslation
+from ukai_node_latency import UKAINodeLatencySet
+from ukai_rpc import UKAIXMLRPCTranslation, ukai_rpc_connection_pool
 from ukai_statistics import UKAIStatistics, UKAIImageStatistics
+from ukai_thread_pool import ukai_thread_pool
 
 # XXX Fix this
 lock = threading.Lock()
 
+class UKAIMetadataCache(object):
+    ''' The UKAIMetadataCache class keeps the metadata of disk images
+    read from the metadata servers.  The cached metadata is discarded
+    when the metadata servers notify the modification of it.
+    '''
+    def __init__(self):
+        self._metadata = {}
+        self._lock = threading.Lock()
+        # Incremented on every invalidation, so that the metadata
+        # read before an invalidation is not cached.
+        self._generation = 0
+
+    def get(self, image_name):
+        ''' Returns the raw metadata of the disk image.  The returned
+        object must not be modified.
+
+        param image_name: the name of a disk image
+        '''
+        try:
+            self._lock.acquire()
+            if image_name in self._metadata:
+                return self._metadata[image_name]
+            generation = self._generation
+        finally:
+            self._lock.release()
+
+        metadata = ukai_db_client.get_metadata(image_name)
+        if metadata is None:
+            return None
+        try:
+            self._lock.acquire()
+            if generation == self._generation:
+                self._metadata[image_name] = metadata
+        finally:
+            self._lock.release()
+        return metadata
+
+    def invalidate(self, image_name):
+        ''' Discards the cached metadata of the disk image.
+
+        param image_name: the name of a disk image, or None to
+            discard the metadata of all the disk images
+        '''
+        try:
+            self._lock.acquire()
+            self._generation += 1
+            if image_name is None:
+                self._metadata = {}
+            elif image_name in self._metadata:
+                del self._metadata[image_name]
+        finally:
+            self._lock.release()
+
 class UKAIWriters(object):
     def __init__(self):
         self._images = {}
@@ -72,6 +132,11 @@ class UKAIWriters(object):
             del self._images[image_name]
         return 0
 
+    def is_writer(self, image_name, fh):
+        if image_name not in self._images:
+            return False
+        return self._images[image_name] == fh
+
 class UKAIOpenImageCount(object):
     def __init__(self):
         self._images = {}
@@ -103,11 +168,20 @@ class UKAICore(object):
         self._data_dict = {}
         self._config = config
         self._node_error_state_set = UKAINodeErrorStateSet()
+        self._node_latency_set = UKAINodeLatencySet(
+            self._config.get('latency_probe_ratio'))
+        self._node_compression_set = UKAINodeCompressionSet(self._config)
         self._rpc_trans = UKAIXMLRPCTranslation()
         self._writers = UKAIWriters()
         self._open_count = UKAIOpenImageCount()
         self._fh = 0
+        self._metadata_cache = UKAIMetadataCache()
         ukai_db_client.connect(self._config)
+        ukai_db_client.watch_metadata(self._metadata_cache.invalidate)
+        ukai_thread_pool.start(self._config)
+        ukai_disk_cache.load(self._config)
+        ukai_rpc_connection_pool.configure(self._config)
+        ukai_binary_rpc_connection_pool.configure(self._config)
 
     ''' Filesystem I/O processing.
     '''
@@ -119,7 +193,7 @@ class UKAICore(object):
                       st_mtime=0, st_atime=0, st_nlink=2)
         else:
             image_name = path[1:]
-            metadata = self._get_metadata(image_name)
+            metadata = self._get_cached_metadata(image_name)
             if metadata is not None:
                 st = dict(st_mode=(stat.S_IFREG | 0644), st_ctime=0,
                           st_mtime=0, st_atime=0, st_nlink=1,
@@ -133,15 +207,23 @@ class UKAICore(object):
           lock.acquire()
           ret = 0
           image_name = path[1:]
-          metadata = self._get_metadata(image_name)
+          metadata = self._get_cached_metadata(image_name)
           if metadata is None:
               return errno.ENOENT, None
           self._fh += 1
           if (flags & 3) != os.O_RDONLY:
               if self._writers.add_writer(image_name, self._fh) == errno.EBUSY:
                   return errno.EBUSY, None
+              ukai_db_client.join_writer(image_name, self._config.get('id'))
           if self._open_count.increment(image_name) == 1:
               self._add_image(image_name)
+          if (flags & 3) != os.O_RDONLY:
+              # the data cached by the other nodes is invalidated
+              # by the new write generation.
+              metadata = self._metadata_dict[image_name]
+              if metadata.set_writer(self._config.get('id')) is True:
+                  ukai_disk_cache.invalidate_image(image_name)
+                  metadata.flush()
           return 0, self._fh
       finally:
           lock.release()
@@ -150,6 +232,11 @@ class UKAICore(object):
       try:
           lock.acquire()
           image_name = path[1:]
+          if self._exists(image_name):
+              self._metadata_dict[image_name].sync()
+          if self._writers.is_writer(image_name, fh):
+              ukai_db_client.leave_writer(image_name,
+                                          self._config.get('id'))
           self._writers.remove_writer(image_name, fh)
           if self._open_count.decrement(image_name) == 0:
               self._remove_image(image_name)
@@ -167,6 +254,13 @@ class UKAICore(object):
         data = image_data.read(size, offset)
         return 0, self._rpc_trans.encode(data)
 
+    def fsync(self, path):
+        image_name = path[1:]
+        if not self._exists(image_name):
+            return errno.ENOENT
+        self._metadata_dict[image_name].sync()
+        return 0
+
     def readdir(self, path):
         return ['.', '..'] + self._metadata_dict.keys()
 
@@ -202,19 +296,29 @@ class UKAICore(object):
     def _get_metadata(self, image_name):
         return ukai_db_client.get_metadata(image_name)
 
+    def _get_cached_metadata(self, image_name):
+        # The returned metadata is shared, and must not be passed to
+        # the UKAIMetadata class which modifies it.
+        return self._metadata_cache.get(image_name)
+
     def _add_image(self, image_name):
         assert image_name not in self._metadata_dict
         metadata = UKAIMetadata(image_name, self._config)
         ukai_db_client.join_reader(image_name, self._config.get('id'))
+        ukai_db_client.subscribe_metadata_updates(
+            image_name, self._metadata_update_received)
         self._metadata_dict[image_name] = metadata
         data = UKAIData(metadata=metadata,
                         node_error_state_set=self._node_error_state_set,
-                        config=self._config)
+                        node_latency_set=self._node_latency_set,
+                        config=self._config,
+                        node_compression_set=self._node_compression_set)
         self._data_dict[image_name] = data
         UKAIStatistics[image_name] = UKAIImageStatistics()
 
     def _remove_image(self, image_name):
         assert image_name in self._metadata_dict
+        ukai_db_client.unsubscribe_metadata_updates(image_name)
         ukai_db_client.leave_reader(image_name, self._config.get('id'))
         del self._metadata_dict[image_name]
         del self._data_dict[image_name]
@@ -228,27 +332,71 @@ class UKAICore(object):
         return True
 
 
-    ''' Proxy server processing.
+    ''' Proxy server processing.  The encoding argument of the
+    proxy_read*/proxy_write* methods is the compression encoding of
+    the block data (see the ukai_compression.py module).  It is
+    omitted by the nodes which always use zlib at the default level.
     '''
     def proxy_read(self, image_name, str_block_size, str_block_index,
-                   str_offset, str_size):
+                   str_offset, str_size, encoding=UKAI_COMPRESSION_ZLIB):
         block_size = int(str_block_size)
         block_index = int(str_block_index)
         offset = int(str_offset)
         size = int(str_size)
         data = ukai_local_read(image_name, block_size, block_index,
                                offset, size, self._config)
-        return self._rpc_trans.encode(zlib.compress(data))
+        return self._rpc_trans.encode(ukai_encode(data, encoding))
 
     def proxy_write(self, image_name, str_block_size, str_block_index,
-                    str_offset, encoded_data):
+                    str_offset, encoded_data, encoding=UKAI_COMPRESSION_ZLIB):
         block_size = int(str_block_size)
         block_index = int(str_block_index)
         offset = int(str_offset)
-        data = zlib.decompress(self._rpc_trans.decode(encoded_data))
+        data = ukai_decode(self._rpc_trans.decode(encoded_data), encoding)
         return ukai_local_write(image_name, block_size, block_index,
                                 offset, data, self._config)
 
+    def proxy_readv(self, image_name, str_block_size, pieces,
+                    encoding=UKAI_COMPRESSION_ZLIB):
+        '''
+        Reads multiple pieces of the disk image at once.
+
+        param pieces: a list of [str_block_index, str_offset,
+            str_size] lists.
+
+        Return values: A list of the data of each piece.
+        '''
+        block_size = int(str_block_size)
+        encoded_data_list = []
+        for (str_block_index, str_offset, str_size) in pieces:
+            data = ukai_local_read(image_name, block_size,
+                                   int(str_block_index), int(str_offset),
+                                   int(str_size), self._config)
+            encoded_data_list.append(
+                self._rpc_trans.encode(ukai_encode(data, encoding)))
+        return encoded_data_list
+
+    def proxy_writev(self, image_name, str_block_size, pieces,
+                     encoding=UKAI_COMPRESSION_ZLIB):
+        '''
+        Writes multiple pieces of the disk image at once.
+
+        param pieces: a list of [str_block_index, str_offset,
+            encoded_data] lists.
+
+        Return values: A list of the return values of each piece.
+        '''
+        block_size = int(str_block_size)
+        ret_list = []
+        for (str_block_index, str_offset, encoded_data) in pieces:
+            data = ukai_decode(self._rpc_trans.decode(encoded_data),
+                               encoding)
+            ret_list.append(ukai_local_write(image_name, block_size,
+                                             int(str_block_index),
+                                             int(str_offset), data,
+                                             self._config))
+        return ret_list
+
     def proxy_allocate_dataspace(self, image_name, block_size, block_index):
         return ukai_local_allocate_dataspace(image_name, block_size,
                                              block_index, self._config)
@@ -260,33 +408,107 @@ class UKAICore(object):
     def proxy_update_metadata(self, image_name, encoded_metadata):
         metadata_raw = json.loads(zlib.decompress(self._rpc_trans.decode(
                     encoded_metadata)))
+        return self._update_metadata(image_name, metadata_raw)
+
+    def _metadata_update_received(self, image_name, message):
+        # Called by the metadata servers when the writer of the image
+        # publishes an update.
+        try:
+            lock.acquire()
+            if image_name not in self._metadata_dict:
+                return
+            if message is None:
+                # some updates may be missing.  fetch the entire
+                # metadata if it is newer.
+                metadata_raw = self._get_metadata(image_name)
+                if metadata_raw is None:
+                    return
+                metadata = self._metadata_dict[image_name]
+                version = int(metadata_raw.get('version', 0))
+                if (version < metadata.version
+                    or (version == metadata.version
+                        and (metadata_raw.get('update_id')
+                             == metadata.update_id))):
+                    return
+                self._update_metadata(image_name, metadata_raw)
+                return
+            update = json.loads(message)
+            self._update_metadata_delta(image_name,
+                                        int(update['base_version']),
+                                        int(update['version']),
+                                        int(update['used_size']),
+                                        update['deltas'],
+                                        update.get('base_update_id'),
+                                        update.get('update_id'))
+        finally:
+            lock.release()
+
+    def _update_metadata_delta(self, image_name, base_version, version,
+                               used_size, deltas, base_update_id=None,
+                               update_id=None):
+        # Different nodes may flush the same version from the same
+        # base version.  If the update IDs are sent, the deltas are
+        # applied only to the exact update they are based on, and
+        # the entire metadata is fetched when the versions collide.
+        if image_name in self._metadata_dict:
+            metadata = self._metadata_dict[image_name]
+            current_version = metadata.version
+            if current_version > version:
+                # already up to date.
+                return 0
+            if current_version == version:
+                if update_id is None or update_id == metadata.update_id:
+                    # already up to date.
+                    return 0
+            elif (current_version == base_version
+                  and (update_id is None
+                       or base_update_id == metadata.update_id)
+                  and deltas is not None):
+                self._data_dict[image_name].apply_metadata_deltas(
+                    version, used_size, deltas, update_id)
+                return 0
+        # some updates are missing, or the locations have been
+        # changed.  fetch the entire metadata.
+        metadata_raw = self._get_metadata(image_name)
+        if metadata_raw is None:
+            return errno.ENOENT
+        return self._update_metadata(image_name, metadata_raw)
+
+    def _update_metadata(self, image_name, metadata_raw):
         if image_name in self._metadata_dict:
-            self._metadata_dict[image_name].metadata = metadata_raw
+            self._data_dict[image_name].update_metadata(metadata_raw)
         else:
             metadata = UKAIMetadata(image_name, self._config, metadata_raw)
             self._metadata_dict[image_name] = metadata
             self._data_dict[image_name] = UKAIData(metadata,
                                                    self._node_error_state_set,
-                                                   self._config)
+                                                   self._node_latency_set,
+                                                   self._config,
+                                                   self._node_compression_set)
             UKAIStatistics[image_name] = UKAIImageStatistics()
 
         return 0
 
     def proxy_destroy_image(self, image_name):
+        ukai_disk_cache.invalidate_image(image_name)
         return ukai_local_destroy_image(image_name, self._config)
 
 
     ''' Controll processing.
     '''
     def ctl_create_image(self, image_name, str_size, block_size=None,
-                         location=None):
+                         location=None, write_quorum=None):
         assert image_name is not None
         size = int(str_size)
         assert size > 0
 
+        defaults = self._config.get('create_default')
         if block_size is None:
-            defaults = self._config.get('create_default')
             block_size = defaults['block_size']
+        if write_quorum is None and defaults is not None:
+            if 'write_quorum' in defaults:
+                write_quorum = defaults['write_quorum']
+        assert write_quorum is None or write_quorum > 0
         assert block_size > 0
         assert size > block_size
         assert size % block_size == 0
@@ -296,19 +518,35 @@ class UKAICore(object):
             location = self._config.get('core_server')
 
         ukai_metadata_create(image_name, size, block_size,
-                             location, self._config)
+                             location, self._config, write_quorum)
 
     def ctl_destroy_image(self, image_name):
         assert image_name is not None
 
         ukai_data_destroy(image_name, self._config)
         ukai_metadata_destroy(image_name, self._config)
+        ukai_disk_cache.invalidate_image(image_name)
 
     def ctl_get_metadata(self, image_name):
-        metadata = self._get_metadata(image_name)
+        metadata = self._get_cached_metadata(image_name)
         if metadata is None:
             return errno.ENOENT, None
-        return 0, json.dumps(metadata)
+        if metadata['blocks'] is None:
+            # The blocks are stored in segments.
+            metadata = UKAIMetadata(image_name, self._config,
+                                    metadata).metadata
+        return 0, json.dumps(ukai_metadata_to_json(metadata))
+
+    def ctl_migrate_metadata(self, image_name, format):
+        assert image_name is not None
+
+        old_format = ukai_db_client.convert_metadata(image_name, format)
+        if old_format is None:
+            return errno.ENOENT, None
+        return 0, old_format
+
+    def ctl_rebalance_metadata(self, old_servers=None):
+        return 0, ukai_db_client.rebalance_metadata(old_servers)
 
     def ctl_add_location(self, image_name, location,
                          start_index=0, end_index=-1,
@@ -383,7 +621,9 @@ class UKAICore(object):
             if metadata_raw is None:
                 return errno.ENOENT
             metadata = UKAIMetadata(image_name, self._config, metadata_raw)
-            data = UKAIData(metadata, self._node_error_state_set, self._config)
+            data = UKAIData(metadata, self._node_error_state_set,
+                            self._node_latency_set, self._config,
+                            self._node_compression_set)
         if end_index == -1:
             end_index = (metadata.size / metadata.block_size) - 1
         for block_index in range(start_index, end_index + 1):
@@ -398,6 +638,17 @@ class UKAICore(object):
     def ctl_get_node_error_state_set(self):
         return self._node_error_state_set.get_list()
 
+    def ctl_get_node_latency_set(self):
+        return self._node_latency_set.get_list()
+
+    def ctl_get_node_compression_set(self):
+        # byte counters may exceed the integer range of XML-RPC.
+        return json.dumps(self._node_compression_set.get_list())
+
+    def ctl_get_rpc_statistics(self):
+        return {'xmlrpc': ukai_rpc_connection_pool.statistics,
+                'binary': ukai_binary_rpc_connection_pool.statistics}
+
     def ctl_get_image_names(self):
         return ukai_db_client.get_image_names()
 
@@ -33,16 +33,24 @@ image data of a UKAI virtual disk image.
 import os
 import sys
 import threading
-import zlib
+import time
+import xmlrpclib
 
 import netifaces
 
+from ukai_binary_rpc import UKAIBinaryRPCCall
+from ukai_cache import UKAIBlockCache, ukai_disk_cache
+from ukai_compression import UKAINodeCompressionSet, UKAI_COMPRESSION_ZLIB
 from ukai_config import UKAIConfig
+from ukai_db import ukai_db_client
 from ukai_local_io import ukai_local_read, ukai_local_write
+from ukai_local_io import ukai_is_zero
 from ukai_metadata import UKAIMetadata
 from ukai_metadata import UKAI_IN_SYNC, UKAI_SYNCING, UKAI_OUT_OF_SYNC
+from ukai_readahead import UKAIReadahead
 from ukai_rpc import UKAIXMLRPCCall, UKAIXMLRPCTranslation
 from ukai_statistics import UKAIStatistics
+from ukai_thread_pool import ukai_thread_pool
 from ukai_utils import UKAIIsLocalNode
 
 def ukai_data_destroy(image_name, config):
@@ -53,12 +61,7 @@ def ukai_data_destroy(image_name, config):
     param config: an UKAIConfig instance
     '''
     metadata = UKAIMetadata(image_name, config)
-    blocks = metadata.blocks
-    location_set = set()
-    for n in blocks:
-        for location in n.keys():
-            location_set.add(location)
-    for location in location_set:
+    for location in metadata.locations:
         rpc_call = UKAIXMLRPCCall(location, config.get('core_port'))
         # XXX handle rpc error.
         rpc_call.call('proxy_destroy_image', image_name)
@@ -83,19 +86,46 @@ class UKAIData(object):
     disk image contents.
     '''
 
-    def __init__(self, metadata, node_error_state_set, config):
+    def __init__(self, metadata, node_error_state_set, node_latency_set,
+                 config, node_compression_set=None):
         '''
         Initializes the instance with the specified metadata object
-        created with the UKAIMetadata class.
+        created with the UKAIMetadata class.  If node_compression_set
+        is None, an UKAINodeCompressionSet instance is created from
+        the config.
         '''
         self._metadata = metadata
         self._node_error_state_set = node_error_state_set
+        self._node_latency_set = node_latency_set
         self._config = config
+        if node_compression_set is None:
+            node_compression_set = UKAINodeCompressionSet(config)
+        self._node_compression_set = node_compression_set
         self._rpc_trans = UKAIXMLRPCTranslation()
-        # Lock objects per block index.
-        self._lock = []
-        for blk_idx in range(0, len(metadata.blocks)):
-            self._lock.append(threading.Lock())
+        # Write tasks still in progress after quorum acknowledgement,
+        # indexed by a block index and a node.
+        self._pending_writes = {}
+        self._pending_cond = threading.Condition()
+        # Cache of data read from remote nodes.
+        self._cache = None
+        if self._config.get('block_cache_size') > 0:
+            self._cache = UKAIBlockCache(self._config.get('block_cache_size'))
+        # The write generation of the disk image in which the block
+        # cache is filled, and whether no node had the disk image open
+        # for writing when the generation was seen.
+        self._cache_generation = None
+        self._cache_without_writer = False
+        # Sequential access detector.  The prefetched data is stored
+        # in the block cache by worker threads.
+        self._readahead = None
+        if (self._cache is not None
+            and ukai_thread_pool.num_workers > 0
+            and self._config.get('readahead_min') > 0):
+            max_window = self._config.get('readahead_max')
+            if max_window < self._config.get('readahead_min'):
+                max_window = self._config.get('readahead_min')
+            self._readahead = UKAIReadahead(
+                self._config.get('readahead_min'), max_window)
 
     def _gather_pieces(self, offset, size):
         '''
@@ -153,32 +183,68 @@ class UKAIData(object):
             # shorten the size not to overread the end of the file.
             size = self._metadata.used_size - offset
 
-        data = ''
-        partial_data = ''
         metadata_flush_required = False
         pieces = self._gather_pieces(offset, size)
         # read operation statistics.
         UKAIStatistics[self._metadata.name].read_op(pieces)
+        data = bytearray(size)
+        # the blocks are locked in shared mode, so that other readers
+        # can read the same blocks at the same time.
+        first_blk_idx = pieces[0][0]
+        last_blk_idx = pieces[-1][0]
+        wait_time = self._metadata.acquire_lock(first_blk_idx, last_blk_idx,
+                                                shared=True)
+        UKAIStatistics[self._metadata.name].lock_wait(wait_time)
         try:
+            # Issue read requests of all the pieces at once, and then
+            # collect the results in order.  The pieces read from the
+            # same remote node are requested in one batch.
+            tasks = []
+            batches = {}
             for piece in pieces:
-                self._metadata._lock[piece[0]].acquire() # XXX
-                self._lock[piece[0]].acquire()
+                candidate = self._find_read_candidate(piece[0])
+                if candidate is None:
+                    print 'XXX fatal.  should raise an exception.'
+                if self._is_batch_read_node(candidate):
+                    batches.setdefault(candidate, []).append(len(tasks))
+                tasks.append([piece, candidate, None])
+            for (node, task_indices) in batches.items():
+                if len(task_indices) < 2:
+                    continue
+                batch_task = ukai_thread_pool.submit(
+                    self._get_data_cached_batch, node,
+                    [tasks[task_idx][0] for task_idx in task_indices])
+                for (piece_idx, task_idx) in enumerate(task_indices):
+                    tasks[task_idx][2] = batch_task.then(
+                        lambda data_list, piece_idx=piece_idx:
+                            data_list[piece_idx])
+            for task_entry in tasks:
+                if task_entry[2] is not None:
+                    continue
+                (blk_idx, off_in_blk, size_in_blk) = task_entry[0]
+                task_entry[2] = ukai_thread_pool.submit(self._get_data_cached,
+                                                        task_entry[1],
+                                                        blk_idx,
+                                                        off_in_blk,
+                                                        size_in_blk)
 
-            for piece in pieces:
-                blk_idx = piece[0]
-                off_in_blk = piece[1]
-                size_in_blk = piece[2]
-                block = self._metadata.blocks[blk_idx]
+            data_offset = 0
+            for (piece, candidate, task) in tasks:
+                (blk_idx, off_in_blk, size_in_blk) = piece
                 data_read = False
                 while not data_read:
-                    candidate = self._find_read_candidate(blk_idx)
-                    if candidate is None:
-                        print 'XXX fatal.  should raise an exception.'
+                    (candidate, task, failed) = self._wait_read_task(
+                        piece, candidate, task)
+                    for (failed_node, failed_task) in failed:
+                        # the failure of a node covered by a hedged
+                        # read.
+                        print failed_task.exception.__class__
+                        self._metadata.set_sync_status(blk_idx, failed_node,
+                                                       UKAI_OUT_OF_SYNC)
+                        metadata_flush_required = True
+                        self._node_error_state_set.add(failed_node, 0)
                     try:
-                        partial_data = self._get_data(candidate,
-                                                      blk_idx,
-                                                      off_in_blk,
-                                                      size_in_blk)
+                        partial_data = task.result()
                         data_read = True
                         break
                     except (IOError, xmlrpclib.Error), e:
@@ -188,34 +254,361 @@ class UKAIData(object):
                         metadata_flush_required = True
                         self._node_error_state_set.add(candidate, 0)
                         # try to find another candidate node.
+                        candidate = self._find_read_candidate(blk_idx)
+                        if candidate is None:
+                            print 'XXX fatal.  should raise an exception.'
+                        task = ukai_thread_pool.submit(self._get_data_cached,
+                                                       candidate,
+                                                       blk_idx,
+                                                       off_in_blk,
+                                                       size_in_blk)
                         continue
                 if data_read is False:
                     # no node is available to get the peice of data.
                     print 'XXX fatal.  should raise an exception.'
 
-                data = data + partial_data
+                data[data_offset:data_offset + size_in_blk] = partial_data
+                data_offset = data_offset + size_in_blk
         finally:
-            for piece in pieces:
-                self._metadata._lock[piece[0]].release() # XXX
-                self._lock[piece[0]].release()
+            self._metadata.release_lock(first_blk_idx, last_blk_idx,
+                                        shared=True)
 
         if metadata_flush_required is True:
-            self._metadata.flush()
+            self._metadata.mark_dirty()
 
-        return (data)
+        if self._readahead is not None:
+            self._read_ahead(offset, size)
+
+        return (str(data))
+
+    def _is_batch_read_node(self, node):
+        '''
+        Returns True if the pieces read from the node can be requested
+        in one batch.  Local pieces are read one by one.  Batches are
+        not used if hedged reads are enabled, since the round trip
+        time of a batch is not comparable to the one of a piece.
+        '''
+        return (node is not None
+                and not UKAIIsLocalNode(node)
+                and self._config.get('hedged_read_percentile') is None)
+
+    def _wait_read_task(self, piece, candidate, task):
+        '''
+        Waits for the completion of a read task of a piece.  If hedged
+        reads are enabled and the node doesn't respond within the
+        configured percentile of its round trip time, the same piece
+        is requested to another in-sync node, and the task completed
+        first successfully is returned.
+
+        piece: a (block index, start position, length) tupple.
+        candidate: the node to which the task was sent.
+        task: the read task.
+
+        Return values: a (node, task, failed) tupple.  The node and
+            task are of the completed task.  The failed is a list of
+            (node, task) tupples of the other tasks which have failed,
+            which the caller must handle as well.
+        '''
+        percent = self._config.get('hedged_read_percentile')
+        if (percent is None
+            or ukai_thread_pool.num_workers == 0
+            or candidate is None
+            or UKAIIsLocalNode(candidate)):
+            task.wait()
+            return ((candidate, task, []))
+        delay = self._node_latency_set.percentile(candidate, percent)
+        if delay is None or task.wait(delay) is True:
+            return ((candidate, task, []))
+
+        (blk_idx, off_in_blk, size_in_blk) = piece
+        hedge_candidate = self._find_read_candidate(blk_idx,
+                                                    exclude=[candidate])
+        if hedge_candidate is None:
+            task.wait()
+            return ((candidate, task, []))
+        UKAIStatistics[self._metadata.name].hedge_fired()
+        hedge_task = ukai_thread_pool.submit(self._get_data_cached,
+                                             hedge_candidate,
+                                             blk_idx,
+                                             off_in_blk,
+                                             size_in_blk)
+        completed = threading.Event()
+        task.add_done_callback(lambda t: completed.set())
+        hedge_task.add_done_callback(lambda t: completed.set())
+        while True:
+            completed.wait()
+            completed.clear()
+            if task.done() and task.exception is None:
+                return ((candidate, task,
+                         self._hedged_read_lost(blk_idx, hedge_candidate,
+                                                hedge_task)))
+            if hedge_task.done() and hedge_task.exception is None:
+                UKAIStatistics[self._metadata.name].hedge_won()
+                return ((hedge_candidate, hedge_task,
+                         self._hedged_read_lost(blk_idx, candidate, task)))
+            if task.done() and hedge_task.done():
+                # both failed.  the failure of the first candidate is
+                # handled when its result is retrieved.
+                return ((candidate, task,
+                         [(hedge_candidate, hedge_task)]))
+
+    def _hedged_read_lost(self, blk_idx, node, task):
+        '''
+        Handles the read task which lost a hedged read.  If the task
+        has failed, it is returned in a list for the caller to handle
+        the failure.  If the task is still in progress, its failure is
+        handled when the task is completed.
+
+        blk_idx: the block index of the disk image.
+        node: the node to which the task was sent.
+        task: the read task.
+
+        Return values: a list of the (node, task) tupple of the failed
+            task, or an empty list.
+        '''
+        if task.done():
+            if task.exception is not None:
+                return ([(node, task)])
+            return ([])
+        task.add_done_callback(
+            lambda task: self._complete_hedged_read(blk_idx, node, task))
+        return ([])
+
+    def _complete_hedged_read(self, blk_idx, node, task):
+        '''
+        Called when a read task which lost a hedged read is completed.
+        This method is called from a worker thread of the thread pool.
+        '''
+        if task.exception is None:
+            return
+        print task.exception.__class__
+        self._metadata.set_sync_status(blk_idx, node, UKAI_OUT_OF_SYNC)
+        self._node_error_state_set.add(node, 0)
+        # The metadata may be flushed immediately.  Use another thread
+        # not to occupy a worker thread while sending it to all the
+        # readers.
+        flusher = threading.Thread(target=self._metadata.mark_dirty)
+        flusher.daemon = True
+        flusher.start()
+
+    def _read_ahead(self, offset, size):
+        '''
+        Passes the read operation to the sequential access detector,
+        and starts prefetching the range returned from the detector
+        in background.
+
+        offset: the offset of the read operation.
+        size: the size of the read operation.
+        '''
+        prefetch = self._readahead.access(offset, size)
+        if prefetch is None:
+            return
+        (ra_offset, ra_size) = prefetch
+        used_size = self._metadata.used_size
+        if ra_offset >= used_size:
+            return
+        if ra_offset + ra_size > used_size:
+            ra_size = used_size - ra_offset
+        UKAIStatistics[self._metadata.name].readahead_op(ra_size)
+        for piece in self._gather_pieces(ra_offset, ra_size):
+            # prefetching must not delay the foreground I/O sharing
+            # the workers.  The rest of the window is prefetched by
+            # the following reads when the pool is busy.
+            if ukai_thread_pool.submit_background(
+                self._prefetch_piece, piece[0], piece[1], piece[2]) is None:
+                self._readahead.cancel(
+                    piece[0] * self._metadata.block_size + piece[1])
+                break
+
+    def _prefetch_piece(self, blk_idx, off_in_blk, size_in_blk):
+        '''
+        Reads a piece of data from a remote node and stores it in the
+        block cache.  The block is locked for reading, so that the
+        data is not read from a node while a write to the block is
+        in progress.  This method is called from a worker thread of
+        the thread pool.
+
+        blk_idx: the block index of the disk image.
+        off_in_blk: the offset relative to the beginning of the
+            specified block.
+        size_in_blk: the length of the data to be read.
+        '''
+        if not self._is_cache_usable():
+            return
+        if self._cache.get(blk_idx, off_in_blk, size_in_blk) is not None:
+            return
+        self._metadata.acquire_lock(blk_idx, blk_idx, shared=True)
+        try:
+            generation = self._cache.generation(blk_idx)
+            candidate = self._find_read_candidate(blk_idx)
+            if candidate is None or UKAIIsLocalNode(candidate):
+                # local data doesn't need to be prefetched.
+                return
+            try:
+                data = self._get_data_remote(candidate, blk_idx,
+                                             off_in_blk, size_in_blk)
+            except (IOError, xmlrpclib.Error), e:
+                # failures are handled when the data is actually read.
+                print e.__class__
+                return
+            if ukai_is_zero(data):
+                return
+            self._cache.put(blk_idx, off_in_blk, data, generation)
+        finally:
+            self._metadata.release_lock(blk_idx, blk_idx, shared=True)
+
+    def _find_read_candidate(self, blk_idx, exclude=None):
+        '''
+        Returns a node from which the specified block is read.  The
+        local node is used if it is in-sync, otherwise the fastest
+        in-sync remote node is chosen.
 
-    def _find_read_candidate(self, blk_idx):
-        candidate = None
-        for node in self._metadata.blocks[blk_idx].keys():
+        blk_idx: the block index of the disk image.
+        exclude: a list of nodes which must not be chosen.
+        '''
+        candidates = []
+        for node in self._metadata.get_locations(blk_idx):
+            if exclude is not None and node in exclude:
+                continue
             if self._node_error_state_set.is_in_failure(node) is True:
                 continue
             if self._metadata.get_sync_status(blk_idx, node) != UKAI_IN_SYNC:
                 continue
+            if self._is_write_pending(blk_idx, node):
+                # the node may not have the latest data yet.
+                continue
             if UKAIIsLocalNode(node):
-                candidate = node
-                break
-            candidate = node
-        return (candidate)
+                return (node)
+            candidates.append(node)
+        return (self._node_latency_set.select(candidates))
+
+    def _get_data_cached(self, node, blk_idx, off_in_blk, size_in_blk):
+        '''
+        Returns a data read from a local store or a remote store.  The
+        data of a remote store is served from the block cache or the
+        disk cache if cached, and inserted to the caches otherwise.
+
+        node: the target node from which we read the data.
+        num: the block index of the disk image.
+        offset: the offset relative to the beginning of the specified
+            block.
+        size: the length of the data to be read.
+        '''
+        if UKAIIsLocalNode(node):
+            return (self._get_data(node, blk_idx, off_in_blk, size_in_blk))
+
+        data = self._get_cached_data(blk_idx, off_in_blk, size_in_blk)
+        if data is None:
+            data = self._get_data_remote(node, blk_idx, off_in_blk,
+                                         size_in_blk)
+            self._put_cached_data(node, blk_idx, off_in_blk, data)
+        return (data)
+
+    def _get_data_cached_batch(self, node, pieces):
+        '''
+        Returns a list of the data of the pieces read from a remote
+        node.  The pieces not cached in the block cache or the disk
+        cache are requested to the node in one batch, and inserted to
+        the caches.
+
+        node: the remote node from which we read the data.
+        pieces: a list of (block index, start position, length)
+            tupples.
+        '''
+        data_list = []
+        missed = []
+        for (piece_idx, piece) in enumerate(pieces):
+            data_list.append(self._get_cached_data(*piece))
+            if data_list[piece_idx] is None:
+                missed.append(piece_idx)
+        if len(missed) == 0:
+            return (data_list)
+        remote_data_list = self._get_data_remote_batch(
+            node, [pieces[piece_idx] for piece_idx in missed])
+        for (piece_idx, data) in zip(missed, remote_data_list):
+            data_list[piece_idx] = data
+            self._put_cached_data(node, pieces[piece_idx][0],
+                                  pieces[piece_idx][1], data)
+        return (data_list)
+
+    def _get_cached_data(self, blk_idx, off_in_blk, size_in_blk):
+        '''
+        Returns a data of a remote store cached in the block cache or
+        the disk cache, or None if not cached.  The data found in the
+        disk cache is inserted to the block cache.
+        '''
+        if not self._is_cache_usable():
+            return (None)
+        if self._cache is not None:
+            data = self._cache.get(blk_idx, off_in_blk, size_in_blk)
+            if data is not None:
+                UKAIStatistics[self._metadata.name].cache_hit()
+                return (data)
+            UKAIStatistics[self._metadata.name].cache_miss()
+
+        if not ukai_disk_cache.enabled:
+            return (None)
+        is_valid = lambda cached_node: self._is_cache_valid(blk_idx,
+                                                            cached_node)
+        data = ukai_disk_cache.get(self._metadata.name, blk_idx,
+                                   off_in_blk, size_in_blk,
+                                   self._metadata.write_generation, is_valid)
+        if data is None:
+            UKAIStatistics[self._metadata.name].disk_cache_miss()
+            return (None)
+        UKAIStatistics[self._metadata.name].disk_cache_hit()
+        if self._cache is not None:
+            self._cache.put(blk_idx, off_in_blk, data)
+        return (data)
+
+    def _put_cached_data(self, node, blk_idx, off_in_blk, data):
+        '''
+        Inserts a data read from a remote store to the caches.  All-zero
+        data is not cached, since it is transferred cheaply.
+        '''
+        if not self._is_cache_usable() or ukai_is_zero(data):
+            return
+        if ukai_disk_cache.enabled:
+            ukai_disk_cache.put(self._metadata.name, blk_idx,
+                                off_in_blk, data,
+                                self._metadata.write_generation, node)
+        if self._cache is not None:
+            self._cache.put(blk_idx, off_in_blk, data)
+
+    def _is_cache_usable(self):
+        '''
+        Returns True if the block cache and the disk cache can be
+        used.  The caches are used by the last writer of the disk
+        image, and by any node while no node has the disk image open
+        for writing, since the data written by other nodes is not
+        notified.  The cached data is valid until a node opens the
+        disk image for writing, which changes the write generation.
+        The writers are checked only when the generation changes, so
+        readers don't start caching when the last writer closes the
+        disk image until it is opened again.
+        '''
+        generation = self._metadata.write_generation
+        if generation != self._cache_generation:
+            if self._cache is not None:
+                self._cache.invalidate_all()
+            self._cache_without_writer = (
+                len(ukai_db_client.get_writers(self._metadata.name)) == 0)
+            self._cache_generation = generation
+        if self._cache_without_writer is True:
+            return (True)
+        return (self._metadata.last_writer == self._config.get('id'))
+
+    def _is_cache_valid(self, blk_idx, node):
+        '''
+        Returns True if the data of the specified block read from the
+        node is still valid, that is, the node is an in-sync location
+        of the block.
+        '''
+        if self._metadata.has_location(blk_idx, node) is False:
+            return (False)
+        if self._metadata.get_sync_status(blk_idx, node) != UKAI_IN_SYNC:
+            return (False)
+        return (True)
 
     def _get_data(self, node, blk_idx, off_in_blk, size_in_blk):
         '''
@@ -262,8 +655,9 @@ class UKAIData(object):
     def _get_data_remote(self, node, blk_idx, off_in_blk, size_in_blk):
         '''
         Returns a data read from a remote store.  The remote read
-        command is sent to a remote proxy program using the XML RPC
-        mechanism.
+        command is sent to a remote proxy program using the binary
+        protocol if the data_port parameter is configured, otherwise
+        using the XML RPC mechanism.
 
         node: the target node from which we read the data.
         num: the block index of the disk image.
@@ -271,15 +665,74 @@ class UKAIData(object):
             block.
         size: the length of the data to be read.
         '''
-        rpc_call = UKAIXMLRPCCall(node,
-                                  self._config.get('core_port'))
-        encoded_data = rpc_call.call('proxy_read',
-                                     self._metadata.name,
-                                     str(self._metadata.block_size),
-                                     str(blk_idx),
-                                     str(off_in_blk),
-                                     str(size_in_blk))
-        return zlib.decompress(self._rpc_trans.decode(encoded_data))
+        compression = self._node_compression_set.get(node)
+        start_time = time.time()
+        if self._config.get('data_port') is not None:
+            rpc_call = UKAIBinaryRPCCall(node, self._config.get('data_port'),
+                                         compression)
+            data = rpc_call.read(self._metadata.name,
+                                 self._metadata.block_size,
+                                 blk_idx,
+                                 off_in_blk,
+                                 size_in_blk)
+        else:
+            rpc_call = UKAIXMLRPCCall(node,
+                                      self._config.get('core_port'))
+            encoding = compression.encoding()
+            encoded_data = rpc_call.call('proxy_read',
+                                         self._metadata.name,
+                                         str(self._metadata.block_size),
+                                         str(blk_idx),
+                                         str(off_in_blk),
+                                         str(size_in_blk),
+                                         *self._encoding_args(encoding))
+            data = compression.decode(encoding,
+                                      self._rpc_trans.decode(encoded_data))
+        self._node_latency_set.update(node, time.time() - start_time)
+        return (data)
+
+    def _get_data_remote_batch(self, node, pieces):
+        '''
+        Returns a list of the data of the pieces read from a remote
+        store in one request.  The round trip time is not recorded,
+        since it depends on the number of the pieces.
+
+        node: the target node from which we read the data.
+        pieces: a list of (block index, start position, length)
+            tupples.
+        '''
+        compression = self._node_compression_set.get(node)
+        if self._config.get('data_port') is not None:
+            rpc_call = UKAIBinaryRPCCall(node, self._config.get('data_port'),
+                                         compression)
+            return (rpc_call.readv(self._metadata.name,
+                                   self._metadata.block_size,
+                                   pieces))
+        rpc_call = UKAIXMLRPCCall(node, self._config.get('core_port'))
+        encoding = compression.encoding()
+        encoded_data_list = rpc_call.call('proxy_readv',
+                                          self._metadata.name,
+                                          str(self._metadata.block_size),
+                                          [[str(blk_idx),
+                                            str(off_in_blk),
+                                            str(size_in_blk)]
+                                           for (blk_idx, off_in_blk,
+                                                size_in_blk) in pieces],
+                                          *self._encoding_args(encoding))
+        return ([compression.decode(encoding,
+                                    self._rpc_trans.decode(encoded_data))
+                 for encoded_data in encoded_data_list])
+
+    def _encoding_args(self, encoding):
+        '''
+        Returns the optional encoding argument of the proxy_read*
+        and proxy_write* XML-RPC methods.  The argument is omitted for
+        the default encoding to be compatible with the nodes which
+        don't accept it.
+        '''
+        if encoding == UKAI_COMPRESSION_ZLIB:
+            return ([])
+        return ([encoding])
 
     def write(self, data, offset):
         '''
@@ -296,55 +749,293 @@ class UKAIData(object):
         # write operation statistics.
         UKAIStatistics[self._metadata.name].write_op(pieces)
         data_offset = 0
+        first_blk_idx = pieces[0][0]
+        last_blk_idx = pieces[-1][0]
+        wait_time = self._metadata.acquire_lock(first_blk_idx, last_blk_idx)
+        UKAIStatistics[self._metadata.name].lock_wait(wait_time)
         try:
+            # Previous writes to the blocks which are still in
+            # progress must be completed before writing new data.
             for piece in pieces:
-                self._metadata._lock[piece[0]].acquire() # XXX
-                self._lock[piece[0]].acquire()
+                self._wait_pending_writes(piece[0])
 
+            # Send all the pieces to all the nodes at once.  The
+            # tasks are executed in parallel if the thread pool has
+            # worker threads, otherwise they are executed one by one.
+            # The pieces sent to the same remote node are sent in one
+            # batch.
+            piece_tasks = []
+            node_writes = {}
             for piece in pieces:
                 blk_idx = piece[0]
                 off_in_blk = piece[1]
                 size_in_blk = piece[2]
-                block = self._metadata.blocks[blk_idx]
-                for node in block.keys():
-                    try:
-                        if (self._node_error_state_set.is_in_failure(node)
-                            is True):
-                            if (self._metadata.get_sync_status(blk_idx, node)
-                                == UKAI_IN_SYNC):
-                                self._metadata.set_sync_status(blk_idx, node,
-                                                               UKAI_OUT_OF_SYNC)
-                                metadata_flush_required = True
-                            continue
+                piece_data = data[data_offset:data_offset + size_in_blk]
+                tasks = []
+                for node in self._metadata.get_locations(blk_idx):
+                    if (self._node_error_state_set.is_in_failure(node)
+                        is True):
                         if (self._metadata.get_sync_status(blk_idx, node)
-                            != UKAI_IN_SYNC):
-                            self._synchronize_block(blk_idx, node)
+                            == UKAI_IN_SYNC):
+                            self._metadata.set_sync_status(blk_idx, node,
+                                                           UKAI_OUT_OF_SYNC)
                             metadata_flush_required = True
-                        self._put_data(node,
-                                       blk_idx,
-                                       off_in_blk,
-                                       data[data_offset:data_offset
-                                            + size_in_blk])
+                        continue
+                    sync_required = False
+                    if (self._metadata.get_sync_status(blk_idx, node)
+                        != UKAI_IN_SYNC):
+                        sync_required = True
+                        metadata_flush_required = True
+                    node_writes.setdefault(node, []).append(
+                        (len(piece_tasks), blk_idx, off_in_blk, piece_data,
+                         sync_required))
+                piece_tasks.append(tasks)
+                if self._cache is not None and self._is_cache_usable():
+                    self._cache.update(blk_idx, off_in_blk, piece_data)
+                if ukai_disk_cache.enabled:
+                    ukai_disk_cache.invalidate(self._metadata.name, blk_idx)
+                data_offset = data_offset + size_in_blk
+            for (node, writes) in node_writes.items():
+                if len(writes) > 1 and not UKAIIsLocalNode(node):
+                    batch_task = ukai_thread_pool.submit(
+                        self._put_data_to_node_batch, node,
+                        [write[1:] for write in writes])
+                    for (write_idx, write) in enumerate(writes):
+                        task = batch_task.then(
+                            lambda ret_list, write_idx=write_idx:
+                                ret_list[write_idx])
+                        piece_tasks[write[0]].append((write[1], node, task))
+                    continue
+                for (piece_idx, blk_idx, off_in_blk, piece_data,
+                     sync_required) in writes:
+                    task = ukai_thread_pool.submit(
+                        self._put_data_to_node,
+                        node,
+                        blk_idx,
+                        off_in_blk,
+                        piece_data,
+                        sync_required)
+                    piece_tasks[piece_idx].append((blk_idx, node, task))
+
+            # Wait until enough nodes acknowledge each piece.  The
+            # rest of the tasks are completed in background.
+            quorum = self._metadata.write_quorum
+            ack_cond = threading.Condition()
+            def notify_ack(task):
+                try:
+                    ack_cond.acquire()
+                    ack_cond.notify_all()
+                finally:
+                    ack_cond.release()
+            for tasks in piece_tasks:
+                for (blk_idx, node, task) in tasks:
+                    task.add_done_callback(notify_ack)
+            try:
+                ack_cond.acquire()
+                while not self._write_acknowledged(piece_tasks, quorum):
+                    ack_cond.wait()
+            finally:
+                ack_cond.release()
+
+            for tasks in piece_tasks:
+                for (blk_idx, node, task) in tasks:
+                    if not task.done():
+                        self._add_pending_write(blk_idx, node, task)
+                        continue
+                    try:
+                        task.result()
                     except (IOError, xmlrpclib.Error), e:
                         print e.__class__
                         self._metadata.set_sync_status(blk_idx, node,
                                                        UKAI_OUT_OF_SYNC)
                         metadata_flush_required = True
                         self._node_error_state_set.add(node, 0)
-                data_offset = data_offset + size_in_blk
         finally:
             if offset + len(data) > self._metadata.used_size:
                 self._metadata.used_size = offset + len(data)
                 metadata_flush_required = True
-            for piece in pieces:
-                self._metadata._lock[piece[0]].release() # XXX
-                self._lock[piece[0]].release()
+            self._metadata.release_lock(first_blk_idx, last_blk_idx)
 
         if metadata_flush_required is True:
-            self._metadata.flush()
+            self._metadata.mark_dirty()
 
         return (len(data))
 
+    def update_metadata(self, metadata_raw):
+        '''
+        Replaces the metadata information with the specified one
+        received from other nodes.  The cached data of the blocks
+        whose location information has changed is invalidated.  All
+        the cached data is invalidated if another node has opened the
+        disk image for writing.
+
+        metadata_raw: a new raw metadata.
+        '''
+        old_status = self._metadata.block_status
+        old_generation = self._metadata.write_generation
+        self._metadata.metadata = metadata_raw
+        if self._cache is None and not ukai_disk_cache.enabled:
+            return
+        new_status = self._metadata.block_status
+        if (old_status.num_blocks != new_status.num_blocks
+            or old_generation != self._metadata.write_generation):
+            if self._cache is not None:
+                self._cache.invalidate_all()
+            ukai_disk_cache.invalidate_image(self._metadata.name)
+            return
+        for blk_idx in new_status.changed_blocks(old_status):
+            if self._cache is not None:
+                self._cache.invalidate(blk_idx)
+            if ukai_disk_cache.enabled:
+                ukai_disk_cache.invalidate(self._metadata.name, blk_idx)
+
+    def apply_metadata_deltas(self, version, used_size, deltas,
+                              update_id=None):
+        '''
+        Applies sync status changes received from the writer of the
+        disk image.  The cached data of the changed blocks is
+        invalidated.
+
+        version: the new version of the metadata.
+        used_size: the used size of the disk image.
+        deltas: a list of (block index, node, sync status) tupples.
+        update_id: the update ID of the new version.
+        '''
+        self._metadata.apply_deltas(version, used_size, deltas, update_id)
+        for (blk_idx, node, sync_status) in deltas:
+            if self._cache is not None:
+                self._cache.invalidate(blk_idx)
+            if ukai_disk_cache.enabled:
+                ukai_disk_cache.invalidate(self._metadata.name, blk_idx)
+
+    def _write_acknowledged(self, piece_tasks, quorum):
+        '''
+        Returns True if all the pieces are acknowledged by at least
+        the quorum number of nodes, or all the write tasks of a piece
+        are completed.
+
+        piece_tasks: a list of lists of (block index, node, task)
+            tupples of each piece.
+        quorum: the number of nodes required to acknowledge a piece.
+            If None, all the nodes must complete the write.
+        '''
+        for tasks in piece_tasks:
+            acks = 0
+            pending = 0
+            for (blk_idx, node, task) in tasks:
+                if not task.done():
+                    pending += 1
+                elif task.exception is None:
+                    acks += 1
+            if pending == 0:
+                continue
+            if quorum is None or acks < quorum:
+                return (False)
+        return (True)
+
+    def _add_pending_write(self, blk_idx, node, task):
+        '''
+        Registers a write task which is still in progress after the
+        write method has returned.  If the task fails, the node is
+        marked as out-of-sync.
+        '''
+        try:
+            self._pending_cond.acquire()
+            if blk_idx not in self._pending_writes:
+                self._pending_writes[blk_idx] = {}
+            self._pending_writes[blk_idx][node] = task
+        finally:
+            self._pending_cond.release()
+        task.add_done_callback(
+            lambda task: self._complete_pending_write(blk_idx, node, task))
+
+    def _complete_pending_write(self, blk_idx, node, task):
+        '''
+        Called when a pending write task is completed.  This method is
+        called from a worker thread of the thread pool.
+        '''
+        if task.exception is not None:
+            print task.exception.__class__
+            self._metadata.set_sync_status(blk_idx, node, UKAI_OUT_OF_SYNC)
+            self._node_error_state_set.add(node, 0)
+            # The metadata may be flushed immediately.  Use another
+            # thread not to occupy a worker thread while sending it to
+            # all the readers.
+            flusher = threading.Thread(target=self._metadata.mark_dirty)
+            flusher.daemon = True
+            flusher.start()
+        try:
+            self._pending_cond.acquire()
+            del self._pending_writes[blk_idx][node]
+            if len(self._pending_writes[blk_idx]) == 0:
+                del self._pending_writes[blk_idx]
+            self._pending_cond.notify_all()
+        finally:
+            self._pending_cond.release()
+
+    def _wait_pending_writes(self, blk_idx):
+        '''
+        Waits for the completion of all the pending write tasks of
+        the specified block.
+        '''
+        try:
+            self._pending_cond.acquire()
+            while blk_idx in self._pending_writes:
+                self._pending_cond.wait()
+        finally:
+            self._pending_cond.release()
+
+    def _is_write_pending(self, blk_idx, node):
+        '''
+        Returns True if a write task to the node of the specified
+        block is still in progress.
+        '''
+        try:
+            self._pending_cond.acquire()
+            return (blk_idx in self._pending_writes
+                    and node in self._pending_writes[blk_idx])
+        finally:
+            self._pending_cond.release()
+
+    def _put_data_to_node(self, node, blk_idx, off_in_blk, data,
+                          sync_required):
+        '''
+        Writes the data to the specified node.  If the block of the
+        node is not synchronized, the block is synchronized before
+        writing the data.  This method is called from a worker
+        thread of the thread pool.
+
+        node: the target node to which we write the data.
+        num: the block index of the disk image.
+        offset: the offset relative to the beginning of the specified
+            block.
+        data: the data to be written.
+        sync_required: True if the block must be synchronized first.
+        '''
+        if sync_required is True:
+            self._synchronize_block(blk_idx, node)
+        return (self._put_data(node, blk_idx, off_in_blk, data))
+
+    def _put_data_to_node_batch(self, node, writes):
+        '''
+        Writes multiple pieces of data to a remote node in one
+        request.  The blocks of the node which are not synchronized
+        are synchronized before writing the data.  This method is
+        called from a worker thread of the thread pool.
+
+        node: the remote node to which we write the data.
+        writes: a list of (block index, start position, data,
+            sync_required) tupples.
+
+        Return values: A list of the return values of each piece.
+        '''
+        pieces = []
+        for (blk_idx, off_in_blk, data, sync_required) in writes:
+            if sync_required is True:
+                self._synchronize_block(blk_idx, node)
+            pieces.append((blk_idx, off_in_blk, data))
+        return (self._put_data_remote_batch(node, pieces))
+
     def _put_data(self, node, blk_idx, off_in_blk, data):
         '''
         Writes the data to a local store or a remote store depending
@@ -388,7 +1079,9 @@ class UKAIData(object):
     def _put_data_remote(self, node, blk_idx, off_in_blk, data):
         '''
         Writes the data to a remote store.  The remote write command
-        is sent to a remote proxy program using the XML RPC mechanism.
+        is sent to a remote proxy program using the binary protocol if
+        the data_port parameter is configured, otherwise using the XML
+        RPC mechanism.
 
         node: the target node from which we read the data.
         num: the block index of the disk image.
@@ -396,13 +1089,52 @@ class UKAIData(object):
             block.
         data: the data to be written.
         '''
+        compression = self._node_compression_set.get(node)
+        if self._config.get('data_port') is not None:
+            rpc_call = UKAIBinaryRPCCall(node, self._config.get('data_port'),
+                                         compression)
+            return rpc_call.write(self._metadata.name,
+                                  self._metadata.block_size,
+                                  blk_idx,
+                                  off_in_blk,
+                                  data)
         rpc_call = UKAIXMLRPCCall(node, self._config.get('core_port'))
+        (encoding, encoded_data) = compression.encode(data)
         return rpc_call.call('proxy_write',
                              self._metadata.name,
                              str(self._metadata.block_size),
                              str(blk_idx),
                              str(off_in_blk),
-                             self._rpc_trans.encode(zlib.compress(data)))
+                             self._rpc_trans.encode(encoded_data),
+                             *self._encoding_args(encoding))
+
+    def _put_data_remote_batch(self, node, pieces):
+        '''
+        Writes multiple pieces of data to a remote store in one
+        request.
+
+        node: the target node to which we write the data.
+        pieces: a list of (block index, start position, data)
+            tupples.
+        '''
+        compression = self._node_compression_set.get(node)
+        if self._config.get('data_port') is not None:
+            rpc_call = UKAIBinaryRPCCall(node, self._config.get('data_port'),
+                                         compression)
+            return (rpc_call.writev(self._metadata.name,
+                                    self._metadata.block_size,
+                                    pieces))
+        rpc_call = UKAIXMLRPCCall(node, self._config.get('core_port'))
+        encoding = compression.encoding()
+        return (rpc_call.call('proxy_writev',
+                              self._metadata.name,
+                              str(self._metadata.block_size),
+                              [[str(blk_idx),
+                                str(off_in_blk),
+                                self._rpc_trans.encode(
+                                    compression.encode(data, encoding)[1])]
+                               for (blk_idx, off_in_blk, data) in pieces],
+                              *self._encoding_args(encoding)))
 
     def synchronize_block(self, blk_idx):
         '''
@@ -415,19 +1147,18 @@ class UKAIData(object):
         process, and must not be called by any other processes.
         '''
         metadata_flush_required = False
+        self._metadata.acquire_lock(blk_idx, blk_idx)
         try:
-            self._metadata._lock[blk_idx].acquire() # XXX
-            self._lock[blk_idx].acquire()
+            self._wait_pending_writes(blk_idx)
 
-            for node in self._metadata.blocks[blk_idx].keys():
+            for node in self._metadata.get_locations(blk_idx):
                 if (self._metadata.get_sync_status(blk_idx, node)
                     == UKAI_IN_SYNC):
                     continue
                 self._synchronize_block(blk_idx, node)
                 metadata_flush_required = True
         finally:
-            self._metadata._lock[blk_idx].release() # XXX
-            self._lock[blk_idx].release()
+            self._metadata.release_lock(blk_idx, blk_idx)
 
         return (metadata_flush_required)
 
@@ -437,9 +1168,8 @@ class UKAIData(object):
         This function first search the already synchronized node block
         and copy the data to all the other not-synchronized nodes.
         '''
-        block = self._metadata.blocks[blk_idx]
         final_candidate = None
-        for candidate in block.keys():
+        for candidate in self._metadata.get_locations(blk_idx):
             if (self._metadata.get_sync_status(blk_idx, candidate)
                 != UKAI_IN_SYNC):
                 continue
@@ -478,6 +1208,11 @@ class UKAIData(object):
             fh.seek(self._metadata.block_size - 1)
             fh.write('\0')
             fh.close()
+        elif self._config.get('data_port') is not None:
+            rpc_call = UKAIBinaryRPCCall(node, self._config.get('data_port'))
+            rpc_call.allocate_dataspace(self._metadata.name,
+                                        self._metadata.block_size,
+                                        blk_idx)
         else:
             rpc_call = UKAIXMLRPCCall(
                 node, self._config.get('core_port'))
@@ -27,29 +27,157 @@
 # OF SUCH DAMAGE.
 
 import json
+import Queue
 import threading
+import time
 
 import redis
 
 import kazoo.client
+import kazoo.exceptions
+
+from ukai_metadata_codec import ukai_metadata_encode, ukai_metadata_decode
+from ukai_metadata_codec import ukai_metadata_format
+from ukai_metadata_codec import ukai_metadata_encode_header
+from ukai_metadata_codec import ukai_metadata_encode_segment
+from ukai_metadata_codec import ukai_metadata_decode_segment
+from ukai_metadata_codec import UKAI_METADATA_FORMAT_JSON
+from ukai_metadata_codec import UKAI_METADATA_FORMAT_SEGMENTED
+from ukai_hash_ring import UKAIHashRing
 
 class UKAIDB(object):
     def __init__(self):
         self._servers = None
         self._client = None
+        # The JSON format can be read by all the versions of UKAI
+        # servers.
+        self._format = UKAI_METADATA_FORMAT_JSON
+        self._metadata_callback = None
 
     def connect(self, config):
         assert False
 
+    def watch_metadata(self, callback):
+        '''
+        Registers a function which is called with the name of a disk
+        image when the metadata of the image is modified by any node.
+        The function is called with None when the modifications may
+        have been missed (e.g. the connection to the metadata servers
+        is lost), so that all the information derived from the
+        metadata is discarded.  The function is called from a
+        background thread.
+
+        callback: a function which receives an image name or None.
+        '''
+        assert False
+
+    def publish_metadata_update(self, image_name, message):
+        '''
+        Sends a message which describes the modification of the
+        metadata of the disk image to all the nodes subscribing the
+        updates of the image.  An error is reported but not raised,
+        since the subscribers fetch the latest metadata when they
+        detect missing messages.
+
+        message: a string.
+        '''
+        assert False
+
+    def subscribe_metadata_updates(self, image_name, callback):
+        '''
+        Registers a function which is called with the image name and
+        a message published by the publish_metadata_update method.
+        The function is called with None instead of a message when
+        messages may have been missed, which may include the start
+        of the subscription.
+        Messages may be coalesced, and only the latest one may be
+        received.  The function is called from a background thread.
+
+        callback: a function which receives an image name and a
+            message.
+        '''
+        assert False
+
+    def unsubscribe_metadata_updates(self, image_name):
+        assert False
+
+    def _notify_metadata_changed(self, image_name):
+        # The local modifications are notified immediately, without
+        # waiting for the notification from the metadata servers.
+        if self._metadata_callback is not None:
+            self._metadata_callback(image_name)
+
+    def _get_servers(self, config):
+        '''
+        Returns the list of the metadata servers.  The
+        metadata_servers parameter may be a list, or a string of
+        comma separated addresses.
+        '''
+        servers = config.get('metadata_servers')
+        if isinstance(servers, basestring):
+            servers = servers.split(',')
+        return ([server.strip() for server in servers])
+
+    def _set_format(self, config):
+        if config.get('metadata_format') is not None:
+            self._format = config.get('metadata_format')
+
     def put_metadata(self, image_name, metadata):
         assert False
 
     def get_metadata(self, image_name):
         assert False
 
+    def put_metadata_segments(self, image_name, metadata, segment_size,
+                              segments):
+        '''
+        Writes out the metadata of the disk image in the segmented
+        format.  Only the specified segments are written, the other
+        segments stored already are kept.
+
+        metadata: a raw metadata.  The 'blocks' key is ignored.
+        segment_size: the number of blocks of each segment.
+        segments: a dictionary whose key is a segment index and value
+            is an UKAIBlockStatusTable instance of the segment.
+        '''
+        assert False
+
+    def get_metadata_segment(self, image_name, segment_idx):
+        '''
+        Returns an UKAIBlockStatusTable instance of the specified
+        segment, or None if the segment doesn't exist.
+        '''
+        assert False
+
+    def convert_metadata(self, image_name, format):
+        '''
+        Rewrites the stored metadata of the disk image in the
+        specified format.  The metadata stored in the segmented
+        format is not converted.
+
+        Return values: The format in which the metadata was stored,
+            or None if the metadata doesn't exist.
+        '''
+        assert False
+
     def delete_metadata(self, image_name):
         assert False
 
+    def rebalance_metadata(self, old_servers=None):
+        '''
+        Moves the metadata of the disk images stored in the metadata
+        servers other than the ones they are mapped to currently.
+        This must be done after adding or removing metadata servers,
+        while the disk images are not in use.
+
+        old_servers: a list of the metadata servers removed from the
+            metadata_servers parameter.
+
+        Return values: A list of (IMAGE_NAME, SOURCE_SERVER,
+            DESTINATION_SERVER) tuples of the moved disk images.
+        '''
+        assert False
+
     def join_reader(self, image_name, node):
         assert False
 
@@ -59,6 +187,15 @@ class UKAIDB(object):
     def get_readers(self, image_name):
         assert False
 
+    def join_writer(self, image_name, node):
+        assert False
+
+    def leave_writer(self, image_name, node):
+        assert False
+
+    def get_writers(self, image_name):
+        assert False
+
     def get_image_names(self):
         assert False
 
@@ -66,85 +203,400 @@ UKAI_REDIS_DB_LOCKS_DIR    = '/ukai/metadata/locks'
 UKAI_REDIS_DB_CONTENTS_DIR = '/ukai/metadata/contents'
 UKAI_REDIS_DB_READERS_DIR  = '/ukai/metadata/readers'
 UKAI_REDIS_DB_WRITERS_DIR  = '/ukai/metadata/writers'
+UKAI_REDIS_DB_SEGMENTS_DIR = '/ukai/metadata/segments'
+UKAI_REDIS_DB_IMAGES_INDEX = '/ukai/metadata/images'
+UKAI_REDIS_DB_CHANGES_CHANNEL = '/ukai/metadata/changes'
+UKAI_REDIS_DB_UPDATES_CHANNEL = '/ukai/metadata/updates'
+UKAI_REDIS_DB_RESUBSCRIBE_INTERVAL = 1
+UKAI_REDIS_DB_PORT = 6379
 class UKAIRedisDB(UKAIDB):
+    '''The UKAIRedisDB class provides an interface class to the Redis
+    server.
+
+    The metadata can be distributed to multiple Redis servers.  All
+    the keys of a disk image are stored in the server the image name
+    is mapped to by a consistent hash ring, and each server has its
+    own connection pool.  When servers are added or removed, the
+    rebalance_metadata method moves the keys to the servers they are
+    newly mapped to.
+
+    No distributed lock is used.  Each value is read by a single GET
+    command and written by a single SET command, which are atomic.
+    Read-modify-write operations are done in a MULTI/EXEC transaction
+    and retried if the key is modified by others during the operation
+    (WATCH).
+
+    The readers and writers of each disk image are kept in sets, and
+    the names of the disk images stored in each server are kept in
+    the UKAI_REDIS_DB_IMAGES_INDEX set of the server, so that they
+    are modified without any transaction.
+
+    The name of a disk image is published to the
+    UKAI_REDIS_DB_CHANGES_CHANNEL channel of the server when its
+    metadata is modified.  The updates of the metadata of each image
+    are published to the UKAI_REDIS_DB_UPDATES_CHANNEL/IMAGE_NAME
+    channel.
+    '''
     def __init__(self):
         super(UKAIRedisDB, self).__init__()
+        self._ring = None
+        # server => a Redis client.
+        self._clients = {}
+        # server => {channel name => a function which handles messages}.
+        self._handlers = {}
+        self._handlers_lock = threading.Lock()
+        # server => a PubSub instance.
+        self._pubsubs = {}
+        # server => a subscriber thread.
+        self._subscribers = {}
 
     def connect(self, config):
-        self._servers = config.get('metadata_servers')
-        self._conn_pool = redis.ConnectionPool(host=self._servers)
-        self._client = redis.Redis(connection_pool=self._conn_pool)
+        self._set_format(config)
+        self._servers = self._get_servers(config)
+        self._ring = UKAIHashRing(self._servers)
+        for server in self._servers:
+            self._clients[server] = self._open_client(server)
+            if not self._clients[server].exists(UKAI_REDIS_DB_IMAGES_INDEX):
+                self._build_image_index(self._clients[server])
+
+    def _open_client(self, server):
+        '''
+        Returns a Redis client which has its own connection pool.
+
+        param server: an address, or an address and a port number
+            separated by a colon.
+        '''
+        (host, sep, port) = server.partition(':')
+        if len(port) == 0:
+            port = UKAI_REDIS_DB_PORT
+        conn_pool = redis.ConnectionPool(host=host, port=int(port))
+        return (redis.Redis(connection_pool=conn_pool))
+
+    def _get_client(self, image_name):
+        return (self._clients[self._ring.get_node(image_name)])
+
+    def _build_image_index(self, client):
+        '''
+        Adds the names of the disk images created by older versions,
+        which don't maintain the index set, to the index set.
+        '''
+        prefix = UKAI_REDIS_DB_CONTENTS_DIR + '/'
+        image_names = [contents_file[len(prefix):] for contents_file
+                       in client.scan_iter(prefix + '*')]
+        if len(image_names) > 0:
+            client.sadd(UKAI_REDIS_DB_IMAGES_INDEX, *image_names)
+
+    def _set_command(self, client, command, key, *args):
+        '''
+        Executes a set command.  If the key holds a JSON list written
+        by older versions, the list is converted to a set first.
+        '''
+        try:
+            return getattr(client, command)(key, *args)
+        except redis.ResponseError, e:
+            if not str(e).startswith('WRONGTYPE'):
+                raise
+        with client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    if pipe.type(key) == 'string':
+                        members = json.loads(pipe.get(key))
+                        pipe.multi()
+                        pipe.delete(key)
+                        if len(members) > 0:
+                            pipe.sadd(key, *members)
+                        pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        return getattr(client, command)(key, *args)
+
+    def _update(self, client, key, update):
+        '''
+        Updates the value of the key atomically.  The update function
+        receives the current value (None if the key doesn't exist)
+        and returns a (new_value, result) tupple.  If new_value is
+        None, the key is deleted.  The function may be called more
+        than once if the key is modified by others.
+
+        Return values: The result value returned by the update
+            function.
+        '''
+        with client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    (value, result) = update(pipe.get(key))
+                    pipe.multi()
+                    if value is None:
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, value)
+                    pipe.execute()
+                    return result
+                except redis.WatchError:
+                    continue
+
+    def _subscribe(self, server, channel, handler):
+        '''
+        Registers a function which is called with the data of every
+        message published to the channel of the server.  The function
+        is called with None when the subscription starts, since
+        messages published before that are missed.
+        '''
+        try:
+            self._handlers_lock.acquire()
+            self._handlers.setdefault(server, {})[channel] = handler
+            if server not in self._subscribers:
+                self._subscribers[server] = threading.Thread(
+                    target=self._run_subscriber, args=(server,))
+                self._subscribers[server].daemon = True
+                self._subscribers[server].start()
+            elif server in self._pubsubs:
+                self._pubsubs[server].subscribe(channel)
+        finally:
+            self._handlers_lock.release()
+
+    def _unsubscribe(self, server, channel):
+        try:
+            self._handlers_lock.acquire()
+            if channel not in self._handlers.get(server, {}):
+                return
+            del self._handlers[server][channel]
+            if server in self._pubsubs:
+                self._pubsubs[server].unsubscribe(channel)
+        finally:
+            self._handlers_lock.release()
+
+    def _run_subscriber(self, server):
+        while True:
+            try:
+                self._handlers_lock.acquire()
+                pubsub = self._clients[server].pubsub()
+                pubsub.subscribe(*self._handlers[server].keys())
+                self._pubsubs[server] = pubsub
+            finally:
+                self._handlers_lock.release()
+            try:
+                for message in pubsub.listen():
+                    if message['type'] not in ('subscribe', 'message'):
+                        continue
+                    handler = self._handlers[server].get(message['channel'])
+                    if handler is None:
+                        continue
+                    if message['type'] == 'subscribe':
+                        handler(None)
+                    else:
+                        handler(message['data'])
+            except redis.ConnectionError, e:
+                print ('Lost the subscription to the metadata server %s: %s'
+                       % (server, e))
+            try:
+                self._handlers_lock.acquire()
+                del self._pubsubs[server]
+                handlers = self._handlers[server].values()
+            finally:
+                self._handlers_lock.release()
+            for handler in handlers:
+                handler(None)
+            time.sleep(UKAI_REDIS_DB_RESUBSCRIBE_INTERVAL)
+
+    def watch_metadata(self, callback):
+        self._metadata_callback = callback
+        for server in self._servers:
+            self._subscribe(server, UKAI_REDIS_DB_CHANGES_CHANNEL, callback)
+
+    def publish_metadata_update(self, image_name, message):
+        try:
+            self._get_client(image_name).publish(
+                UKAI_REDIS_DB_UPDATES_CHANNEL + '/' + image_name, message)
+        except redis.RedisError, e:
+            print e.__class__
+            print 'Failed to publish the metadata update of %s.' % image_name
+
+    def subscribe_metadata_updates(self, image_name, callback):
+        self._subscribe(self._ring.get_node(image_name),
+                        UKAI_REDIS_DB_UPDATES_CHANNEL + '/' + image_name,
+                        lambda message: callback(image_name, message))
+
+    def unsubscribe_metadata_updates(self, image_name):
+        self._unsubscribe(self._ring.get_node(image_name),
+                          UKAI_REDIS_DB_UPDATES_CHANNEL + '/' + image_name)
+
+    def _publish_metadata_changed(self, image_name, pipe=None):
+        if pipe is None:
+            pipe = self._get_client(image_name)
+        pipe.publish(UKAI_REDIS_DB_CHANGES_CHANNEL, image_name)
 
     def put_metadata(self, image_name, metadata):
         contents_file = UKAI_REDIS_DB_CONTENTS_DIR + '/' + image_name
-        lock_file = UKAI_REDIS_DB_LOCKS_DIR + '/' + image_name
-        with self._client.lock(lock_file):
-            self._client.set(contents_file, json.dumps(metadata))
+        pipe = self._get_client(image_name).pipeline(transaction=True)
+        pipe.set(contents_file, ukai_metadata_encode(metadata, self._format))
+        pipe.sadd(UKAI_REDIS_DB_IMAGES_INDEX, image_name)
+        pipe.execute()
+        self._notify_metadata_changed(image_name)
+        self._publish_metadata_changed(image_name)
 
     def get_metadata(self, image_name):
         contents_file = UKAI_REDIS_DB_CONTENTS_DIR + '/' + image_name
-        lock_file = UKAI_REDIS_DB_LOCKS_DIR + '/' + image_name
         ret = None
-        with self._client.lock(lock_file):
-            ret_json = self._client.get(contents_file)
-            if ret_json is not None:
-                ret = json.loads(ret_json)
+        ret_encoded = self._get_client(image_name).get(contents_file)
+        if ret_encoded is not None:
+            ret = ukai_metadata_decode(ret_encoded)
+        return ret
+
+    def convert_metadata(self, image_name, format):
+        contents_file = UKAI_REDIS_DB_CONTENTS_DIR + '/' + image_name
+        def convert(encoded):
+            if encoded is None:
+                return (None, None)
+            old_format = ukai_metadata_format(encoded)
+            if (old_format != format
+                and old_format != UKAI_METADATA_FORMAT_SEGMENTED):
+                encoded = ukai_metadata_encode(ukai_metadata_decode(encoded),
+                                               format)
+            return (encoded, old_format)
+        old_format = self._update(self._get_client(image_name),
+                                  contents_file, convert)
+        if old_format is not None:
+            self._notify_metadata_changed(image_name)
+            self._publish_metadata_changed(image_name)
+        return old_format
+
+    def put_metadata_segments(self, image_name, metadata, segment_size,
+                              segments):
+        contents_file = UKAI_REDIS_DB_CONTENTS_DIR + '/' + image_name
+        segments_dir = UKAI_REDIS_DB_SEGMENTS_DIR + '/' + image_name
+        # The segments and the header are written in one transaction.
+        pipe = self._get_client(image_name).pipeline(transaction=True)
+        for (segment_idx, segment) in segments.items():
+            pipe.set(segments_dir + '/' + str(segment_idx),
+                     ukai_metadata_encode_segment(segment))
+        pipe.set(contents_file,
+                 ukai_metadata_encode_header(metadata, segment_size))
+        pipe.sadd(UKAI_REDIS_DB_IMAGES_INDEX, image_name)
+        self._publish_metadata_changed(image_name, pipe)
+        pipe.execute()
+        self._notify_metadata_changed(image_name)
+
+    def get_metadata_segment(self, image_name, segment_idx):
+        segment_file = (UKAI_REDIS_DB_SEGMENTS_DIR + '/' + image_name
+                        + '/' + str(segment_idx))
+        ret = None
+        ret_encoded = self._get_client(image_name).get(segment_file)
+        if ret_encoded is not None:
+            ret = ukai_metadata_decode_segment(ret_encoded)
         return ret
 
     def delete_metadata(self, image_name):
+        client = self._get_client(image_name)
         contents_file = UKAI_REDIS_DB_CONTENTS_DIR + '/' + image_name
-        lock_file = UKAI_REDIS_DB_LOCKS_DIR + '/' + image_name
-        with self._client.lock(lock_file):
-            if self._client.exists(contents_file) is False:
-                return
-            self._client.delete(contents_file)
+        segments_dir = UKAI_REDIS_DB_SEGMENTS_DIR + '/' + image_name
+        segment_files = list(client.scan_iter(segments_dir + '/*'))
+        pipe = client.pipeline(transaction=True)
+        pipe.delete(contents_file, *segment_files)
+        pipe.srem(UKAI_REDIS_DB_IMAGES_INDEX, image_name)
+        pipe.execute()
+        self._notify_metadata_changed(image_name)
+        self._publish_metadata_changed(image_name)
+
+    def rebalance_metadata(self, old_servers=None):
+        client_dict = dict(self._clients)
+        if old_servers is not None:
+            for server in old_servers:
+                if server not in client_dict:
+                    client_dict[server] = self._open_client(server)
+        prefix = UKAI_REDIS_DB_CONTENTS_DIR + '/'
+        moved = []
+        for (server, client) in client_dict.items():
+            image_names = set(client.smembers(UKAI_REDIS_DB_IMAGES_INDEX))
+            image_names.update([contents_file[len(prefix):]
+                                for contents_file
+                                in client.scan_iter(prefix + '*')])
+            for image_name in image_names:
+                destination = self._ring.get_node(image_name)
+                if destination == server:
+                    continue
+                self._move_image(image_name, client,
+                                 self._clients[destination])
+                moved.append((image_name, server, destination))
+        return (moved)
+
+    def _move_image(self, image_name, src_client, dst_client):
+        '''
+        Moves all the keys of the disk image from a server to another.
+        If the destination server has the metadata of the image
+        already, it is newer than the one of the source server, and
+        the keys of the source server are just deleted.
+        '''
+        contents_file = UKAI_REDIS_DB_CONTENTS_DIR + '/' + image_name
+        segments_dir = UKAI_REDIS_DB_SEGMENTS_DIR + '/' + image_name
+        keys = [contents_file,
+                UKAI_REDIS_DB_READERS_DIR + '/' + image_name,
+                UKAI_REDIS_DB_WRITERS_DIR + '/' + image_name]
+        keys.extend(src_client.scan_iter(segments_dir + '/*'))
+        if not dst_client.exists(contents_file):
+            pipe = dst_client.pipeline(transaction=True)
+            for key in keys:
+                # The values are either strings or sets.
+                key_type = src_client.type(key)
+                if key_type == 'string':
+                    pipe.set(key, src_client.get(key))
+                elif key_type == 'set':
+                    pipe.delete(key)
+                    pipe.sadd(key, *src_client.smembers(key))
+            pipe.sadd(UKAI_REDIS_DB_IMAGES_INDEX, image_name)
+            self._publish_metadata_changed(image_name, pipe)
+            pipe.execute()
+        pipe = src_client.pipeline(transaction=True)
+        pipe.delete(*keys)
+        pipe.srem(UKAI_REDIS_DB_IMAGES_INDEX, image_name)
+        pipe.execute()
+        self._notify_metadata_changed(image_name)
 
     def join_reader(self, image_name, node):
         readers_file = UKAI_REDIS_DB_READERS_DIR + '/' + image_name
-        lock_file = UKAI_REDIS_DB_LOCKS_DIR + '/' + image_name
-        with self._client.lock(lock_file):
-            readers = []
-            readers_json = self._client.get(readers_file)
-            if readers_json is not None:
-                readers = json.loads(readers_json)
-            if node not in readers:
-                readers.append(node)
-            self._client.set(readers_file, json.dumps(readers))
+        self._set_command(self._get_client(image_name), 'sadd',
+                          readers_file, node)
 
     def leave_reader(self, image_name, node):
-        readers_file = UKAI_ZK_DB_READERS_DIR + '/' + image_name
-        lock_file = UKAI_REDIS_DB_LOCKS_DIR + '/' + image_name
-        with self._client.lock(lock_file):
-            if self._client.exists(readers_file) is None:
-                return
-            readers_json = self._client.get(readers_file)
-            readers = json.loads(readers_json)
-            if node in readers:
-                readers.remove(node)
-                if len(readers) == 0:
-                    self._client.delete(readers_file)
-                else:
-                    self._client.set(readers_file, json.dumps(readers))
+        readers_file = UKAI_REDIS_DB_READERS_DIR + '/' + image_name
+        self._set_command(self._get_client(image_name), 'srem',
+                          readers_file, node)
 
     def get_readers(self, image_name):
         readers_file = UKAI_REDIS_DB_READERS_DIR + '/' + image_name
-        lock_file = UKAI_REDIS_DB_LOCKS_DIR + '/' + image_name
-        with self._client.lock(lock_file):
-            readers = []
-            readers_json = self._client.get(readers_file)
-            if readers_json is not None:
-                readers = json.loads(readers_json)
-            return readers
+        return list(self._set_command(self._get_client(image_name),
+                                      'smembers', readers_file))
+
+    def join_writer(self, image_name, node):
+        writers_file = UKAI_REDIS_DB_WRITERS_DIR + '/' + image_name
+        self._set_command(self._get_client(image_name), 'sadd',
+                          writers_file, node)
+
+    def leave_writer(self, image_name, node):
+        writers_file = UKAI_REDIS_DB_WRITERS_DIR + '/' + image_name
+        self._set_command(self._get_client(image_name), 'srem',
+                          writers_file, node)
+
+    def get_writers(self, image_name):
+        writers_file = UKAI_REDIS_DB_WRITERS_DIR + '/' + image_name
+        return list(self._set_command(self._get_client(image_name),
+                                      'smembers', writers_file))
 
     def get_image_names(self):
-        keys = self._client.keys(UKAI_REDIS_DB_CONTENTS_DIR + '*')
-        return [image_name[len(UKAI_REDIS_DB_CONTENTS_DIR) + 1:]
-                for image_name in keys]
+        image_names = set()
+        for client in self._clients.values():
+            image_names.update(client.smembers(UKAI_REDIS_DB_IMAGES_INDEX))
+        return list(image_names)
 
 UKAI_ZK_DB_LOCKS_DIR    = '/ukai/metadata/locks'
 UKAI_ZK_DB_CONTENTS_DIR = '/ukai/metadata/contents'
 UKAI_ZK_DB_READERS_DIR  = '/ukai/metadata/readers'
 UKAI_ZK_DB_WRITERS_DIR  = '/ukai/metadata/writers'
+UKAI_ZK_DB_SEGMENTS_DIR = '/ukai/metadata/segments'
+UKAI_ZK_DB_UPDATES_DIR  = '/ukai/metadata/updates'
 class UKAIZooKeeperDB(UKAIDB):
     '''The UKAIZooKeeperDB class provides an interface class to the
     ZooKeeper cluster.
@@ -154,27 +606,133 @@ class UKAIZooKeeperDB(UKAIDB):
     /metadata/locks/IMAGE_NAMES
       IMAGE_NAMES are lock objects.
     /metadata/contents/IMAGE_NAMES
-      each IMAGE_NAME has a JSON style metadata string.
-    /metadata/readers/IMAGE_NAMES
-      each IMAGE_NAME contains a list of IP addresses who open the disk
-      image with a read right.
-    /metadata/writers/IMAGE_NAMES
-      each IMAGE_NAME contains an IP address who opens the disk image
-      with a writing right.
+      each IMAGE_NAME has a metadata string encoded by the
+      ukai_metadata_encode or the ukai_metadata_encode_header
+      function.
+    /metadata/segments/IMAGE_NAMES/SEGMENT_INDICES
+      each SEGMENT_INDEX has a segment string of the metadata
+      encoded by the ukai_metadata_encode_segment function.
+    /metadata/readers/IMAGE_NAMES/NODES
+      each IMAGE_NAME has an ephemeral child node for each IP address
+      who opens the disk image with a read right.  The JSON list of
+      the IP addresses stored in IMAGE_NAME by older versions is
+      converted to persistent child nodes.
+    /metadata/writers/IMAGE_NAMES/NODES
+      each IMAGE_NAME has an ephemeral child node for each IP address
+      who opens the disk image with a writing right.
+    /metadata/updates/IMAGE_NAMES
+      each IMAGE_NAME contains the latest message published by the
+      publish_metadata_update method.
+
+    The modification of the metadata is notified by a watch which is
+    set when the metadata is read.
     '''
     def __init__(self):
         super(UKAIZooKeeperDB, self).__init__()
         self._lock = threading.Lock()
+        # image name => a function which handles update messages.
+        self._update_callbacks = {}
+        self._connected = True
+        # The (function, arguments) tupples called by the dispatcher
+        # thread.  The callbacks must not be called from the event
+        # thread of kazoo, which delivers the watch events the kazoo
+        # operations of the callbacks wait for.
+        self._events = Queue.Queue()
+        self._dispatcher = None
+        # The (set directory, node) tuples joined by this node, which
+        # are created again when the ephemeral nodes are lost with
+        # the session.
+        self._joined_sets = set()
+        # The set directories already checked for the JSON list of
+        # older versions.
+        self._converted_sets = set()
 
     def connect(self, config):
-        self._servers = config.get('metadata_servers')
-        self._client = kazoo.client.KazooClient(hosts=self._servers)
+        self._set_format(config)
+        self._servers = self._get_servers(config)
+        self._client = kazoo.client.KazooClient(hosts=','.join(self._servers))
         self._client.start()
 
         self._client.ensure_path(UKAI_ZK_DB_LOCKS_DIR)
         self._client.ensure_path(UKAI_ZK_DB_CONTENTS_DIR)
         self._client.ensure_path(UKAI_ZK_DB_READERS_DIR)
         self._client.ensure_path(UKAI_ZK_DB_WRITERS_DIR)
+        self._client.ensure_path(UKAI_ZK_DB_SEGMENTS_DIR)
+        self._client.ensure_path(UKAI_ZK_DB_UPDATES_DIR)
+        self._client.add_listener(self._state_listener)
+        self._dispatcher = threading.Thread(target=self._run_dispatcher)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def _run_dispatcher(self):
+        while True:
+            (function, args) = self._events.get()
+            try:
+                function(*args)
+            except Exception, e:
+                print e.__class__
+                print 'Failed to handle a metadata event: %s' % e
+
+    def watch_metadata(self, callback):
+        self._metadata_callback = callback
+
+    def _state_listener(self, state):
+        # The watches may be lost while the session is not connected.
+        if state != kazoo.client.KazooState.CONNECTED:
+            self._connected = False
+            if self._metadata_callback is not None:
+                self._metadata_callback(None)
+            return
+        if self._connected is True:
+            return
+        self._connected = True
+        # The ephemeral nodes are lost if the session has expired, and
+        # messages may have been missed while disconnected.  The
+        # listener must not block, the nodes are created and the
+        # subscribers are called from the dispatcher thread.
+        self._events.put((self._rejoin_sets, ()))
+        for (image_name, callback) in self._update_callbacks.items():
+            self._events.put((callback, (image_name, None)))
+
+    def publish_metadata_update(self, image_name, message):
+        updates_file = UKAI_ZK_DB_UPDATES_DIR + '/' + image_name
+        try:
+            self._lock.acquire()
+            if self._client.exists(updates_file) is None:
+                self._client.create(updates_file, message)
+            else:
+                self._client.set(updates_file, message)
+        except kazoo.exceptions.KazooException, e:
+            print e.__class__
+            print 'Failed to publish the metadata update of %s.' % image_name
+        finally:
+            self._lock.release()
+
+    def subscribe_metadata_updates(self, image_name, callback):
+        updates_file = UKAI_ZK_DB_UPDATES_DIR + '/' + image_name
+        self._update_callbacks[image_name] = callback
+        def watch(data, stat):
+            if self._update_callbacks.get(image_name) is not callback:
+                # unsubscribed.
+                return False
+            if watch.started is False:
+                # The first call reports the current data, which is
+                # older than the metadata the subscriber has just
+                # read.  It is made from the DataWatch constructor in
+                # the caller's thread, and is ignored.
+                watch.started = True
+            elif data is not None:
+                self._events.put((callback, (image_name, data)))
+        watch.started = False
+        self._client.DataWatch(updates_file, watch)
+
+    def unsubscribe_metadata_updates(self, image_name):
+        if image_name in self._update_callbacks:
+            del self._update_callbacks[image_name]
+
+    def _contents_watch(self, event):
+        self._metadata_callback(event.path[len(UKAI_ZK_DB_CONTENTS_DIR)
+                                           + 1:])
 
     def put_metadata(self, image_name, metadata):
         contents_file = UKAI_ZK_DB_CONTENTS_DIR + '/' + image_name
@@ -185,26 +743,34 @@ class UKAIZooKeeperDB(UKAIDB):
             with lock:
                 if self._client.exists(contents_file) is None:
                     self._client.create(contents_file)
-                self._client.set(contents_file, json.dumps(metadata))
+                self._client.set(contents_file,
+                                 ukai_metadata_encode(metadata,
+                                                      self._format))
         finally:
             self._lock.release()
+        self._notify_metadata_changed(image_name)
 
     def get_metadata(self, image_name):
         contents_file = UKAI_ZK_DB_CONTENTS_DIR + '/' + image_name
         ret = None
+        watch = None
+        if self._metadata_callback is not None:
+            watch = self._contents_watch
         try:
             self._lock.acquire()
             lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR,
                                      image_name)
             with lock:
-                if self._client.exists(contents_file) is not None:
-                    ret_json = self._client.get(contents_file)[0]
-                    ret = json.loads(ret_json)
+                if self._client.exists(contents_file,
+                                       watch=watch) is not None:
+                    ret_encoded = self._client.get(contents_file,
+                                                   watch=watch)[0]
+                    ret = ukai_metadata_decode(ret_encoded)
         finally:
             self._lock.release()
         return ret
 
-    def delete_metadata(self, image_name):
+    def convert_metadata(self, image_name, format):
         contents_file = UKAI_ZK_DB_CONTENTS_DIR + '/' + image_name
         try:
             self._lock.acquire()
@@ -212,61 +778,159 @@ class UKAIZooKeeperDB(UKAIDB):
                                      image_name)
             with lock:
                 if self._client.exists(contents_file) is None:
-                    return
-                self._client.delete(contents_file)
+                    return None
+                encoded = self._client.get(contents_file)[0]
+                old_format = ukai_metadata_format(encoded)
+                if (old_format != format
+                    and old_format != UKAI_METADATA_FORMAT_SEGMENTED):
+                    self._client.set(contents_file, ukai_metadata_encode(
+                            ukai_metadata_decode(encoded), format))
         finally:
             self._lock.release()
+        self._notify_metadata_changed(image_name)
+        return old_format
 
-    def join_reader(self, image_name, node):
-        readers_file = UKAI_ZK_DB_READERS_DIR + '/' + image_name
+    def put_metadata_segments(self, image_name, metadata, segment_size,
+                              segments):
+        contents_file = UKAI_ZK_DB_CONTENTS_DIR + '/' + image_name
+        segments_dir = UKAI_ZK_DB_SEGMENTS_DIR + '/' + image_name
         try:
             self._lock.acquire()
-            lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR, image_name)
+            lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR,
+                                     image_name)
             with lock:
-                readers = []
-                if self._client.exists(readers_file) is None:
-                    self._client.create(readers_file)
-                else:
-                    readers_json = self._client.get(readers_file)[0]
-                    readers = json.loads(readers_json)
-                if node not in readers:
-                    readers.append(node)
-                self._client.set(readers_file, json.dumps(readers))
+                self._client.ensure_path(segments_dir)
+                for (segment_idx, segment) in segments.items():
+                    segment_file = segments_dir + '/' + str(segment_idx)
+                    if self._client.exists(segment_file) is None:
+                        self._client.create(segment_file)
+                    self._client.set(segment_file,
+                                     ukai_metadata_encode_segment(segment))
+                if self._client.exists(contents_file) is None:
+                    self._client.create(contents_file)
+                self._client.set(contents_file,
+                                 ukai_metadata_encode_header(metadata,
+                                                             segment_size))
         finally:
             self._lock.release()
+        self._notify_metadata_changed(image_name)
 
-    def leave_reader(self, image_name, node):
-        readers_file = UKAI_ZK_DB_READERS_DIR + '/' + image_name
+    def get_metadata_segment(self, image_name, segment_idx):
+        segment_file = (UKAI_ZK_DB_SEGMENTS_DIR + '/' + image_name
+                        + '/' + str(segment_idx))
+        ret = None
         try:
             self._lock.acquire()
-            lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR, image_name)
+            lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR,
+                                     image_name)
+            with lock:
+                if self._client.exists(segment_file) is not None:
+                    ret_encoded = self._client.get(segment_file)[0]
+                    ret = ukai_metadata_decode_segment(ret_encoded)
+        finally:
+            self._lock.release()
+        return ret
+
+    def delete_metadata(self, image_name):
+        contents_file = UKAI_ZK_DB_CONTENTS_DIR + '/' + image_name
+        segments_dir = UKAI_ZK_DB_SEGMENTS_DIR + '/' + image_name
+        updates_file = UKAI_ZK_DB_UPDATES_DIR + '/' + image_name
+        try:
+            self._lock.acquire()
+            lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR,
+                                     image_name)
             with lock:
-                if self._client.exists(readers_file) is None:
+                if self._client.exists(segments_dir) is not None:
+                    self._client.delete(segments_dir, recursive=True)
+                if self._client.exists(updates_file) is not None:
+                    self._client.delete(updates_file)
+                if self._client.exists(contents_file) is None:
                     return
-                readers_json = self._client.get(readers_file)[0]
-                readers = json.loads(readers_json)
-                if node in readers:
-                    readers.remove(node)
-                    if len(readers) == 0:
-                        self._client.delete(readers_file)
-                    else:
-                        self._client.set(readers_file, json.dumps(readers))
+                self._client.delete(contents_file)
         finally:
             self._lock.release()
+        self._notify_metadata_changed(image_name)
 
-    def get_readers(self, image_name):
-        readers_file = UKAI_ZK_DB_READERS_DIR + '/' + image_name
+    def rebalance_metadata(self, old_servers=None):
+        # All the servers of a ZooKeeper ensemble have the same data.
+        return ([])
+
+    def _convert_set(self, set_dir):
+        '''
+        Converts the JSON list stored in the set directory by older
+        versions to child nodes.  The converted members are
+        persistent, since the nodes which joined are unknown.
+        '''
+        if set_dir in self._converted_sets:
+            return
         try:
             self._lock.acquire()
-            lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR, image_name)
+            lock = self._client.Lock(UKAI_ZK_DB_LOCKS_DIR,
+                                     set_dir.rsplit('/', 1)[1])
             with lock:
-                readers = []
-                if self._client.exists(readers_file) is not None:
-                    readers_json = self._client.get(readers_file)[0]
-                    readers = json.loads(readers_json)
-                return readers
+                try:
+                    members_json = self._client.get(set_dir)[0]
+                except kazoo.exceptions.NoNodeError:
+                    members_json = None
+                if members_json:
+                    for member in json.loads(members_json):
+                        try:
+                            self._client.create(set_dir + '/' + member)
+                        except kazoo.exceptions.NodeExistsError:
+                            pass
+                    self._client.set(set_dir, '')
         finally:
             self._lock.release()
+        self._converted_sets.add(set_dir)
+
+    def _join_set(self, set_dir, node):
+        self._convert_set(set_dir)
+        self._joined_sets.add((set_dir, node))
+        self._create_member(set_dir, node)
+
+    def _create_member(self, set_dir, node):
+        try:
+            self._client.ensure_path(set_dir)
+            self._client.create(set_dir + '/' + node, ephemeral=True)
+        except kazoo.exceptions.NodeExistsError:
+            pass
+
+    def _rejoin_sets(self):
+        for (set_dir, node) in list(self._joined_sets):
+            self._create_member(set_dir, node)
+
+    def _leave_set(self, set_dir, node):
+        self._convert_set(set_dir)
+        self._joined_sets.discard((set_dir, node))
+        try:
+            self._client.delete(set_dir + '/' + node)
+        except kazoo.exceptions.NoNodeError:
+            pass
+
+    def _get_set(self, set_dir):
+        self._convert_set(set_dir)
+        try:
+            return self._client.get_children(set_dir)
+        except kazoo.exceptions.NoNodeError:
+            return []
+
+    def join_reader(self, image_name, node):
+        self._join_set(UKAI_ZK_DB_READERS_DIR + '/' + image_name, node)
+
+    def leave_reader(self, image_name, node):
+        self._leave_set(UKAI_ZK_DB_READERS_DIR + '/' + image_name, node)
+
+    def get_readers(self, image_name):
+        return self._get_set(UKAI_ZK_DB_READERS_DIR + '/' + image_name)
+
+    def join_writer(self, image_name, node):
+        self._join_set(UKAI_ZK_DB_WRITERS_DIR + '/' + image_name, node)
+
+    def leave_writer(self, image_name, node):
+        self._leave_set(UKAI_ZK_DB_WRITERS_DIR + '/' + image_name, node)
+
+    def get_writers(self, image_name):
+        return self._get_set(UKAI_ZK_DB_WRITERS_DIR + '/' + image_name)
 
     def get_image_names(self):
         try:
@@ -278,13 +942,79 @@ class UKAIZooKeeperDB(UKAIDB):
 # ukai_db_client = UKAIZooKeeperDB()
 ukai_db_client = UKAIRedisDB()
 
+def _ukai_redis_db_benchmark(db, count):
+    '''
+    Compares the number of operations per second of the lock-free
+    access of the UKAIRedisDB class with the access protected by the
+    distributed lock.
+    '''
+    import time
+
+    image_name = 'benchmark'
+    contents_file = UKAI_REDIS_DB_CONTENTS_DIR + '/' + image_name
+    readers_file = UKAI_REDIS_DB_READERS_DIR + '/' + image_name
+    lock_file = UKAI_REDIS_DB_LOCKS_DIR + '/' + image_name
+    client = db._get_client(image_name)
+    db.put_metadata(image_name,
+                    {'name': image_name, 'size': 1000, 'used_size': 1000,
+                     'block_size': 1,
+                     'blocks': [{'192.168.1.1': {'sync_status': 0}}
+                                for blk_idx in range(0, 1000)]})
+
+    def locked_get_metadata():
+        with client.lock(lock_file):
+            ukai_metadata_decode(client.get(contents_file))
+
+    def locked_join_leave_reader():
+        for update in (lambda readers: readers + ['192.168.1.1'],
+                       lambda readers: []):
+            with client.lock(lock_file):
+                readers = []
+                readers_json = client.get(readers_file)
+                if readers_json is not None:
+                    readers = json.loads(readers_json)
+                readers = update(readers)
+                if len(readers) == 0:
+                    client.delete(readers_file)
+                else:
+                    client.set(readers_file, json.dumps(readers))
+
+    def join_leave_reader():
+        db.join_reader(image_name, '192.168.1.1')
+        db.leave_reader(image_name, '192.168.1.1')
+
+    for (name, locked_func, func) in (
+        ('get_metadata', locked_get_metadata,
+         lambda: db.get_metadata(image_name)),
+        ('join_reader/leave_reader', locked_join_leave_reader,
+         join_leave_reader)):
+        for (scheme, target) in (('locked', locked_func),
+                                 ('lock-free', func)):
+            start_time = time.time()
+            for i in range(0, count):
+                target()
+            elapsed = time.time() - start_time
+            print '%s (%s): %.1f ops/sec' % (name, scheme, count / elapsed)
+
+    db.delete_metadata(image_name)
+
 if __name__ == '__main__':
+    import sys
     from ukai_config import UKAIConfig
     config = UKAIConfig()
 #    db = UKAIZooKeeperDB()
     db = UKAIRedisDB()
     db.connect(config)
-    db.put_metadata('test', 'hoge')
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        count = 1000
+        if len(sys.argv) > 2:
+            count = int(sys.argv[2])
+        _ukai_redis_db_benchmark(db, count)
+        sys.exit(0)
+    db.put_metadata('test', {'name': 'test', 'size': 2, 'used_size': 2,
+                             'block_size': 1,
+                             'blocks': [{'192.168.1.1': {'sync_status': 0}},
+                                        {'192.168.1.1': {'sync_status': 0}}]})
     print db.get_metadata('test')
     print db.get_image_names()
     db.delete_metadata('test')
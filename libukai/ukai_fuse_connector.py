@@ -38,6 +38,7 @@ from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
 from ukai_config import UKAIConfig
 from ukai_rpc import UKAIXMLRPCClient, UKAIXMLRPCTranslation
+from ukai_rpc import ukai_rpc_connection_pool
 
 class UKAIFUSE(LoggingMixIn, Operations):
     ''' The UKAIFUSE class provides a FUSE operation implementation.
@@ -51,6 +52,7 @@ class UKAIFUSE(LoggingMixIn, Operations):
         self._config = config
         self._rpc_client = UKAIXMLRPCClient(self._config)
         self._rpc_trans = UKAIXMLRPCTranslation()
+        ukai_rpc_connection_pool.configure(self._config)
 
     def init(self, path):
         ''' Initializes the FUSE operation.
@@ -82,6 +84,20 @@ class UKAIFUSE(LoggingMixIn, Operations):
         '''
         raise FuseOSError(errno.EPERM)
 
+    def fsync(self, path, datasync, fh):
+        ''' Writes out the pending metadata modifications of a file.
+        The data itself is always written to storage nodes before a
+        write operation returns.
+
+        param path: the path name of a file
+        param datasync: non-zero if only the data is synchronized
+        param fh: the file handle of the file
+        '''
+        ret = self._rpc_client.call('fsync', path)
+        if ret != 0:
+            raise FuseOSError(ret)
+        return 0
+
     def getattr(self, path, fh=None):
         ''' Returns file stat information of a specified file.
 
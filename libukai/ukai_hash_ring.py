@@ -0,0 +1,123 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_hash_ring.py module provides a consistent hash ring which
+maps keys to a set of nodes.  When a node is added or removed, only
+the keys mapped to the node move.
+'''
+
+import bisect
+import hashlib
+
+# The number of points each node has on the ring.
+UKAI_HASH_RING_REPLICAS = 160
+
+def _ukai_hash(key):
+    return (long(hashlib.md5(key).hexdigest()[0:16], 16))
+
+class UKAIHashRing(object):
+    '''
+    The UKAIHashRing class places UKAI_HASH_RING_REPLICAS points of
+    each node on a ring of 64 bit hash values.  A key is mapped to the
+    node which owns the first point at or after the hash value of the
+    key.
+    '''
+    def __init__(self, nodes=None, replicas=UKAI_HASH_RING_REPLICAS):
+        '''
+        Initializes a ring.
+
+        param nodes: a list of node names.
+        param replicas: the number of points of each node.
+        '''
+        self._replicas = replicas
+        self._nodes = []
+        self._points = []
+        self._point_nodes = []
+        if nodes is not None:
+            for node in nodes:
+                self.add_node(node)
+
+    @property
+    def nodes(self):
+        return (list(self._nodes))
+
+    def add_node(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.append(node)
+        for replica in range(0, self._replicas):
+            point = _ukai_hash('%s#%d' % (node, replica))
+            idx = bisect.bisect(self._points, point)
+            self._points.insert(idx, point)
+            self._point_nodes.insert(idx, node)
+
+    def remove_node(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.remove(node)
+        points = []
+        point_nodes = []
+        for (point, point_node) in zip(self._points, self._point_nodes):
+            if point_node != node:
+                points.append(point)
+                point_nodes.append(point_node)
+        self._points = points
+        self._point_nodes = point_nodes
+
+    def get_node(self, key):
+        '''
+        Returns the node the key is mapped to.
+
+        param key: a string.
+
+        Return values: A node name, or None if the ring is empty.
+        '''
+        if len(self._points) == 0:
+            return (None)
+        idx = bisect.bisect_left(self._points, _ukai_hash(key))
+        if idx == len(self._points):
+            idx = 0
+        return (self._point_nodes[idx])
+
+if __name__ == '__main__':
+    import sys
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    ring = UKAIHashRing(['192.0.2.1', '192.0.2.2', '192.0.2.3'])
+    keys = ['image%d' % i for i in range(0, count)]
+    before = dict([(key, ring.get_node(key)) for key in keys])
+    distribution = {}
+    for node in before.values():
+        distribution[node] = distribution.get(node, 0) + 1
+    for (node, num_keys) in sorted(distribution.items()):
+        print '%s: %d keys' % (node, num_keys)
+    ring.add_node('192.0.2.4')
+    moved = len([key for key in keys if ring.get_node(key) != before[key]])
+    print 'added a node: %d of %d keys moved' % (moved, count)
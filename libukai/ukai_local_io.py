@@ -26,9 +26,58 @@
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
 
+import ctypes
+import ctypes.util
 import os
 import shutil
 
+from ukai_statistics import UKAIStatistics
+
+# The size of the chunks compared with zeros by ukai_is_zero().
+UKAI_ZERO_CHUNK_SIZE = 64 * 1024
+
+_ukai_zero_chunk = buffer('\0' * UKAI_ZERO_CHUNK_SIZE)
+
+# The mode flags of fallocate(2) to deallocate a range of a file.
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+try:
+    _ukai_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _ukai_fallocate = _ukai_libc.fallocate64
+    _ukai_fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError):
+    # holes are not punched, and zeros are written instead.
+    _ukai_fallocate = None
+
+def ukai_is_zero(data):
+    '''
+    Returns True if the data is not empty and all the bytes are zero.
+    The first and last bytes are checked first, so that most of the
+    non-zero data is rejected without scanning it.
+    '''
+    size = len(data)
+    if size == 0 or data[:1] != '\0' or data[-1:] != '\0':
+        return (False)
+    for pos in xrange(0, size, UKAI_ZERO_CHUNK_SIZE):
+        length = min(UKAI_ZERO_CHUNK_SIZE, size - pos)
+        if buffer(data, pos, length) != buffer(_ukai_zero_chunk, 0, length):
+            return (False)
+    return (True)
+
+def _ukai_punch_hole(block_path, offset, size):
+    if _ukai_fallocate is None:
+        return (False)
+    fd = os.open(block_path, os.O_WRONLY)
+    try:
+        ret = _ukai_fallocate(fd, FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE,
+                              offset, size)
+    finally:
+        os.close(fd)
+    # the filesystem may not support punching holes.
+    return (ret == 0)
+
 def ukai_local_read(image_name, block_size, block_index, offset, size, config):
     image_path = '%s/%s/' % (config.get('data_root'), image_name)
     block_path = image_path + config.get('blockname_format') % block_index
@@ -51,6 +100,9 @@ def ukai_local_read(image_name, block_size, block_index, offset, size, config):
 
 def ukai_local_write(image_name, block_size, block_index,
                      offset, data, config):
+    if ukai_is_zero(data):
+        return ukai_local_write_zero(image_name, block_size, block_index,
+                                     offset, len(data), config)
     image_path = '%s/%s/' % (config.get('data_root'), image_name)
     block_path = image_path + config.get('blockname_format') % block_index
     if ((not os.path.exists(block_path))
@@ -65,6 +117,35 @@ def ukai_local_write(image_name, block_size, block_index,
 
     return len(data)
 
+def ukai_local_write_zero(image_name, block_size, block_index,
+                          offset, size, config):
+    image_path = '%s/%s/' % (config.get('data_root'), image_name)
+    block_path = image_path + config.get('blockname_format') % block_index
+    if not os.path.exists(block_path):
+        # the data block file is not allocated yet, which is read as
+        # zeros.  leave it as is.
+        _ukai_zero_disk(image_name, size)
+        return size
+    if os.path.getsize(block_path) != block_size:
+        # garbage.  the block is read as zeros without the file.
+        ukai_local_deallocate_dataspace(image_name, block_index, config)
+        _ukai_zero_disk(image_name, size)
+        return size
+    if _ukai_punch_hole(block_path, offset, size):
+        _ukai_zero_disk(image_name, size)
+        return size
+    fh = open(block_path, 'r+')
+    fh.seek(offset)
+    fh.write('\0' * size)
+    fh.close()
+
+    return size
+
+def _ukai_zero_disk(image_name, size):
+    # counted only if the disk image is open on this node.
+    if image_name in UKAIStatistics:
+        UKAIStatistics[image_name].zero_disk(size)
+
 def ukai_local_allocate_dataspace(image_name, block_size, block_index, config):
     image_path = '%s/%s/' % (config.get('data_root'), image_name)
     if not os.path.exists(image_path):
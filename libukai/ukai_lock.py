@@ -0,0 +1,210 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_lock.py module provides reader/writer lock objects to
+protect blocks of a disk image.
+'''
+
+import threading
+import time
+
+# The maximum number of lock objects of a disk image.
+UKAI_LOCK_STRIPES = 1024
+
+class UKAIReadWriteLock(object):
+    '''
+    The UKAIReadWriteLock class provides a lock which can be held by
+    multiple readers or one writer at the same time.  Writers waiting
+    for the lock have priority over new readers, so that writers are
+    not starved by continuous reads.
+    '''
+    def __init__(self):
+        '''
+        Initializes an unlocked instance.
+
+        Return values: This function does not return any values.
+        '''
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        '''
+        Acquires the lock in shared mode.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._cond.acquire()
+            while self._writer or self._waiting_writers > 0:
+                self._cond.wait()
+            self._readers += 1
+        finally:
+            self._cond.release()
+
+    def release_read(self):
+        '''
+        Releases the lock acquired in shared mode.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._cond.acquire()
+            assert self._readers > 0
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def acquire_write(self):
+        '''
+        Acquires the lock in exclusive mode.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._cond.acquire()
+            self._waiting_writers += 1
+            while self._writer or self._readers > 0:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        finally:
+            self._cond.release()
+
+    def release_write(self):
+        '''
+        Releases the lock acquired in exclusive mode.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._cond.acquire()
+            assert self._writer is True
+            self._writer = False
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+class UKAILockManager(object):
+    '''
+    The UKAILockManager class manages reader/writer locks of all the
+    blocks of a disk image.  To keep the number of lock objects
+    constant regardless of the size of a disk image, blocks share a
+    fixed size table of locks.  The lock of a block is chosen by the
+    block index modulo the size of the table.  The locks of a range
+    of blocks are always acquired from the lowest table index to
+    avoid deadlocks.  The time spent for waiting locks is
+    accumulated.
+    '''
+    def __init__(self, num_blocks, num_stripes=UKAI_LOCK_STRIPES):
+        '''
+        Initializes lock objects of the specified number of blocks.
+
+        num_blocks: The number of blocks of a disk image.
+        num_stripes: The maximum number of lock objects.
+
+        Return values: This function does not return any values.
+        '''
+        self._locks = []
+        for stripe_idx in range(0, max(min(num_blocks, num_stripes), 1)):
+            self._locks.append(UKAIReadWriteLock())
+        self._wait_time = 0.0
+        self._wait_count = 0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def wait_time(self):
+        '''
+        The total time in seconds spent for waiting locks.
+        '''
+        return (self._wait_time)
+
+    @property
+    def wait_count(self):
+        '''
+        The number of lock acquisitions.
+        '''
+        return (self._wait_count)
+
+    def acquire(self, start_idx, end_idx, shared=False):
+        '''
+        Acquires the locks of the specified range of blocks.
+
+        start_idx: The first block index to be locked.
+        end_idx: The last block index to be locked.
+        shared: True to acquire the locks in shared mode, False to
+            acquire them in exclusive mode.
+
+        Return values: The time in seconds spent for waiting the
+            locks.
+        '''
+        start_time = time.time()
+        for stripe_idx in self._stripes(start_idx, end_idx):
+            if shared is True:
+                self._locks[stripe_idx].acquire_read()
+            else:
+                self._locks[stripe_idx].acquire_write()
+        wait_time = time.time() - start_time
+        try:
+            self._stats_lock.acquire()
+            self._wait_time += wait_time
+            self._wait_count += 1
+        finally:
+            self._stats_lock.release()
+        return (wait_time)
+
+    def release(self, start_idx, end_idx, shared=False):
+        '''
+        Releases the locks acquired by the acquire() method.
+
+        start_idx: The first block index to be released.
+        end_idx: The last block index to be released.
+        shared: True if the locks were acquired in shared mode.
+
+        Return values: This function does not return any values.
+        '''
+        for stripe_idx in reversed(self._stripes(start_idx, end_idx)):
+            if shared is True:
+                self._locks[stripe_idx].release_read()
+            else:
+                self._locks[stripe_idx].release_write()
+
+    def _stripes(self, start_idx, end_idx):
+        '''
+        Returns a sorted list of the lock table indices covering the
+        specified range of blocks.
+        '''
+        num_stripes = len(self._locks)
+        if end_idx - start_idx + 1 >= num_stripes:
+            return (range(0, num_stripes))
+        return (sorted(set([blk_idx % num_stripes
+                            for blk_idx in range(start_idx, end_idx + 1)])))
@@ -33,14 +33,16 @@ handle metadata information of a UKAI virtual disk image.
 import json
 import sys
 import threading
-import zlib
+import time
+import uuid
 
 import netifaces
 
+from ukai_block_status import UKAIBlockStatusTable
 from ukai_config import UKAIConfig
 from ukai_db import ukai_db_client
-from ukai_rpc import UKAIXMLRPCCall, UKAIXMLRPCTranslation
-from ukai_utils import UKAIIsLocalNode
+from ukai_lock import UKAILockManager
+from ukai_statistics import UKAIStatistics
 
 UKAI_IN_SYNC = 0
 UKAI_SYNCING = 1
@@ -48,7 +50,12 @@ UKAI_OUT_OF_SYNC = 2
 
 UKAI_METADATA_BUCKET = 'metadata'
 
-def ukai_metadata_create(image_name, size, block_size, location, config):
+# The maximum number of sync status changes sent to readers at once.
+# If more blocks are changed, readers fetch the entire metadata.
+UKAI_METADATA_MAX_DELTAS = 10000
+
+def ukai_metadata_create(image_name, size, block_size, location, config,
+                         write_quorum=None):
     ''' The ukai_metadata_create function creates a metadata
     information.
 
@@ -59,12 +66,17 @@ def ukai_metadata_create(image_name, size, block_size, location, config):
     param location: The node address (currently IPv4 numeric
         address only) of initial data store.
     param config: an UKAIConfig instance.
+    param write_quorum: The number of locations which must
+        acknowledge a write operation before returning to the
+        caller.  If None, all the locations must complete the write.
     '''
     metadata_raw = {}
     metadata_raw['name'] = image_name
     metadata_raw['size'] = size
     metadata_raw['used_size'] = size
     metadata_raw['block_size'] = block_size
+    if write_quorum is not None:
+        metadata_raw['write_quorum'] = write_quorum
     metadata_raw['blocks'] = []
     blocks = metadata_raw['blocks']
     for block_num in range(0, size / block_size):
@@ -106,70 +118,391 @@ class UKAIMetadata(object):
         Return values: This function does not return any values.
         '''
         self._config = config
-        self._rpc_trans = UKAIXMLRPCTranslation()
-        if (metadata_raw != None):
-            self._metadata = metadata_raw
-        else:
-            self._metadata = None
-            self._metadata = ukai_db_client.get_metadata(image_name)
+        if (metadata_raw == None):
+            metadata_raw = ukai_db_client.get_metadata(image_name)
+        # The metadata except the block information, and the sync
+        # status table of all the blocks.  If the metadata is stored
+        # in segments, _segment_size is the number of blocks of each
+        # segment, _loaded_segments has a non-zero entry for each
+        # segment loaded into the table, and _dirty_segments is a set
+        # of the segments modified since the last flush.
+        (self._metadata,
+         self._block_status,
+         self._segment_size,
+         self._loaded_segments,
+         self._dirty_segments) = self._split_metadata(metadata_raw)
+        # Incremented when the table is modified by other nodes, so
+        # that the segments being loaded are discarded.
+        self._load_generation = 0
+
+        # Reader/writer locks of each block.
+        self._lock_manager = UKAILockManager(self._block_status.num_blocks)
+        # The lock to protect the metadata contents from being
+        # modified while they are written out.
+        self._update_lock = threading.Lock()
+        # Deferred flush status.  Modifications of the metadata made
+        # by I/O operations are written out together by a timer.
+        self._flush_interval = self._config.get('metadata_flush_interval')
+        self._dirty = False
+        self._flush_timer = None
+        self._dirty_lock = threading.Lock()
+        # Only one flush operation runs at a time, so that readers
+        # receive updates in order.
+        self._flush_lock = threading.Lock()
+        # Sync status changes since the last flush, which are sent to
+        # readers instead of the entire metadata.  If the location
+        # information is changed, readers must fetch the entire
+        # metadata.
+        self._deltas = []
+        self._full_update_required = False
+
+    def mark_dirty(self):
+        '''
+        Records that the metadata has been modified.  If the
+        metadata_flush_interval parameter is configured, the metadata
+        is written out after the interval together with all the other
+        modifications made in the meantime.  Otherwise, the metadata
+        is written out immediately.
+
+        Return values: This function does not return any values.
+        '''
+        if not self._flush_interval > 0:
+            self.flush()
+            return
+        try:
+            self._dirty_lock.acquire()
+            self._dirty = True
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._flush_interval,
+                                                    self._flush_deferred)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        finally:
+            self._dirty_lock.release()
+        if self.name in UKAIStatistics:
+            UKAIStatistics[self.name].metadata_deferred()
+
+    def sync(self):
+        '''
+        Writes out the metadata immediately if it has been modified
+        since the last flush.  When this method returns, all the
+        modifications marked by the mark_dirty method have been
+        written out.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            # Wait for the flush in progress, which may not have
+            # written out the modifications yet.
+            self._flush_lock.acquire()
+            try:
+                self._dirty_lock.acquire()
+                dirty = self._dirty
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+            finally:
+                self._dirty_lock.release()
+            if dirty is True:
+                self._flush_timed()
+        finally:
+            self._flush_lock.release()
 
-        self._lock = []
-        for idx in range(0, len(self.blocks)):
-            self._lock.append(threading.Lock())
+    def _flush_deferred(self):
+        try:
+            self._dirty_lock.acquire()
+            self._flush_timer = None
+            dirty = self._dirty
+        finally:
+            self._dirty_lock.release()
+        if dirty is True:
+            self.flush()
 
     def flush(self):
         '''
         Writes out the latest metadata information stored in memory
-        to the metadata file.
+        to the metadata file.  The block locks are not acquired, so
+        that I/O operations can continue while flushing.  Only the
+        modification of the metadata contents is blocked while the
+        contents are written out.
         '''
         try:
-            self.acquire_lock()
+            self._flush_lock.acquire()
+            self._flush_timed()
+        finally:
+            self._flush_lock.release()
 
-            # Write out to the metadata storage.
-            ukai_db_client.put_metadata(self.name, self._metadata)
+    def _flush_timed(self):
+        # The caller must hold _flush_lock.
+        start_time = time.time()
+        self._flush()
+        if self.name in UKAIStatistics:
+            UKAIStatistics[self.name].metadata_flush(time.time()
+                                                     - start_time)
 
-            # Send the latest metadata information to all the hypervisors
-            # using this virtual disk.
-            for hv in ukai_db_client.get_readers(self.name):
-                if UKAIIsLocalNode(hv):
-                    continue
-                try:
-                    rpc_call = UKAIXMLRPCCall(
-                        hv, self._config.get('core_port'))
-                    rpc_call.call('proxy_update_metadata',
-                                  self.name,
-                                  self._rpc_trans.encode(zlib.compress(json.dumps(self._metadata))))
-                except (IOError, xmlrpclib.Error), e:
-                    print e.__class__
-                    print 'Failed to update metadata at %s.  You cannot migrate a virtual machine to %s' % (hv, hv)
+    def _flush(self):
+        try:
+            self._update_lock.acquire()
+
+            base_version = self.version
+            base_update_id = self.update_id
+            self._metadata['version'] = base_version + 1
+            self._metadata['update_id'] = uuid.uuid4().hex
+            deltas = self._deltas
+            full_update_required = self._full_update_required
+
+            # Write out to the metadata storage.  The status table is
+            # passed as is, so that it is encoded without being
+            # converted to the JSON style representation.  If the
+            # metadata is stored in segments, only the modified
+            # segments are written out.  The modification state is
+            # cleared only after the write succeeds, so that a failed
+            # flush is retried.
+            try:
+                if self._segment_size is None:
+                    metadata_raw = dict(self._metadata)
+                    metadata_raw['blocks'] = self._block_status
+                    ukai_db_client.put_metadata(self.name, metadata_raw)
+                else:
+                    segments = {}
+                    for segment_idx in self._dirty_segments:
+                        (start_idx,
+                         end_idx) = self._get_segment_range(segment_idx)
+                        segments[segment_idx] = self._block_status.slice(
+                            start_idx, end_idx)
+                    ukai_db_client.put_metadata_segments(self.name,
+                                                         self._metadata,
+                                                         self._segment_size,
+                                                         segments)
+            except Exception:
+                self._metadata['version'] = base_version
+                self._metadata['update_id'] = base_update_id
+                raise
+            self._deltas = []
+            self._full_update_required = False
+            self._dirty_segments = set()
+            # The modifications made after this point are blocked
+            # until the update lock is released, and mark the
+            # metadata dirty again.
+            try:
+                self._dirty_lock.acquire()
+                self._dirty = False
+            finally:
+                self._dirty_lock.release()
+
+            if (full_update_required is True
+                or len(deltas) > UKAI_METADATA_MAX_DELTAS):
+                # Readers fetch the entire metadata from the metadata
+                # storage.
+                deltas = None
+            update = json.dumps({'base_version': base_version,
+                                 'base_update_id': base_update_id,
+                                 'version': base_version + 1,
+                                 'update_id': self.update_id,
+                                 'used_size': self.used_size,
+                                 'deltas': deltas})
 
         finally:
-            self.release_lock()
+            self._update_lock.release()
+
+        # Notify all the hypervisors using this virtual disk of the
+        # latest metadata information at once through the metadata
+        # storage.  Only the changes since the last flush are sent
+        # unless the location information is changed.
+        ukai_db_client.publish_metadata_update(self.name, update)
+
+    def apply_deltas(self, version, used_size, deltas, update_id=None):
+        '''
+        Applies sync status changes received from the writer of the
+        disk image.  The caller must check that the changes are based
+        on the current version of the metadata.
+
+        version: The new version of the metadata.
+        used_size: The used size of the disk image.
+        deltas: A list of (block index, node, sync status) tupples.
+        update_id: The update ID of the new version.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._update_lock.acquire()
+            for (blk_idx, node, sync_status) in deltas:
+                if not self._block_status.has_location(blk_idx, node):
+                    continue
+                self._block_status.set_sync_status(blk_idx, node,
+                                                   sync_status)
+            self._metadata['used_size'] = used_size
+            self._metadata['version'] = version
+            if update_id is not None:
+                self._metadata['update_id'] = update_id
+            # The changes of the segments not loaded yet are read
+            # from the metadata storage when they are loaded.
+            self._load_generation += 1
+        finally:
+            self._update_lock.release()
+
+    def _split_metadata(self, metadata_raw):
+        '''
+        Splits a raw metadata into a dictionary without the block
+        information and an UKAIBlockStatusTable instance.  The block
+        information may be either a list of location dictionaries or
+        an UKAIBlockStatusTable instance decoded from the binary
+        format.  If the metadata is stored in segments, the returned
+        table is empty and the segments are loaded by the
+        _load_segments method when they are accessed.
+
+        Return values: A (metadata, block_status, segment_size,
+            loaded_segments, dirty_segments) tupple.
+        '''
+        metadata = dict(metadata_raw)
+        block_status = metadata.pop('blocks')
+        segment_size = metadata.pop('segment_size', None)
+        num_blocks = int(metadata['size']) / int(metadata['block_size'])
+        if block_status is None:
+            # Stored in segments.
+            num_segments = (num_blocks + segment_size - 1) / segment_size
+            return ((metadata, UKAIBlockStatusTable(num_blocks),
+                     segment_size, bytearray(num_segments), set()))
+
+        if not isinstance(block_status, UKAIBlockStatusTable):
+            block_status = UKAIBlockStatusTable.from_json(block_status)
+        segment_size = self._config.get('metadata_segment_size')
+        if not segment_size > 0:
+            return ((metadata, block_status, None, None, set()))
+        # All the segments are written out at the next flush, since
+        # the metadata storage may not have them.
+        num_segments = (num_blocks + segment_size - 1) / segment_size
+        return ((metadata, block_status, segment_size, None,
+                 set(range(0, num_segments))))
+
+    def _get_segment_range(self, segment_idx):
+        '''
+        Returns the (first, last) block indices of the segment.
+        '''
+        start_idx = segment_idx * self._segment_size
+        end_idx = min(start_idx + self._segment_size,
+                      self._block_status.num_blocks) - 1
+        return ((start_idx, end_idx))
+
+    def _load_segments(self, start_idx=0, end_idx=-1):
+        '''
+        Loads the segments which contain the specified range of blocks
+        from the metadata storage, if they have not been loaded yet.
+        This method must be called before accessing the status table
+        without holding the _update_lock lock.
+
+        start_idx: The first block index.
+        end_idx: The last block index.  When specified -1, the last
+            block index of the disk image is used.
+
+        Return values: This function does not return any values.
+        '''
+        if end_idx == -1:
+            end_idx = self._block_status.num_blocks - 1
+        loaded_segments = self._loaded_segments
+        if loaded_segments is None:
+            return
+        if loaded_segments.find('\x00', start_idx / self._segment_size,
+                                end_idx / self._segment_size + 1) == -1:
+            return
+
+        while True:
+            try:
+                self._update_lock.acquire()
+                if self._loaded_segments is None:
+                    return
+                generation = self._load_generation
+                missing_segments = [
+                    segment_idx for segment_idx
+                    in range(start_idx / self._segment_size,
+                             end_idx / self._segment_size + 1)
+                    if self._loaded_segments[segment_idx] == 0]
+            finally:
+                self._update_lock.release()
+            if len(missing_segments) == 0:
+                return
+
+            segments = [(segment_idx,
+                         ukai_db_client.get_metadata_segment(self.name,
+                                                             segment_idx))
+                        for segment_idx in missing_segments]
+
+            try:
+                self._update_lock.acquire()
+                if generation != self._load_generation:
+                    # The metadata has been changed while loading.
+                    continue
+                for (segment_idx, segment) in segments:
+                    (first_idx, last_idx) = self._get_segment_range(
+                        segment_idx)
+                    if segment is None:
+                        print 'segment %d of %s does not exist' % (
+                            segment_idx, self.name)
+                        segment = UKAIBlockStatusTable(last_idx - first_idx
+                                                       + 1)
+                    self._block_status.merge(first_idx, segment)
+                    self._loaded_segments[segment_idx] = 1
+                if self._loaded_segments.count('\x00') == 0:
+                    self._loaded_segments = None
+                return
+            finally:
+                self._update_lock.release()
+
+    def _mark_segments_dirty(self, start_idx, end_idx):
+        '''
+        Records that the segments which contain the specified range of
+        blocks are modified.  The caller must hold the _update_lock
+        lock.
+        '''
+        if self._segment_size is None:
+            return
+        self._dirty_segments.update(range(start_idx / self._segment_size,
+                                          end_idx / self._segment_size + 1))
+
+    def _join_metadata(self):
+        '''
+        Returns the raw metadata, which is used as the storage and
+        wire format, built from the in-memory representation.
+        '''
+        metadata_raw = dict(self._metadata)
+        metadata_raw['blocks'] = self._block_status.to_json()
+        return (metadata_raw)
 
     @property
     def metadata(self):
         '''
-        The metadata dictionary object of this instance.
+        The raw metadata dictionary object of this instance.  The
+        returned object is a copy, and modifying it doesn't affect
+        this instance.
         '''
-        return(self._metadata)
+        self._load_segments()
+        try:
+            self._update_lock.acquire()
+            return (self._join_metadata())
+        finally:
+            self._update_lock.release()
 
     @metadata.setter
     def metadata(self, metadata_raw):
-        if self._metadata is None:
-            # If this is the first time to load the metadata, just
-            # load it.
-            self._metadata = metadata_raw
-        else:
-            # If the instance has metadata already, need to lock
-            # the object to avoid thread confliction.
-            try:
-                self.acquire_lock()
+        (metadata, block_status, segment_size, loaded_segments,
+         dirty_segments) = self._split_metadata(metadata_raw)
+        # Need to lock the object to avoid thread confliction.
+        try:
+            self.acquire_lock()
+            self._update_lock.acquire()
 
-                self._metadata = metadata_raw
+            self._metadata = metadata
+            self._block_status = block_status
+            self._segment_size = segment_size
+            self._loaded_segments = loaded_segments
+            self._dirty_segments = dirty_segments
+            self._load_generation += 1
+            self._deltas = []
+
+        finally:
+            self._update_lock.release()
+            self.release_lock()
 
-            finally:
-                self.release_lock()
-        
 
     @property
     def name(self):
@@ -178,6 +511,26 @@ class UKAIMetadata(object):
         '''
         return (self._metadata['name'])
 
+    @property
+    def version(self):
+        '''
+        The version number of the metadata.  The number is incremented
+        every time the metadata is flushed.
+        '''
+        if 'version' not in self._metadata:
+            return (0)
+        return (int(self._metadata['version']))
+
+    @property
+    def update_id(self):
+        '''
+        The unique ID of the flush which wrote out the current
+        version of the metadata.  Different nodes may flush the same
+        version from the same base version, and the ID tells which
+        one the metadata is.  None if unknown.
+        '''
+        return (self._metadata.get('update_id'))
+
     @property
     def size(self):
         '''
@@ -193,7 +546,11 @@ class UKAIMetadata(object):
         return (int(self._metadata['used_size']))
     @used_size.setter
     def used_size(self, used_size):
-        self._metadata['used_size'] = used_size
+        try:
+            self._update_lock.acquire()
+            self._metadata['used_size'] = used_size
+        finally:
+            self._update_lock.release()
 
     @property
     def block_size(self):
@@ -202,15 +559,106 @@ class UKAIMetadata(object):
         '''
         return (int(self._metadata['block_size']))
 
+    @property
+    def write_quorum(self):
+        '''
+        The number of locations which must acknowledge a write
+        operation before returning to the caller.  None if all the
+        locations must complete the write.
+        '''
+        if 'write_quorum' not in self._metadata:
+            return (None)
+        return (int(self._metadata['write_quorum']))
+
+    @property
+    def last_writer(self):
+        '''
+        The node which opened the disk image for writing most
+        recently.  None if no node has opened it for writing.
+        '''
+        return (self._metadata.get('last_writer'))
+
+    @property
+    def write_generation(self):
+        '''
+        The number incremented every time the disk image is opened
+        for writing.  The cached data is valid only in the same
+        generation.
+        '''
+        return (int(self._metadata.get('write_generation', 0)))
+
+    def set_writer(self, node):
+        '''
+        Records that the node opens the disk image for writing.  The
+        write generation is incremented even if the node is the last
+        writer, since other nodes may have cached the data while no
+        node was writing.  Readers fetch the entire metadata when it
+        is flushed.
+
+        node: The IP address of the node.
+
+        Return values: True if the metadata is modified.
+        '''
+        try:
+            self._update_lock.acquire()
+            self._metadata['last_writer'] = node
+            self._metadata['write_generation'] = (
+                int(self._metadata.get('write_generation', 0)) + 1)
+            self._full_update_required = True
+            return (True)
+        finally:
+            self._update_lock.release()
+
     @property
     def blocks(self):
         '''
-        An array of all blocks.  Need to acquire lock when modifying
-        the contents.
+        An array of all blocks in the raw metadata format.  The
+        returned object is a copy, use the set_sync_status,
+        add_location and remove_location methods to modify the
+        contents.
+        '''
+        self._load_segments()
+        return(self._block_status.to_json())
+
+    @property
+    def block_status(self):
+        '''
+        The UKAIBlockStatusTable instance which keeps the location
+        and sync status information of all blocks.  The instance is
+        replaced when the entire metadata is replaced.
+        '''
+        return (self._block_status)
+
+    @property
+    def locations(self):
+        '''
+        A list of all the nodes which store at least one block of the
+        disk image.
+        '''
+        self._load_segments()
+        return (self._block_status.nodes)
+
+    def get_locations(self, blk_idx):
+        '''
+        Returns a list of nodes which store the specified block.
+
+        blk_idx: The index of a block.
+        '''
+        self._load_segments(blk_idx, blk_idx)
+        return (self._block_status.get_locations(blk_idx))
+
+    def has_location(self, blk_idx, node):
+        '''
+        Returns True if the node stores the specified block.
+
+        blk_idx: The index of a block.
+        node: The location information specified by the IP address
+            of a storage node.
         '''
-        return(self._metadata['blocks'])
+        self._load_segments(blk_idx, blk_idx)
+        return (self._block_status.has_location(blk_idx, node))
 
-    def acquire_lock(self, start_idx=0, end_idx=-1):
+    def acquire_lock(self, start_idx=0, end_idx=-1, shared=False):
         '''
         Acquires lock objects of the specified range of metadata
         blocks of the virtual disk.  If you don't specify any index
@@ -220,8 +668,12 @@ class UKAIMetadata(object):
             the lock object is aquired.
         end_idx: The last block index of metadata blocks at which
             the lock object is aquired.
+        shared: True if the blocks are locked for reading.  Multiple
+            readers can hold the locks of the same block at the same
+            time.  False if the blocks are locked exclusively.
 
-        Return values: This function does not return any values.
+        Return values: The time in seconds spent for waiting the
+            locks.
         '''
         if end_idx == -1:
             end_idx = (self.size / self.block_size) - 1
@@ -229,10 +681,9 @@ class UKAIMetadata(object):
         assert end_idx >= start_idx
         assert end_idx < (self.size / self.block_size)
 
-        for blk_idx in range(0, end_idx + 1):
-            self._lock[blk_idx].acquire()
+        return (self._lock_manager.acquire(start_idx, end_idx, shared))
 
-    def release_lock(self, start_idx=0, end_idx=-1):
+    def release_lock(self, start_idx=0, end_idx=-1, shared=False):
         '''
         Releases lock objects acquired by the acquire_lock method.  If
         you don't specify any index values, the entire metadata blocks
@@ -243,6 +694,7 @@ class UKAIMetadata(object):
             the lock object is aquired.
         end_idx: The last block index of metadata blocks at which
             the lock object is aquired.
+        shared: The same value passed to the acquire_lock method.
 
         Return values: This function does not return any values.
         '''
@@ -252,8 +704,7 @@ class UKAIMetadata(object):
         assert end_idx >= start_idx
         assert end_idx < (self.size / self.block_size)
 
-        for blk_idx in range(0, end_idx + 1):
-            self._lock[blk_idx].release()
+        self._lock_manager.release(start_idx, end_idx, shared)
 
     def set_sync_status(self, blk_idx, node, sync_status):
         '''
@@ -274,7 +725,15 @@ class UKAIMetadata(object):
                 or sync_status == UKAI_SYNCING
                 or sync_status == UKAI_OUT_OF_SYNC)
 
-        self.blocks[blk_idx][node]['sync_status'] = sync_status
+        self._load_segments(blk_idx, blk_idx)
+        try:
+            self._update_lock.acquire()
+            if self._block_status.set_sync_status(blk_idx, node,
+                                                  sync_status) is True:
+                self._deltas.append((blk_idx, node, sync_status))
+                self._mark_segments_dirty(blk_idx, blk_idx)
+        finally:
+            self._update_lock.release()
 
     def get_sync_status(self, blk_idx, node):
         '''
@@ -290,7 +749,8 @@ class UKAIMetadata(object):
             UKAI_SYNCING: The block is being synchronized (NOT USED).
             UKAI_OUT_OF_SYNC: The block is not synchronized.
         '''
-        return (self.blocks[blk_idx][node]['sync_status'])
+        self._load_segments(blk_idx, blk_idx)
+        return (self._block_status.get_sync_status(blk_idx, node))
 
     def add_location(self, node, start_idx=0, end_idx=-1,
                      sync_status=UKAI_OUT_OF_SYNC):
@@ -315,12 +775,18 @@ class UKAIMetadata(object):
 
         try:
             self.acquire_lock(start_idx, end_idx)
+            self._load_segments(start_idx, end_idx)
 
-            for blk_idx in range(start_idx, end_idx + 1):
-                if node not in self.blocks[blk_idx]:
-                    # if there is no node entry, create it.
-                    self.blocks[blk_idx][node] = {}
-                    self.set_sync_status(blk_idx, node, sync_status)
+            # The node entries are created at once for the blocks
+            # which don't have the node yet.
+            try:
+                self._update_lock.acquire()
+                if self._block_status.add_location(node, start_idx, end_idx,
+                                                   sync_status) is True:
+                    self._full_update_required = True
+                    self._mark_segments_dirty(start_idx, end_idx)
+            finally:
+                self._update_lock.release()
 
         finally:
             self.release_lock(start_idx, end_idx)
@@ -348,22 +814,22 @@ class UKAIMetadata(object):
 
         try:
             self.acquire_lock(start_idx, end_idx)
+            self._load_segments(start_idx, end_idx)
 
-            for blk_idx in range(start_idx, end_idx + 1):
-                block = self.blocks[blk_idx]
-                has_synced_node = False
-                for member_node in block.keys():
-                    if member_node == node:
-                        continue
-                    if (self.get_sync_status(blk_idx, member_node)
-                        == UKAI_IN_SYNC):
-                        has_synced_node = True
-                        break
-                if has_synced_node is False:
-                    print 'block %d does not have synced block' % blk_idx
-                    continue
-                if node in block.keys():
-                    del block[node]
+            # The node is removed only from the blocks which have
+            # another in-sync location.
+            try:
+                self._update_lock.acquire()
+                (changed,
+                 kept_blocks) = self._block_status.remove_location(
+                    node, start_idx, end_idx)
+                if changed is True:
+                    self._full_update_required = True
+                    self._mark_segments_dirty(start_idx, end_idx)
+            finally:
+                self._update_lock.release()
+            for blk_idx in kept_blocks:
+                print 'block %d does not have synced block' % blk_idx
 
         finally:
             self.release_lock(start_idx, end_idx)
@@ -383,12 +849,12 @@ if __name__ == '__main__':
     print 'block[3]:', meta.blocks[3]
 
     for blk_idx in range(0, meta.size / meta.block_size):
-        for node in meta.blocks[blk_idx].keys():
+        for node in meta.get_locations(blk_idx):
             if node == '192.168.100.100':
                 meta.set_sync_status(blk_idx, node, UKAI_OUT_OF_SYNC)
     meta.flush()
     for blk_idx in range(0, meta.size / meta.block_size):
-        for node in meta.blocks[blk_idx].keys():
+        for node in meta.get_locations(blk_idx):
             if node == '192.168.100.100':
                 meta.set_sync_status(blk_idx, node, UKAI_IN_SYNC)
     meta.flush()
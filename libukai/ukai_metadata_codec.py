@@ -0,0 +1,297 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_metadata_codec.py module defines functions to convert the
+metadata of a disk image to and from the format stored in metadata
+servers.
+
+Two formats are supported.  The JSON format is the same as the
+metadata exchanged among UKAI servers.  The binary format consists
+of the following parts.
+
+    header: the magic string, the format version, the size, the
+        used size, the block size and the version of the metadata,
+        the number of blocks and locations, and the length of the
+        extra header (see UKAI_METADATA_HEADER).
+    extra header: the other keys of the metadata (e.g. the name) in
+        the JSON format.
+    location table: the address of each location, prefixed by its
+        length in 2 bytes.
+    status array: the sync status of each block of each location,
+        1 byte per block, ordered by the location table.
+
+The segmented format splits the status array into segments of a
+fixed number of blocks, so that each segment can be stored and loaded
+separately.  The header of the segmented format is the same as the
+binary format, except that the format version is
+UKAI_METADATA_SEGMENTED_VERSION, the number of locations is 0, and the
+extra header has the 'segment_size' key.  Each segment consists of
+the following parts.
+
+    segment header: the magic string, the format version, the number
+        of blocks and locations (see UKAI_METADATA_SEGMENT_HEADER).
+    location table and status array: the same as the binary format.
+
+The format is detected automatically when decoding, so that metadata
+written in any format can be read.
+'''
+
+import json
+import struct
+
+from ukai_block_status import UKAIBlockStatusTable
+
+UKAI_METADATA_FORMAT_JSON = 'json'
+UKAI_METADATA_FORMAT_BINARY = 'binary'
+UKAI_METADATA_FORMAT_SEGMENTED = 'segmented'
+
+UKAI_METADATA_MAGIC = 'UKAM'
+UKAI_METADATA_BINARY_VERSION = 1
+UKAI_METADATA_SEGMENTED_VERSION = 2
+UKAI_METADATA_HEADER = struct.Struct('!4sBQQQQIHI')
+UKAI_METADATA_LOCATION_LENGTH = struct.Struct('!H')
+
+UKAI_METADATA_SEGMENT_MAGIC = 'UKAS'
+UKAI_METADATA_SEGMENT_VERSION = 1
+UKAI_METADATA_SEGMENT_HEADER = struct.Struct('!4sBIH')
+
+# The keys stored in the binary format other than the extra header.
+_UKAI_METADATA_HEADER_KEYS = ('size', 'used_size', 'block_size', 'version',
+                              'blocks')
+
+def ukai_metadata_format(encoded):
+    '''
+    Returns the format of the encoded metadata.
+
+    param encoded: a string returned by the ukai_metadata_encode
+        function.
+    '''
+    if encoded.startswith(UKAI_METADATA_MAGIC):
+        binary_version = ord(encoded[len(UKAI_METADATA_MAGIC)])
+        if binary_version == UKAI_METADATA_SEGMENTED_VERSION:
+            return (UKAI_METADATA_FORMAT_SEGMENTED)
+        return (UKAI_METADATA_FORMAT_BINARY)
+    return (UKAI_METADATA_FORMAT_JSON)
+
+def ukai_metadata_encode(metadata, format=UKAI_METADATA_FORMAT_BINARY):
+    '''
+    Encodes a raw metadata in the specified format.
+
+    param metadata: a raw metadata.  The 'blocks' value may be either
+        a list of location dictionaries or an UKAIBlockStatusTable
+        instance.
+    param format: UKAI_METADATA_FORMAT_BINARY or
+        UKAI_METADATA_FORMAT_JSON.
+    '''
+    if format == UKAI_METADATA_FORMAT_JSON:
+        return (json.dumps(ukai_metadata_to_json(metadata)))
+    assert format == UKAI_METADATA_FORMAT_BINARY
+
+    block_status = metadata['blocks']
+    if not isinstance(block_status, UKAIBlockStatusTable):
+        block_status = UKAIBlockStatusTable.from_json(block_status)
+    (nodes, packed_status) = block_status.pack()
+    encoded = _ukai_metadata_encode_header(metadata,
+                                           UKAI_METADATA_BINARY_VERSION,
+                                           block_status.num_blocks,
+                                           len(nodes))
+    encoded.extend(_ukai_metadata_encode_blocks(nodes, packed_status))
+    return (''.join(encoded))
+
+def ukai_metadata_encode_header(metadata, segment_size):
+    '''
+    Encodes a raw metadata without the block information in the
+    segmented format.  The block information is encoded by the
+    ukai_metadata_encode_segment function.
+
+    param metadata: a raw metadata.  The 'blocks' key is ignored.
+    param segment_size: the number of blocks of each segment.
+    '''
+    metadata = dict(metadata)
+    metadata['segment_size'] = segment_size
+    num_blocks = int(metadata['size']) / int(metadata['block_size'])
+    return (''.join(_ukai_metadata_encode_header(
+                metadata, UKAI_METADATA_SEGMENTED_VERSION, num_blocks, 0)))
+
+def ukai_metadata_encode_segment(segment):
+    '''
+    Encodes a segment of the block information.
+
+    param segment: an UKAIBlockStatusTable instance which contains
+        the blocks of the segment.
+    '''
+    (nodes, packed_status) = segment.pack()
+    encoded = [UKAI_METADATA_SEGMENT_HEADER.pack(
+            UKAI_METADATA_SEGMENT_MAGIC,
+            UKAI_METADATA_SEGMENT_VERSION,
+            segment.num_blocks,
+            len(nodes))]
+    encoded.extend(_ukai_metadata_encode_blocks(nodes, packed_status))
+    return (''.join(encoded))
+
+def _ukai_metadata_encode_header(metadata, binary_version, num_blocks,
+                                 num_nodes):
+    extra = json.dumps(dict([(key, metadata[key]) for key in metadata
+                             if key not in _UKAI_METADATA_HEADER_KEYS]))
+    return ([UKAI_METADATA_HEADER.pack(UKAI_METADATA_MAGIC,
+                                       binary_version,
+                                       int(metadata['size']),
+                                       int(metadata['used_size']),
+                                       int(metadata['block_size']),
+                                       int(metadata.get('version', 0)),
+                                       num_blocks,
+                                       num_nodes,
+                                       len(extra)),
+             extra])
+
+def _ukai_metadata_encode_blocks(nodes, packed_status):
+    encoded = []
+    for node in nodes:
+        node = node.encode('utf-8')
+        encoded.append(UKAI_METADATA_LOCATION_LENGTH.pack(len(node)))
+        encoded.append(node)
+    encoded.append(packed_status)
+    return (encoded)
+
+def ukai_metadata_decode(encoded):
+    '''
+    Decodes the metadata encoded by the ukai_metadata_encode or the
+    ukai_metadata_encode_header function.  The 'blocks' value of the
+    returned metadata is an UKAIBlockStatusTable instance if the
+    metadata is encoded in the binary format, otherwise a list of
+    location dictionaries.  Use the ukai_metadata_to_json function
+    to get the latter form.  If the metadata is encoded in the
+    segmented format, the 'blocks' value is None and the
+    'segment_size' key is set.
+
+    param encoded: an encoded metadata string.
+    '''
+    if ukai_metadata_format(encoded) == UKAI_METADATA_FORMAT_JSON:
+        return (json.loads(encoded))
+
+    (magic, binary_version, size, used_size, block_size, version,
+     num_blocks, num_nodes, extra_length) = UKAI_METADATA_HEADER.unpack_from(
+        encoded)
+    if (binary_version != UKAI_METADATA_BINARY_VERSION
+        and binary_version != UKAI_METADATA_SEGMENTED_VERSION):
+        raise ValueError('unsupported metadata format version %d'
+                         % binary_version)
+    offset = UKAI_METADATA_HEADER.size
+    metadata = json.loads(encoded[offset:offset + extra_length])
+    offset += extra_length
+    metadata['size'] = size
+    metadata['used_size'] = used_size
+    metadata['block_size'] = block_size
+    metadata['version'] = version
+    if binary_version == UKAI_METADATA_SEGMENTED_VERSION:
+        metadata['blocks'] = None
+    else:
+        metadata['blocks'] = _ukai_metadata_decode_blocks(encoded, offset,
+                                                          num_blocks,
+                                                          num_nodes)
+    return (metadata)
+
+def ukai_metadata_decode_segment(encoded):
+    '''
+    Decodes a segment encoded by the ukai_metadata_encode_segment
+    function, and returns an UKAIBlockStatusTable instance.
+
+    param encoded: an encoded segment string.
+    '''
+    (magic, segment_version, num_blocks,
+     num_nodes) = UKAI_METADATA_SEGMENT_HEADER.unpack_from(encoded)
+    if (magic != UKAI_METADATA_SEGMENT_MAGIC
+        or segment_version != UKAI_METADATA_SEGMENT_VERSION):
+        raise ValueError('unsupported metadata segment format')
+    return (_ukai_metadata_decode_blocks(encoded,
+                                         UKAI_METADATA_SEGMENT_HEADER.size,
+                                         num_blocks, num_nodes))
+
+def _ukai_metadata_decode_blocks(encoded, offset, num_blocks, num_nodes):
+    nodes = []
+    for node_idx in range(0, num_nodes):
+        (length,) = UKAI_METADATA_LOCATION_LENGTH.unpack_from(encoded,
+                                                              offset)
+        offset += UKAI_METADATA_LOCATION_LENGTH.size
+        nodes.append(encoded[offset:offset + length].decode('utf-8'))
+        offset += length
+    return (UKAIBlockStatusTable.unpack(
+            num_blocks, nodes, encoded[offset:offset + num_blocks * num_nodes]))
+
+def ukai_metadata_to_json(metadata):
+    '''
+    Returns the raw metadata whose 'blocks' value is a list of
+    location dictionaries.
+
+    param metadata: a raw metadata returned by the
+        ukai_metadata_decode function.
+    '''
+    if not isinstance(metadata['blocks'], UKAIBlockStatusTable):
+        return (metadata)
+    metadata = dict(metadata)
+    metadata['blocks'] = metadata['blocks'].to_json()
+    return (metadata)
+
+if __name__ == '__main__':
+    import time
+
+    num_blocks = 100000
+    metadata = {'name': 'test',
+                'size': num_blocks * 1000,
+                'used_size': num_blocks * 1000,
+                'block_size': 1000,
+                'version': 1,
+                'blocks': [{'192.168.100.1': {'sync_status': 0},
+                            '192.168.100.2': {'sync_status': 2}}
+                           for blk_idx in range(0, num_blocks)]}
+    for format in (UKAI_METADATA_FORMAT_JSON, UKAI_METADATA_FORMAT_BINARY):
+        start_time = time.time()
+        encoded = ukai_metadata_encode(metadata, format)
+        encode_time = time.time() - start_time
+        start_time = time.time()
+        decoded = ukai_metadata_decode(encoded)
+        decode_time = time.time() - start_time
+        assert ukai_metadata_to_json(decoded) == metadata
+        print '%s: %d bytes, encode %f sec, decode %f sec' % (
+            format, len(encoded), encode_time, decode_time)
+
+    segment_size = 1000
+    block_status = ukai_metadata_decode(
+        ukai_metadata_encode(metadata))['blocks']
+    header = ukai_metadata_decode(ukai_metadata_encode_header(metadata,
+                                                              segment_size))
+    assert header['segment_size'] == segment_size
+    assert header['blocks'] is None
+    start_time = time.time()
+    encoded = ukai_metadata_encode_segment(block_status.slice(0,
+                                                              segment_size - 1))
+    decoded = ukai_metadata_decode_segment(encoded)
+    assert decoded.to_json() == metadata['blocks'][0:segment_size]
+    print 'segment: %d bytes, %f sec' % (len(encoded),
+                                         time.time() - start_time)
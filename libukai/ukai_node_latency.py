@@ -0,0 +1,253 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_node_latency.py module provides classes to keep the round
+trip time of RPC requests to storage nodes.
+'''
+
+import collections
+import math
+import random
+import threading
+
+# The weight of a new sample in the exponentially weighted moving
+# average of the round trip time.
+UKAI_NODE_LATENCY_EWMA_WEIGHT = 0.2
+
+# The default ratio of reads sent to a randomly chosen node to keep
+# the latency information of all the nodes fresh.
+UKAI_NODE_LATENCY_PROBE_RATIO = 0.05
+
+# The number of recent samples kept to calculate percentiles.
+UKAI_NODE_LATENCY_SAMPLES = 100
+
+class UKAINodeLatencySet(object):
+    '''
+    The UKAINodeLatencySet class provides interfaces to manage the
+    round trip time of each storage node, and to choose the fastest
+    node from a list of nodes.
+    '''
+    def __init__(self, probe_ratio=None):
+        '''
+        Initializes a internal dictionary object to keep
+        UKAINodeLatency class instances, and a lock object.
+
+        probe_ratio: The ratio of selections which return a randomly
+            chosen node instead of the fastest node.  If None, the
+            UKAI_NODE_LATENCY_PROBE_RATIO value is used.
+
+        Return values: This function does not return any values.
+        '''
+        if probe_ratio is None:
+            probe_ratio = UKAI_NODE_LATENCY_PROBE_RATIO
+        self._probe_ratio = probe_ratio
+        self._set = {}
+        self._lock = threading.Lock()
+
+    def update(self, address, rtt):
+        '''
+        Adds a round trip time sample of the specified node.
+
+        address: The IP address of the node.
+        rtt: The round trip time in seconds.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            if address not in self._set:
+                self._set[address] = UKAINodeLatency(address)
+            self._set[address].update(rtt)
+        finally:
+            self._lock.release()
+
+    def get(self, address):
+        '''
+        Returns the average round trip time of the specified node, or
+        None if the node has never been measured.
+
+        address: The IP address of the node.
+        '''
+        try:
+            self._lock.acquire()
+            if address not in self._set:
+                return (None)
+            return (self._set[address].average)
+        finally:
+            self._lock.release()
+
+    def percentile(self, address, percent):
+        '''
+        Returns the specified percentile of the recent round trip
+        time samples of the node, or None if the node has never been
+        measured.
+
+        address: The IP address of the node.
+        percent: The percentile between 0 and 100.
+        '''
+        try:
+            self._lock.acquire()
+            if address not in self._set:
+                return (None)
+            return (self._set[address].percentile(percent))
+        finally:
+            self._lock.release()
+
+    def select(self, addresses):
+        '''
+        Returns the node which has the smallest average round trip
+        time in the specified list of nodes.  The nodes which have
+        never been measured are preferred so that they are measured.
+        Occasionally a random node is returned to refresh the latency
+        information of slow nodes.
+
+        addresses: A list of IP addresses of nodes.
+
+        Return values: The IP address of the selected node, or None
+            if the list is empty.
+        '''
+        if len(addresses) == 0:
+            return (None)
+        if len(addresses) > 1 and random.random() < self._probe_ratio:
+            return (random.choice(addresses))
+        candidate = None
+        candidate_rtt = None
+        try:
+            self._lock.acquire()
+            for address in addresses:
+                if address not in self._set:
+                    return (address)
+                rtt = self._set[address].average
+                if candidate is None or rtt < candidate_rtt:
+                    candidate = address
+                    candidate_rtt = rtt
+        finally:
+            self._lock.release()
+        return (candidate)
+
+    def get_list(self):
+        '''
+        Returns a list of nodes and their latency information.
+
+        Return values: A list object of a dictionary object of
+        following format.
+
+            {
+                'address': NODE_ADDRESS,
+                'latency': AVERAGE_RTT,
+                'samples': NUMBER_OF_SAMPLES
+            }
+
+        AVERAGE_RTT is the exponentially weighted moving average of
+        the round trip time in seconds.
+        '''
+        try:
+            self._lock.acquire()
+            copied_set = []
+            for address in self._set:
+                latency = self._set[address]
+                copied_set.append({'address': latency.address,
+                                   'latency': latency.average,
+                                   'samples': latency.samples
+                                   })
+            return (copied_set)
+        finally:
+            self._lock.release()
+
+class UKAINodeLatency(object):
+    '''
+    The UKAINodeLatency class keeps the round trip time information
+    of a storage node.
+    '''
+    def __init__(self, address):
+        '''
+        Initializes an instance of the UKAINodeLatency class with the
+        specified node address.
+
+        address: The IP address of the node.
+
+        Return values: This function does not return any values.
+        '''
+        self._address = address
+        self._average = 0.0
+        self._samples = 0
+        self._recent = collections.deque(maxlen=UKAI_NODE_LATENCY_SAMPLES)
+
+    @property
+    def address(self):
+        '''
+        The IP address of the node.
+        '''
+        return (self._address)
+
+    @property
+    def average(self):
+        '''
+        The exponentially weighted moving average of the round trip
+        time in seconds.
+        '''
+        return (self._average)
+
+    @property
+    def samples(self):
+        '''
+        The number of samples measured.
+        '''
+        return (self._samples)
+
+    def update(self, rtt):
+        '''
+        Adds a round trip time sample.
+
+        rtt: The round trip time in seconds.
+
+        Return values: This function does not return any values.
+        '''
+        if self._samples == 0:
+            self._average = rtt
+        else:
+            self._average = (UKAI_NODE_LATENCY_EWMA_WEIGHT * rtt
+                             + (1 - UKAI_NODE_LATENCY_EWMA_WEIGHT)
+                             * self._average)
+        self._samples += 1
+        self._recent.append(rtt)
+
+    def percentile(self, percent):
+        '''
+        Returns the specified percentile of the recent round trip
+        time samples.
+
+        percent: The percentile between 0 and 100.
+        '''
+        assert 0 <= percent <= 100
+        if len(self._recent) == 0:
+            return (None)
+        recent = sorted(self._recent)
+        index = int(math.ceil(len(recent) * percent / 100.0)) - 1
+        return (recent[max(index, 0)])
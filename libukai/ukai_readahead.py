@@ -0,0 +1,132 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_readahead.py module provides a sequential access detector
+which decides the range of data to be read ahead.
+'''
+
+import threading
+
+# The number of consecutive sequential reads required to start
+# readahead.
+UKAI_READAHEAD_THRESHOLD = 2
+
+class UKAIReadahead(object):
+    '''
+    The UKAIReadahead class tracks the offsets of read operations of
+    a disk image.  When the reads form a sequential stream, the class
+    returns the next range to be prefetched.  The size of the range
+    (the readahead window) starts from the minimum size and is doubled
+    every time a range is prefetched until it reaches the maximum
+    size.  The window is reset when a non-sequential read is seen.
+    '''
+    def __init__(self, min_window, max_window):
+        '''
+        Initializes an instance.
+
+        min_window: The initial size of the readahead window.
+        max_window: The maximum size of the readahead window.
+
+        Return values: This function does not return any values.
+        '''
+        assert min_window > 0
+        assert max_window >= min_window
+        self._min_window = min_window
+        self._max_window = max_window
+        self._window = min_window
+        self._next_offset = -1
+        self._sequential_count = 0
+        self._prefetched_end = 0
+        self._trigger_offset = 0
+        self._lock = threading.Lock()
+
+    @property
+    def window(self):
+        '''
+        The current size of the readahead window.
+        '''
+        return (self._window)
+
+    def access(self, offset, size):
+        '''
+        Records a read operation and returns the range to be
+        prefetched.
+
+        offset: the offset of the read operation.
+        size: the size of the read operation.
+
+        Return values: A (offset, size) tupple of the range to be
+            prefetched, or None if no prefetch is required.
+        '''
+        try:
+            self._lock.acquire()
+            end = offset + size
+            if offset != self._next_offset:
+                # a new stream starts.
+                self._sequential_count = 0
+                self._window = self._min_window
+                self._prefetched_end = end
+                self._trigger_offset = end
+            else:
+                self._sequential_count += 1
+            self._next_offset = end
+
+            if self._sequential_count < UKAI_READAHEAD_THRESHOLD:
+                return (None)
+            if end < self._trigger_offset:
+                # enough data is prefetched.
+                return (None)
+
+            start = max(end, self._prefetched_end)
+            window = self._window
+            self._prefetched_end = start + window
+            # prefetch the next range when the half of this range is
+            # consumed.
+            self._trigger_offset = start + (window / 2)
+            self._window = min(self._window * 2, self._max_window)
+            return ((start, window))
+        finally:
+            self._lock.release()
+
+    def cancel(self, offset):
+        '''
+        Records that the range returned from the access() method was
+        not prefetched after the specified offset.  The range is
+        returned again by the following sequential read.
+
+        offset: the offset from which the data was not prefetched.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            self._prefetched_end = min(self._prefetched_end, offset)
+            self._trigger_offset = min(self._trigger_offset, offset)
+        finally:
+            self._lock.release()
@@ -26,8 +26,19 @@
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
 # OF SUCH DAMAGE.
 
+from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+import threading
+import time
 import xmlrpclib
 
+# The maximum number of idle connections kept per server.
+UKAI_RPC_POOL_SIZE_DEFAULT = 8
+# The time in seconds after which an idle connection is closed.  Must
+# be shorter than UKAI_RPC_SERVER_TIMEOUT of the servers.
+UKAI_RPC_IDLE_TIMEOUT_DEFAULT = 30
+# The time in seconds after which a server closes an idle connection.
+UKAI_RPC_SERVER_TIMEOUT = 60
+
 class UKAIRPCClient(object):
     def call(self, method, *params):
         # must subclass.
@@ -45,6 +56,184 @@ class UKAIRPCTranslation(object):
     def decode(self, source):
         return source
 
+class UKAIXMLRPCTransport(xmlrpclib.Transport):
+    '''
+    The UKAIXMLRPCTransport class is an HTTP/1.1 transport which keeps
+    its connection open between requests, and reports to the
+    statistics whether each request reused the connection.
+    '''
+    def __init__(self, statistics):
+        xmlrpclib.Transport.__init__(self)
+        self._statistics = statistics
+
+    def make_connection(self, host):
+        conn = xmlrpclib.Transport.make_connection(self, host)
+        if conn.sock is not None:
+            self._statistics.add_reuse()
+            return conn
+        start_time = time.time()
+        conn.connect()
+        self._statistics.add_connect(time.time() - start_time)
+        return conn
+
+class UKAIRPCStatistics(object):
+    '''
+    The UKAIRPCStatistics class counts the connections made and
+    reused by the UKAIRPCConnectionPool class.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connects = 0
+        self._reuses = 0
+        self._connect_time = 0.0
+
+    def add_connect(self, connect_time):
+        try:
+            self._lock.acquire()
+            self._connects += 1
+            self._connect_time += connect_time
+        finally:
+            self._lock.release()
+
+    def add_reuse(self):
+        try:
+            self._lock.acquire()
+            self._reuses += 1
+        finally:
+            self._lock.release()
+
+    def get(self):
+        '''
+        Returns the statistics in a dictionary.  The saved_time value
+        is the average connect time multiplied by the number of
+        requests which reused connections.
+        '''
+        try:
+            self._lock.acquire()
+            requests = self._connects + self._reuses
+            reuse_ratio = 0.0
+            if requests > 0:
+                reuse_ratio = float(self._reuses) / requests
+            saved_time = 0.0
+            if self._connects > 0:
+                saved_time = (self._connect_time / self._connects
+                              * self._reuses)
+            return ({'connects': self._connects,
+                     'reuses': self._reuses,
+                     'reuse_ratio': reuse_ratio,
+                     'connect_time': self._connect_time,
+                     'saved_time': saved_time})
+        finally:
+            self._lock.release()
+
+class UKAIRPCConnectionPool(object):
+    '''
+    The UKAIRPCConnectionPool class keeps persistent connections to
+    each (server, port) pair.  A connection is used by one caller at
+    a time.  At most pool_size idle connections are kept per server,
+    and connections idle longer than idle_timeout seconds are closed.
+    '''
+    def __init__(self, factory):
+        '''
+        Initializes an empty pool.
+
+        param factory: a function which receives an UKAIRPCStatistics
+            instance and returns a new connection.  A connection must
+            have the close() method, and must report to the
+            statistics when it connects to or reuses the connection
+            to a server.
+        '''
+        self._factory = factory
+        self._lock = threading.Lock()
+        # (server, port) => a list of (connection, released time).
+        self._idle = {}
+        self._pool_size = UKAI_RPC_POOL_SIZE_DEFAULT
+        self._idle_timeout = UKAI_RPC_IDLE_TIMEOUT_DEFAULT
+        self._statistics = UKAIRPCStatistics()
+
+    def configure(self, config):
+        '''
+        Takes the pool size and the idle timeout from the
+        rpc_pool_size and rpc_idle_timeout parameters of the config.
+
+        config: an UKAIConfig instance.
+        '''
+        if config.get('rpc_pool_size') is not None:
+            self._pool_size = config.get('rpc_pool_size')
+        if config.get('rpc_idle_timeout') is not None:
+            self._idle_timeout = config.get('rpc_idle_timeout')
+
+    @property
+    def statistics(self):
+        return (self._statistics.get())
+
+    def _evict(self, now):
+        # must be called with the lock held.
+        closing = []
+        for (key, idle) in self._idle.items():
+            while len(idle) > 0 and idle[0][1] + self._idle_timeout < now:
+                closing.append(idle.pop(0)[0])
+            if len(idle) == 0:
+                del self._idle[key]
+        return (closing)
+
+    def acquire(self, server, port):
+        '''
+        Returns a connection to the server, or a new connection if
+        there is no idle connection.
+        '''
+        conn = None
+        try:
+            self._lock.acquire()
+            closing = self._evict(time.time())
+            idle = self._idle.get((server, port))
+            if idle is not None:
+                # the most recently used one is least likely to be
+                # closed by the server.
+                conn = idle.pop()[0]
+                if len(idle) == 0:
+                    del self._idle[(server, port)]
+        finally:
+            self._lock.release()
+        for idle_conn in closing:
+            idle_conn.close()
+        if conn is None:
+            conn = self._factory(self._statistics)
+        return (conn)
+
+    def release(self, server, port, conn, reusable=True):
+        '''
+        Returns a connection acquired by the acquire method to the
+        pool.  The connection is closed if it is not reusable (e.g. an
+        error occurred during a request) or the pool is full.
+        '''
+        if reusable:
+            try:
+                self._lock.acquire()
+                idle = self._idle.setdefault((server, port), [])
+                if len(idle) < self._pool_size:
+                    idle.append((conn, time.time()))
+                    return
+            finally:
+                self._lock.release()
+        conn.close()
+
+    def clear(self):
+        '''
+        Closes all the idle connections.
+        '''
+        try:
+            self._lock.acquire()
+            idle_lists = self._idle.values()
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for idle in idle_lists:
+            for (conn, released_time) in idle:
+                conn.close()
+
+ukai_rpc_connection_pool = UKAIRPCConnectionPool(UKAIXMLRPCTransport)
+
 class UKAIXMLRPCClient(UKAIRPCClient):
     def __init__(self, config):
         self._config = config
@@ -60,14 +249,37 @@ class UKAIXMLRPCCall(UKAIRPCCall):
         self._port = port
 
     def call(self, method, *params):
+        transport = ukai_rpc_connection_pool.acquire(self._server,
+                                                     self._port)
         client = xmlrpclib.ServerProxy(
             'http://%s:%d' % (self._server, self._port),
-            allow_none=True)
+            transport=transport, allow_none=True)
+        reusable = False
         try:
-            return getattr(client, method)(*params)
+            ret = getattr(client, method)(*params)
+            reusable = True
+            return ret
+        except xmlrpclib.Fault, e:
+            # the error is reported by the server, and the connection
+            # is still usable.
+            reusable = True
+            print e.__class__
+            raise
         except xmlrpclib.Error, e:
             print e.__class__
             raise
+        finally:
+            ukai_rpc_connection_pool.release(self._server, self._port,
+                                             transport, reusable)
+
+class UKAIXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+    '''
+    The UKAIXMLRPCRequestHandler class serves multiple requests on
+    one HTTP/1.1 connection, which is closed if it is idle for
+    UKAI_RPC_SERVER_TIMEOUT seconds.
+    '''
+    protocol_version = 'HTTP/1.1'
+    timeout = UKAI_RPC_SERVER_TIMEOUT
 
 class UKAIXMLRPCTranslation(UKAIRPCTranslation):
     def encode(self, source):
@@ -75,3 +287,39 @@ class UKAIXMLRPCTranslation(UKAIRPCTranslation):
 
     def decode(self, source):
         return source.data
+
+if __name__ == '__main__':
+    import sys
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    import SocketServer
+
+    class Server(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+        daemon_threads = True
+
+    count = 1000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    server = Server(('127.0.0.1', 0), requestHandler=UKAIXMLRPCRequestHandler,
+                    logRequests=False, allow_none=True)
+    server.register_function(lambda data: data, 'echo')
+    port = server.server_address[1]
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    data = xmlrpclib.Binary('x' * 4096)
+    def fresh_call():
+        xmlrpclib.ServerProxy('http://127.0.0.1:%d' % port,
+                              allow_none=True).echo(data)
+    rpc_call = UKAIXMLRPCCall('127.0.0.1', port)
+    for (name, func) in (('new connection per call', fresh_call),
+                         ('pooled connection',
+                          lambda: rpc_call.call('echo', data))):
+        start_time = time.time()
+        for i in range(0, count):
+            func()
+        elapsed = time.time() - start_time
+        print '%s: %.1f calls/sec' % (name, count / elapsed)
+    print ukai_rpc_connection_pool.statistics
+    ukai_rpc_connection_pool.clear()
+    server.shutdown()
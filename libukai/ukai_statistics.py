@@ -71,6 +71,39 @@ class UKAIImageStatistics(object):
         self._stats['histogram']['read'] = {}
         self._stats['histogram']['write'] = {}
 
+        # block cache statistics.
+        self._stats['cache'] = {}
+        self._stats['cache']['hits'] = 0
+        self._stats['cache']['misses'] = 0
+        self._stats['cache']['disk_hits'] = 0
+        self._stats['cache']['disk_misses'] = 0
+        self._stats['cache']['readahead_ops'] = 0
+        self._stats['cache']['readahead_bytes'] = 0
+
+        # block lock statistics.
+        self._stats['lock'] = {}
+        self._stats['lock']['wait_time'] = 0.0
+        self._stats['lock']['acquisitions'] = 0
+
+        # metadata flush statistics.
+        self._stats['metadata'] = {}
+        self._stats['metadata']['deferred'] = 0
+        self._stats['metadata']['flushes'] = 0
+        self._stats['metadata']['flush_time'] = 0.0
+
+        # hedged read statistics.
+        self._stats['hedge'] = {}
+        self._stats['hedge']['fired'] = 0
+        self._stats['hedge']['won'] = 0
+
+        # zero extent statistics.  the bytes of all-zero data which
+        # was transferred as zero extents by the binary protocol, and
+        # the bytes not written to the block files of this node.
+        self._stats['zero'] = {}
+        self._stats['zero']['wire_read_bytes'] = 0
+        self._stats['zero']['wire_write_bytes'] = 0
+        self._stats['zero']['disk_bytes'] = 0
+
     @property
     def descriptor(self):
         '''
@@ -143,6 +176,110 @@ class UKAIImageStatistics(object):
         self._stats['write_ops'] += 1
         self._update_histogram(self._stats['histogram']['write'], total_size)
 
+    def cache_hit(self):
+        '''
+        Updates statistics when a read request is served from the
+        block cache.
+        '''
+        self._stats['cache']['hits'] += 1
+
+    def cache_miss(self):
+        '''
+        Updates statistics when a read request is not found in the
+        block cache.
+        '''
+        self._stats['cache']['misses'] += 1
+
+    def disk_cache_hit(self):
+        '''
+        Updates statistics when a read request is served from the
+        disk cache.
+        '''
+        self._stats['cache']['disk_hits'] += 1
+
+    def disk_cache_miss(self):
+        '''
+        Updates statistics when a read request is not found in the
+        disk cache.
+        '''
+        self._stats['cache']['disk_misses'] += 1
+
+    def readahead_op(self, size):
+        '''
+        Updates statistics when a range of data is prefetched.
+
+        size: the size of the prefetched range.
+        '''
+        self._stats['cache']['readahead_ops'] += 1
+        self._stats['cache']['readahead_bytes'] += size
+
+    def hedge_fired(self):
+        '''
+        Updates statistics when a hedged read request is sent to a
+        second node.
+        '''
+        self._stats['hedge']['fired'] += 1
+
+    def hedge_won(self):
+        '''
+        Updates statistics when a hedged read request completes before
+        the original request.
+        '''
+        self._stats['hedge']['won'] += 1
+
+    def zero_wire_read(self, size):
+        '''
+        Updates statistics when a zero extent is received instead of
+        the data read from a remote node.
+
+        size: the size of the extent.
+        '''
+        self._stats['zero']['wire_read_bytes'] += size
+
+    def zero_wire_write(self, size):
+        '''
+        Updates statistics when a zero extent is sent instead of the
+        data written to a remote node.
+
+        size: the size of the extent.
+        '''
+        self._stats['zero']['wire_write_bytes'] += size
+
+    def zero_disk(self, size):
+        '''
+        Updates statistics when all-zero data is not written to a
+        block file, since the block is not allocated or a hole is
+        punched instead.
+
+        size: the size of the data.
+        '''
+        self._stats['zero']['disk_bytes'] += size
+
+    def lock_wait(self, wait_time):
+        '''
+        Updates statistics when block locks are acquired.
+
+        wait_time: the time in seconds spent for waiting the locks.
+        '''
+        self._stats['lock']['wait_time'] += wait_time
+        self._stats['lock']['acquisitions'] += 1
+
+    def metadata_deferred(self):
+        '''
+        Updates statistics when a metadata modification is queued to
+        be flushed later.
+        '''
+        self._stats['metadata']['deferred'] += 1
+
+    def metadata_flush(self, flush_time):
+        '''
+        Updates statistics when the metadata is flushed.
+
+        flush_time: the time in seconds spent for flushing.
+        '''
+        self._stats['metadata']['flushes'] += 1
+        self._stats['metadata']['flush_time'] += flush_time
+
     def _init_io_stats(self, stats):
         stats['read_bytes'] = 0
         stats['read_ops'] = 0
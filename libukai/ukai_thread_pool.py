@@ -0,0 +1,270 @@
+# Copyright 2015
+# IIJ Innovation Institute Inc. All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the following
+#   disclaimer in the documentation and/or other materials
+#   provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY IIJ INNOVATION INSTITUTE INC. ``AS
+# IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT
+# SHALL IIJ INNOVATION INSTITUTE INC. OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+'''
+The ukai_thread_pool.py module provides a bounded pool of worker
+threads used to issue I/O requests to multiple storage nodes in
+parallel.
+'''
+
+import Queue
+import sys
+import threading
+
+class UKAIThreadPoolTask(object):
+    '''
+    The UKAIThreadPoolTask class represents a function call submitted
+    to the UKAIThreadPool class.  The caller can wait for the
+    completion of the call and retrieve its result.
+    '''
+    def __init__(self, func, args):
+        '''
+        Initializes an instance with the function and its arguments.
+
+        func: The function to be called.
+        args: The arguments passed to the function.
+
+        Return values: This function does not return any values.
+        '''
+        self._func = func
+        self._args = args
+        self._result = None
+        self._exc_info = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        '''
+        Calls the function and keeps the result or the exception
+        raised by the function.  The done callbacks are called after
+        the call is completed.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._result = self._func(*self._args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        try:
+            self._lock.acquire()
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        '''
+        Registers a function which is called with this task as an
+        argument when the task is completed.  If the task has
+        already been completed, the function is called immediately.
+
+        callback: The function to be called.
+
+        Return values: This function does not return any values.
+        '''
+        try:
+            self._lock.acquire()
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+
+    def then(self, func):
+        '''
+        Returns a new task which is completed with the return value
+        of the function called with the result of this task, when
+        this task is completed.  If this task raised an exception, the
+        new task raises the same exception.  The function is called
+        from the thread which completes this task, so it must not
+        block.
+
+        func: The function which receives the result of this task.
+
+        Return values: An UKAIThreadPoolTask instance.
+        '''
+        task = UKAIThreadPoolTask(lambda: func(self.result()), ())
+        self.add_done_callback(lambda completed_task: task.run())
+        return (task)
+
+    def done(self):
+        '''
+        Returns True if the task has been completed.
+        '''
+        return (self._done.is_set())
+
+    def wait(self, timeout=None):
+        '''
+        Waits for the completion of the task.
+
+        timeout: The maximum time in seconds to wait.  If None is
+            specified, waits until the task is completed.
+
+        Return values: True if the task has been completed, False
+            if the timeout has expired.
+        '''
+        self._done.wait(timeout)
+        return (self._done.is_set())
+
+    @property
+    def exception(self):
+        '''
+        The exception raised by the function, or None if the function
+        returned normally.  Must be referred after the task has been
+        completed.
+        '''
+        if self._exc_info is None:
+            return (None)
+        return (self._exc_info[1])
+
+    def result(self):
+        '''
+        Waits for the completion of the task and returns the return
+        value of the function.  If the function raised an exception,
+        the exception is raised again.
+        '''
+        self.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return (self._result)
+
+class UKAIThreadPool(object):
+    '''
+    The UKAIThreadPool class provides a bounded set of worker threads
+    which execute submitted tasks.  If the pool has no worker thread,
+    the submitted tasks are executed immediately in the thread of the
+    caller.
+    '''
+    def __init__(self):
+        '''
+        Initializes an instance without any worker threads.  Call the
+        start() method to launch worker threads.
+
+        Return values: This function does not return any values.
+        '''
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        # The number of background tasks queued or running.
+        self._background_tasks = 0
+
+    @property
+    def num_workers(self):
+        '''
+        The number of worker threads.
+        '''
+        return (len(self._workers))
+
+    def start(self, config):
+        '''
+        Launches worker threads.  The number of workers is taken from
+        the io_workers parameter of the config.  The function does
+        nothing if the workers are already running.
+
+        config: an UKAIConfig instance.
+
+        Return values: This function does not return any values.
+        '''
+        num_workers = config.get('io_workers')
+        if num_workers is None:
+            num_workers = 0
+        try:
+            self._lock.acquire()
+            if len(self._workers) > 0:
+                return
+            for idx in range(0, num_workers):
+                worker = threading.Thread(target=self._worker,
+                                          name='ukai-io-%d' % idx)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        finally:
+            self._lock.release()
+
+    def submit(self, func, *args):
+        '''
+        Submits a function call to the pool.
+
+        func: The function to be called.
+        args: The arguments passed to the function.
+
+        Return values: An UKAIThreadPoolTask instance of the call.
+        '''
+        task = UKAIThreadPoolTask(func, args)
+        if len(self._workers) == 0:
+            task.run()
+        else:
+            self._queue.put(task)
+        return (task)
+
+    def submit_background(self, func, *args):
+        '''
+        Submits a function call which nobody waits for, such as
+        prefetching.  The number of background tasks queued or
+        running is limited to half of the worker threads, so that
+        the tasks submitted by the submit() method are not delayed
+        behind them.  If the limit is reached or the pool has no
+        worker thread, the call is dropped.
+
+        func: The function to be called.
+        args: The arguments passed to the function.
+
+        Return values: An UKAIThreadPoolTask instance of the call, or
+            None if the call is dropped.
+        '''
+        limit = max(len(self._workers) / 2, 1)
+        try:
+            self._lock.acquire()
+            if len(self._workers) == 0 or self._background_tasks >= limit:
+                return (None)
+            self._background_tasks += 1
+        finally:
+            self._lock.release()
+        task = UKAIThreadPoolTask(func, args)
+        task.add_done_callback(self._background_task_done)
+        self._queue.put(task)
+        return (task)
+
+    def _background_task_done(self, task):
+        try:
+            self._lock.acquire()
+            self._background_tasks -= 1
+        finally:
+            self._lock.release()
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            task.run()
+
+ukai_thread_pool = UKAIThreadPool()